@@ -0,0 +1,77 @@
+"""
+Benchmark de memoria y tiempo del DataFrame de anotaciones: columnas de texto
+(object) frente a columnas categóricas, como las devuelve SQLiteWrapper.get_annotations.
+
+Uso:
+    python benchmarks/benchmark_annotations.py [--rows 200000] [--books 800]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.db_manager import ANNOTATION_CATEGORY_COLUMNS
+from src.data_processor import process_data
+from src.functions_notion import create_content_hash
+
+
+def make_annotations(rows, books, seed=0):
+    """Genera un historial sintético de anotaciones con textos repetidos como los del Kobo."""
+    rng = random.Random(seed)
+    titles = [f"Libro de prueba número {i}: una novela" for i in range(books)]
+    authors = [f"Autor Apellido{i % (books // 3 + 1)}" for i in range(books)]
+    data = {column: [] for column in ['Autor', 'Título', 'Capítulo', 'Progreso del libro',
+                                      'Texto', 'Anotación', 'Tipo', 'Fecha de creación']}
+    for _ in range(rows):
+        book = rng.randrange(books)
+        data['Autor'].append(authors[book])
+        data['Título'].append(titles[book])
+        data['Capítulo'].append(f"Capítulo {rng.randrange(40)}")
+        data['Progreso del libro'].append(rng.random() * 100)
+        data['Texto'].append(f"Subrayado {rng.randrange(10 ** 9)}")
+        data['Anotación'].append("")
+        data['Tipo'].append(rng.choice(["subrayado", "nota"]))
+        data['Fecha de creación'].append(f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}")
+    libros = pd.DataFrame({'titulo': titles, 'autor': authors, 'estado': 'Leído', 'idioma': 'Español'})
+    return pd.DataFrame(data), libros
+
+
+def measure(label, anotaciones_df, libros_df):
+    start = time.perf_counter()
+    process_data(anotaciones_df, libros_df, pd.DataFrame(columns=['title', 'author', 'language', 'subjects',
+                                                                  'pages', 'publication_date']))
+    process_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    hashes = [create_content_hash(group)
+              for _, group in anotaciones_df.groupby('Título', sort=False, observed=True)]
+    pages_time = time.perf_counter() - start
+
+    memory_mb = anotaciones_df.memory_usage(deep=True).sum() / 1e6
+    print(f"{label:<12} memoria {memory_mb:8.1f} MB | process_data {process_time:6.2f} s | "
+          f"hash de {len(hashes)} libros {pages_time:6.2f} s")
+    return hashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de columnas categóricas en las anotaciones")
+    parser.add_argument('--rows', type=int, default=200_000, help="Número de anotaciones")
+    parser.add_argument('--books', type=int, default=800, help="Número de libros")
+    args = parser.parse_args()
+
+    anotaciones_df, libros_df = make_annotations(args.rows, args.books)
+    categoricas_df = anotaciones_df.astype({column: 'category' for column in ANNOTATION_CATEGORY_COLUMNS})
+
+    print(f"📊 {args.rows} anotaciones de {args.books} libros\n")
+    hashes_object = measure("object", anotaciones_df, libros_df)
+    hashes_category = measure("categórico", categoricas_df, libros_df)
+    print("\n✅ Mismos hashes de contenido" if hashes_object == hashes_category else "\n❌ Los hashes no coinciden")
+
+
+if __name__ == "__main__":
+    main()
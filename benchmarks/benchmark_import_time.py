@@ -0,0 +1,73 @@
+"""
+Guarda del tiempo de arranque de la CLI (tareas programadas, `--help`).
+
+Mide en procesos nuevos el arranque de `koboannotations.py --help` frente a importar
+main.py (que carga pandas, notion_client, dropbox...), y comprueba que la CLI no importa
+ninguno de los módulos pesados. Sale con código 1 si se supera el presupuesto o si
+algún módulo pesado se cuela en el arranque.
+
+Uso:
+    python benchmarks/benchmark_import_time.py [--runs 5] [--max-ms 300]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('pandas', 'numpy', 'notion_client', 'dropbox', 'bs4', 'tqdm', 'requests', 'polars')
+
+CHECK_HEAVY = (
+    "import sys; sys.argv = ['koboannotations', '--help']\n"
+    "import src.cli\n"
+    "try:\n"
+    "    src.cli.main()\n"
+    "except SystemExit:\n"
+    "    pass\n"
+    f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules), file=sys.stderr)\n"
+)
+
+
+def measure(command, runs):
+    """Mediana en ms del tiempo de pared de `command` en procesos nuevos."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiempo de arranque de la CLI")
+    parser.add_argument('--runs', type=int, default=5, help="Repeticiones de cada medida")
+    parser.add_argument('--max-ms', type=float, default=300, help="Presupuesto para `koboannotations.py --help`")
+    args = parser.parse_args()
+
+    baseline = measure([sys.executable, "-c", "pass"], args.runs)
+    cli = measure([sys.executable, "koboannotations.py", "--help"], args.runs)
+    full = measure([sys.executable, "-c", "import main"], args.runs)
+    heavy = subprocess.run([sys.executable, "-c", CHECK_HEAVY], cwd=ROOT, capture_output=True,
+                           text=True, check=True).stderr.strip()
+
+    print(f"🐍 Intérprete vacío          {baseline:8.1f} ms")
+    print(f"⚡ koboannotations --help    {cli:8.1f} ms (presupuesto {args.max_ms:.0f} ms)")
+    print(f"🐢 import main               {full:8.1f} ms")
+
+    ok = True
+    if heavy:
+        print(f"❌ La CLI importa módulos pesados al arrancar: {heavy}")
+        ok = False
+    if cli > args.max_ms:
+        print("❌ El arranque de la CLI supera el presupuesto")
+        ok = False
+    if ok:
+        print("✅ Arranque de la CLI dentro del presupuesto y sin módulos pesados")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
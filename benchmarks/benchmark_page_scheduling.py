@@ -0,0 +1,72 @@
+"""
+Simulación del tiempo total (makespan) de create_book_pages con 5 hilos: libros en el
+orden de groupby frente a primero los más largos (estimate_page_blocks).
+
+Cada libro cuesta lo que sus llamadas a Notion: borrar los bloques que tenía la página
+(uno por llamada) y añadir los nuevos en lotes de 100, todo en secuencia dentro del libro.
+Con la mayoría de libros pequeños y unos pocos enormes, si un libro enorme empieza el
+último su hilo termina mucho después que los demás.
+
+Uso:
+    python benchmarks/benchmark_page_scheduling.py [--books 300] [--workers 5] [--latency 0.35]
+"""
+import argparse
+import heapq
+import math
+import os
+import random
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.functions_notion import estimate_page_blocks
+
+
+def make_annotations(books, seed=0):
+    """Anotaciones sintéticas: tamaños de libro con cola larga (pocos libros con cientos de subrayados)."""
+    rng = random.Random(seed)
+    rows = []
+    for book in range(books):
+        size = max(1, int(rng.paretovariate(1.2) * 3))
+        for i in range(min(size, 1500)):
+            rows.append({'Título': f"Libro {book}", 'Capítulo': f"Capítulo {i // 12}",
+                         'Progreso del libro': i / size * 100})
+    return pd.DataFrame(rows)
+
+
+def book_calls(blocks):
+    """Llamadas secuenciales de un libro: borrar los bloques anteriores y añadir los nuevos de 100 en 100."""
+    return blocks + math.ceil(blocks / 100)
+
+
+def makespan(costs, workers):
+    """Tiempo total repartiendo los libros en orden al primer hilo libre (como ThreadPoolExecutor)."""
+    finish = [0.0] * workers
+    for cost in costs:
+        heapq.heapreplace(finish, finish[0] + cost)
+    return max(finish)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.35, help="Segundos por llamada a Notion")
+    args = parser.parse_args()
+
+    df = make_annotations(args.books)
+    groups = list(df.groupby('Título', sort=False, observed=True))
+    blocks = [estimate_page_blocks(group) for _, group in groups]
+    print(f"{len(groups)} libros, {len(df)} anotaciones, libro más largo {max(blocks)} bloques")
+
+    costs = [book_calls(b) * args.latency for b in blocks]
+    lower_bound = max(sum(costs) / args.workers, max(costs))
+    for label, ordered in [("groupby", costs), ("más largos", sorted(costs, reverse=True))]:
+        total = makespan(ordered, args.workers)
+        print(f"{label:<12} {total / 60:8.1f} min ({total / lower_bound:5.2f}x la cota inferior)")
+
+
+if __name__ == '__main__':
+    main()
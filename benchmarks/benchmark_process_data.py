@@ -0,0 +1,62 @@
+"""
+Comprueba que los motores 'pandas' y 'polars' de process_data devuelven el mismo
+DataFrame y compara sus tiempos sobre una biblioteca sintética.
+
+Uso:
+    python benchmarks/benchmark_process_data.py [--rows 200000] [--books 5000]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.data_processor import process_data
+from benchmarks.benchmark_annotations import make_annotations
+
+
+def make_metadata(libros_df):
+    """Metadatos de EPUB para dos de cada tres libros, con títulos escritos de otra forma."""
+    muestra = libros_df.loc[lambda x: x.index % 3 != 0]
+    return pd.DataFrame({
+        'title': muestra['titulo'].str.upper(),
+        'author': muestra['autor'],
+        'language': 'es',
+        'subjects': [["Ficción, Novela"]] * len(muestra),
+        'pages': range(100, 100 + len(muestra)),
+        'publication_date': '2001-02-03',
+    })
+
+
+def run(backend, anotaciones_df, libros_df, epub_metadata):
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        result = process_data(anotaciones_df, libros_df, epub_metadata, backend=backend)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Equivalencia y tiempos de los motores de process_data")
+    parser.add_argument('--rows', type=int, default=200_000, help="Número de anotaciones")
+    parser.add_argument('--books', type=int, default=5000, help="Número de libros")
+    args = parser.parse_args()
+
+    anotaciones_df, libros_df = make_annotations(args.rows, args.books)
+    epub_metadata = make_metadata(libros_df)
+
+    resultado_pandas, tiempo_pandas = run('pandas', anotaciones_df, libros_df, epub_metadata)
+    resultado_polars, tiempo_polars = run('polars', anotaciones_df, libros_df, epub_metadata)
+
+    print(f"📊 {args.rows} anotaciones de {args.books} libros")
+    print(f"pandas {tiempo_pandas:6.2f} s | polars {tiempo_polars:6.2f} s")
+    pd.testing.assert_frame_equal(resultado_pandas, resultado_polars)
+    print("✅ Ambos motores devuelven el mismo resultado")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Comprobación de DropboxClient y fetch_epub_metadata_from_dropbox contra un servidor HTTP
+local que imita /2/files/download (POST con Dropbox-API-Arg y Range) y /oauth2/token, sin
+red ni credenciales. Termina con error (AssertionError) si algo no cuadra.
+
+Verifica que:
+  - un token al que le quedan menos de TOKEN_REFRESH_MARGIN segundos se renueva una sola
+    vez aunque lo pidan todos los hilos, y uno válido no se renueva;
+  - todas las descargas llevan el token y la ruta en Dropbox-API-Arg;
+  - las peticiones simultáneas no pasan de los hilos configurados, reutilizan el pool de
+    conexiones compartido y los bytes pedidos en vuelo no pasan del límite;
+  - EPUB más grandes que el límite se leen igualmente en paralelo, porque cada petición
+    Range solo carga los bytes que pide;
+  - los metadatos coinciden con los del fichero completo.
+
+Uso:
+    python benchmarks/check_dropbox_client.py [--books 12] [--image-mb 2] [--workers 4]
+"""
+import argparse
+import http.server
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.functions_dropbox import DropboxClient, TOKEN_REFRESH_MARGIN, fetch_epub_metadata_from_dropbox
+from src.functions_epub import EpubProcessor
+from benchmarks.check_range_file import make_epub
+
+
+class DropboxHandler(http.server.BaseHTTPRequestHandler):
+    """Imita /2/files/download y /oauth2/token y anota la concurrencia que ve el servidor."""
+
+    protocol_version = "HTTP/1.1"
+    files = {}
+    access_token = "token-renovado"
+    delay = 0.02
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        cls.active = 0
+        cls.active_bytes = 0
+        cls.peak = 0
+        cls.peak_bytes = 0
+        cls.token_requests = 0
+        cls.downloads = 0
+        cls.connections = set()
+        cls.errors = []
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path == '/oauth2/token':
+            form = parse_qs(body.decode())
+            with self.lock:
+                DropboxHandler.token_requests += 1
+            if form.get('grant_type') != ['refresh_token'] or form.get('refresh_token') != ['refresco']:
+                self.send_body(400, b'{"error": "invalid_grant"}')
+                return
+            self.send_body(200, json.dumps({"access_token": self.access_token, "expires_in": 14400,
+                                            "token_type": "bearer"}).encode())
+        elif self.path == '/2/files/download':
+            self.download()
+        else:
+            self.send_body(404, b'')
+
+    def download(self):
+        if self.headers.get('Authorization') != f"Bearer {self.access_token}":
+            self.errors.append(("token", self.headers.get('Authorization')))
+            self.send_body(401, b'{"error": "expired_access_token"}')
+            return
+        data = self.files.get(json.loads(self.headers['Dropbox-API-Arg'])["path"])
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if data is None or match is None:
+            self.errors.append(("petición", self.headers.get('Dropbox-API-Arg'), self.headers.get('Range')))
+            self.send_body(409, b'{"error": "path/not_found"}')
+            return
+        first, last = match.groups()
+        if first == '':
+            start, end = max(0, len(data) - int(last)), len(data) - 1
+        else:
+            start, end = int(first), min(int(last or len(data) - 1), len(data) - 1)
+        # Bytes pedidos (los que el cliente carga a su límite), no los que quedan hasta el final
+        requested = int(last) if first == '' else int(last or len(data) - 1) - int(first) + 1
+        with self.lock:
+            DropboxHandler.downloads += 1
+            DropboxHandler.connections.add(self.client_address)
+            DropboxHandler.active += 1
+            DropboxHandler.active_bytes += requested
+            DropboxHandler.peak = max(DropboxHandler.peak, DropboxHandler.active)
+            DropboxHandler.peak_bytes = max(DropboxHandler.peak_bytes, DropboxHandler.active_bytes)
+        try:
+            time.sleep(self.delay)
+            self.send_body(206, data[start:end + 1], [('Content-Range', f'bytes {start}-{end}/{len(data)}')])
+        finally:
+            with self.lock:
+                DropboxHandler.active -= 1
+                DropboxHandler.active_bytes -= requested
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(files):
+    DropboxHandler.files = files
+    DropboxHandler.reset()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), DropboxHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def make_client(base_url, token_file, expires_in, workers):
+    with open(token_file, 'w') as f:
+        json.dump({"access_token": "token-viejo", "refresh_token": "refresco",
+                   "expires_at": time.time() + expires_in}, f)
+    return DropboxClient(app_key="clave", app_secret="secreto", token_file=token_file, pool_size=workers,
+                         download_url=f"{base_url}/2/files/download", token_url=f"{base_url}/oauth2/token")
+
+
+def check_token(base_url, token_file, workers):
+    # Le queda menos que el margen: se renueva una vez aunque lo pidan todos los hilos a la vez
+    client = make_client(base_url, token_file, TOKEN_REFRESH_MARGIN / 2, workers)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(client.get_token())) for _ in range(workers * 4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(tokens) == {DropboxHandler.access_token}, set(tokens)
+    assert DropboxHandler.token_requests == 1, DropboxHandler.token_requests
+    with open(token_file) as f:
+        assert json.load(f)["expires_at"] > time.time() + TOKEN_REFRESH_MARGIN
+
+    # Válido más allá del margen: ni se renueva ni se relee el fichero en cada llamada
+    client = make_client(base_url, token_file, 3600, workers)
+    assert client.get_token() == "token-viejo"
+    os.remove(token_file)
+    assert client.get_token() == "token-viejo"
+    assert DropboxHandler.token_requests == 1, DropboxHandler.token_requests
+    print("✅ Token: una renovación al entrar en el margen, ninguna con el token vigente")
+
+
+def check_fetch(base_url, token_file, files, expected, workers, max_inflight_bytes):
+    DropboxHandler.reset()
+    client = make_client(base_url, token_file, TOKEN_REFRESH_MARGIN / 2, workers)
+    items = [{"name": os.path.basename(path), "path": path, "size": len(data)} for path, data in files.items()]
+    with redirect_stdout(io.StringIO()) as output:
+        results = fetch_epub_metadata_from_dropbox(items, client, max_workers=workers,
+                                                   max_inflight_bytes=max_inflight_bytes)
+    assert not DropboxHandler.errors, DropboxHandler.errors
+    assert len(results) == len(items), output.getvalue()
+    assert all(metadata == expected for _, metadata in results)
+    assert DropboxHandler.token_requests == 1, DropboxHandler.token_requests
+    assert 1 < DropboxHandler.peak <= workers, DropboxHandler.peak
+    assert DropboxHandler.peak_bytes <= max_inflight_bytes, (DropboxHandler.peak_bytes, max_inflight_bytes)
+    assert len(DropboxHandler.connections) <= workers, len(DropboxHandler.connections)
+    print(f"✅ {len(results)} EPUBs de {len(next(iter(files.values()))) / 1e6:.1f} MB con un límite de "
+          f"{max_inflight_bytes / 1e6:.2f} MB: {DropboxHandler.downloads} peticiones, hasta {DropboxHandler.peak} "
+          f"a la vez ({DropboxHandler.peak_bytes / 1e3:.0f} KB en vuelo) por {len(DropboxHandler.connections)} "
+          f"conexiones")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comprobación de DropboxClient contra un servidor local")
+    parser.add_argument('--books', type=int, default=12, help="Número de EPUB en la carpeta simulada")
+    parser.add_argument('--image-mb', type=int, default=2, help="Tamaño de la imagen dentro de cada EPUB")
+    parser.add_argument('--workers', type=int, default=4, help="Descargas simultáneas")
+    args = parser.parse_args()
+
+    data = make_epub(args.image_mb)
+    with EpubProcessor(epub_content=data) as processor:
+        processor.process()
+        expected = processor.get_metadata()
+    files = {f"/Aplicaciones/Rakuten Kobo/Libro {i}.epub": data for i in range(args.books)}
+
+    server, base_url = start_server(files)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            token_file = os.path.join(tmp, "dropbox_token.json")
+            check_token(base_url, token_file, args.workers)
+            # Límite por debajo del tamaño de un EPUB: antes se leían de uno en uno
+            check_fetch(base_url, token_file, files, expected, args.workers, max_inflight_bytes=len(data) // 2)
+            # Límite de dos bloques de 64 KB: las peticiones esperan a que haya hueco
+            check_fetch(base_url, token_file, files, expected, args.workers, max_inflight_bytes=128 * 1024)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Comprobación de que los motores 'pandas' y 'polars' de process_data devuelven exactamente
+el mismo DataFrame (sin medir tiempos). Termina con error (AssertionError) si difieren.
+
+Cubre los casos que más fácilmente separan ambos motores: tildes, ligaduras y puntuación,
+subtítulos y volúmenes de una serie, "Apellido, Nombre", autores vacíos, géneros en una sola
+cadena o ausentes, EPUB duplicados, libros sin anotaciones, claves ya calculadas (como las
+de la etapa kobo) y el cruce aproximado.
+
+Uso:
+    python benchmarks/check_process_data_backends.py [--rows 20000] [--books 600]
+"""
+import argparse
+import io
+import os
+import sys
+from contextlib import redirect_stdout
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.book_keys import add_book_key, canonical_key, book_key_expr
+from src.data_processor import process_data
+from benchmarks.benchmark_annotations import make_annotations
+from benchmarks.benchmark_process_data import make_metadata
+
+TITLES = ["El señor de los anillos: La comunidad del anillo", "El señor de los anillos: Las dos torres",
+          "Harry Potter (1)", "Harry Potter (2)", "Dune", "Crème Brûlée — Añejo", "L'Étranger",
+          "ﬁn de Straße [Ed. 2]", "Título_con_guion", "  Solaris  ", "(Sin título)", None]
+AUTHORS = ["Tolkien, J.R.R.", "J.K. Rowling", "Herbert, Frank", "García Márquez, Gabriel", "", None]
+
+
+def tricky_library():
+    """Biblioteca pequeña con los casos límite de las claves y de los metadatos."""
+    libros = pd.DataFrame({'titulo': TITLES, 'autor': (AUTHORS * 2)[:len(TITLES)],
+                           'estado': 'Leído', 'idioma': 'Español'})
+    anotaciones = pd.DataFrame({
+        'Título': [t for t in TITLES[:-3] for _ in range(3)],
+        'Autor': [a for a in (AUTHORS * 2)[:len(TITLES) - 3] for _ in range(3)],
+        'Fecha de creación': [f"2024-0{i % 9 + 1}-1{i % 10}" for i in range((len(TITLES) - 3) * 3)],
+    })
+    metadata = pd.DataFrame({
+        # OPF con otra grafía, con y sin subtítulo, y un EPUB repetido
+        'title': ["EL SEÑOR DE LOS ANILLOS: LAS DOS TORRES", "Harry Potter (1)", "Dune: Las crónicas de Dune",
+                  "Creme Brulee - Anejo", "L’Étranger", "Dune: Las crónicas de Dune"],
+        'author': ["J.R.R. Tolkien", "Rowling, J.K.", "Frank Herbert", "Gabriel García Márquez", "", "Frank Herbert"],
+        'language': 'es',
+        'subjects': [["Fantasía, Aventura"], ["Fantasía", "Juvenil"], None, ["Ficción"], [], ["Otra"]],
+        'pages': [350, 300, None, 120, 90, 999],
+        'publication_date': ['1954-11-11', '1997-06-26', '1965-08-01', None, '1942-01-01', '2000-01-01'],
+    })
+    return anotaciones, libros, metadata
+
+
+def check_keys():
+    import polars as pl
+    pairs = [(title, author) for title in TITLES for author in AUTHORS]
+    frame = pl.DataFrame({'t': [p[0] for p in pairs], 'a': [p[1] for p in pairs]},
+                         schema={'t': pl.String, 'a': pl.String})
+    polars_keys = frame.select(key=book_key_expr('t', 'a'))['key'].to_list()
+    pandas_keys = add_book_key(pd.DataFrame({'titulo': frame['t'].to_list(), 'autor': frame['a'].to_list()}))
+    for (title, author), polars_key, pandas_key in zip(pairs, polars_keys, pandas_keys['book_key']):
+        expected = canonical_key(title, float('nan') if author is None else author)
+        assert polars_key == expected == pandas_key, (title, author, polars_key, expected, pandas_key)
+
+
+def check(label, anotaciones_df, libros_df, epub_metadata, fuzzy_threshold=None):
+    with redirect_stdout(io.StringIO()):
+        resultado_pandas = process_data(anotaciones_df, libros_df, epub_metadata, fuzzy_threshold, backend='pandas')
+        resultado_polars = process_data(anotaciones_df, libros_df, epub_metadata, fuzzy_threshold, backend='polars')
+    pd.testing.assert_frame_equal(resultado_pandas, resultado_polars)
+    print(f"✅ {label}: {len(resultado_pandas)} libros iguales en ambos motores")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Equivalencia de los motores de process_data")
+    parser.add_argument('--rows', type=int, default=20_000, help="Número de anotaciones sintéticas")
+    parser.add_argument('--books', type=int, default=600, help="Número de libros sintéticos")
+    args = parser.parse_args()
+
+    check_keys()
+    print("✅ Claves canónicas iguales en polars y en Python")
+
+    anotaciones_df, libros_df, epub_metadata = tricky_library()
+    check("casos límite", anotaciones_df, libros_df, epub_metadata)
+    check("casos límite con cruce aproximado", anotaciones_df, libros_df, epub_metadata, fuzzy_threshold=0.85)
+    # Claves ya calculadas y categóricas, como las deja la etapa kobo
+    check("claves precalculadas", add_book_key(anotaciones_df, 'Título', 'Autor'), add_book_key(libros_df),
+          epub_metadata)
+
+    anotaciones_df, libros_df = make_annotations(args.rows, args.books)
+    check("biblioteca sintética", anotaciones_df, libros_df, make_metadata(libros_df), fuzzy_threshold=0.9)
+
+
+if __name__ == "__main__":
+    main()
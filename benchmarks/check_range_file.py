@@ -0,0 +1,226 @@
+"""
+Comprobación de los RangeFile (lectura por rangos) contra un servidor HTTP local que
+admite cabeceras Range, sin red ni credenciales. Termina con error (AssertionError) si algo
+no cuadra.
+
+Cubre: lecturas y seeks que cruzan bloques comparadas con los bytes reales (LocalRangeFile y
+HTTPRangeFile, con y sin tamaño conocido, y con un servidor que ignora el Range), los
+metadatos de un EPUB leídos por rangos frente al fichero completo sin descargar la imagen
+grande que lleva dentro, y que fetch_epub_metadata_from_dropbox cierra todos los ficheros
+aunque un EPUB esté corrupto.
+
+Uso:
+    python benchmarks/check_range_file.py [--image-mb 4] [--block-kb 64]
+"""
+import argparse
+import http.server
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import zipfile
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.functions_dropbox import fetch_epub_metadata_from_dropbox
+from src.functions_epub import EpubProcessor
+from src.remote_file import HTTPRangeFile, LocalRangeFile
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>Crónica de una muerte anunciada</dc:title>
+    <dc:creator opf:role="aut">Gabriel García Márquez</dc:creator>
+    <dc:language>es</dc:language>
+    <dc:subject>Novela</dc:subject>
+    <dc:date>1981-01-01</dc:date>
+  </metadata>
+  <manifest>
+    <item id="portada" href="images/portada.jpg" media-type="image/jpeg"/>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{items}
+  </manifest>
+  <spine>
+{itemrefs}
+  </spine>
+</package>"""
+
+
+def make_epub(image_mb, chapters=5, seed=0):
+    """EPUB sintético con una imagen grande sin comprimir entre el OPF y los capítulos."""
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as epub:
+        epub.writestr('mimetype', 'application/epub+zip')
+        epub.writestr('META-INF/container.xml', CONTAINER)
+        items = "\n".join(f'    <item id="c{i}" href="c{i}.xhtml" media-type="application/xhtml+xml"/>'
+                          for i in range(chapters))
+        itemrefs = "\n".join(f'    <itemref idref="c{i}"/>' for i in range(chapters))
+        epub.writestr('OEBPS/content.opf', OPF.format(items=items, itemrefs=itemrefs))
+        links = "".join(f'<li><a href="c{i}.xhtml">Capítulo {i}</a></li>' for i in range(chapters))
+        epub.writestr('OEBPS/nav.xhtml', '<html xmlns="http://www.w3.org/1999/xhtml" '
+                      'xmlns:epub="http://www.idpf.org/2007/ops"><body>'
+                      f'<nav epub:type="toc"><ol>{links}</ol></nav></body></html>')
+        epub.writestr('OEBPS/images/portada.jpg', rng.randbytes(image_mb * 1024 * 1024))
+        for i in range(chapters):
+            text = " ".join(f"Párrafo {j} del capítulo {i}." for j in range(300))
+            epub.writestr(f'OEBPS/c{i}.xhtml', f"<html><body><h1>Capítulo {i}</h1><p>{text}</p></body></html>",
+                          compress_type=zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Sirve los ficheros de `files` atendiendo (o no, según `honor_range`) la cabecera Range."""
+
+    files = {}
+    honor_range = True
+
+    def do_GET(self):
+        data = self.files.get(self.path.lstrip('/'))
+        if data is None:
+            self.send_error(404)
+            return
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and self.honor_range:
+            first, last = match.groups()
+            if first == '':
+                start, end = max(0, len(data) - int(last)), len(data) - 1
+            else:
+                start, end = int(first), min(int(last or len(data) - 1), len(data) - 1)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(files):
+    RangeHandler.files = files
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def check_reads(label, range_file, data, seed=0):
+    """Lecturas aleatorias (también cruzando bloques y pasado el final) contra los bytes reales."""
+    rng = random.Random(seed)
+    assert range_file.size == len(data), (label, range_file.size, len(data))
+    for _ in range(200):
+        start = rng.randrange(len(data) + 10)
+        length = rng.choice([1, 7, range_file.block_size - 1, range_file.block_size + 3, 3 * range_file.block_size])
+        range_file.seek(start)
+        assert range_file.read(length) == data[start:start + length], (label, start, length)
+        assert range_file.tell() == min(start + length, max(start, len(data))), (label, start, length)
+    range_file.seek(-100, io.SEEK_END)
+    assert range_file.read() == data[-100:], label
+    range_file.seek(10)
+    range_file.seek(5, io.SEEK_CUR)
+    assert range_file.read(5) == data[15:20], label
+    # Releer lo ya leído no genera peticiones nuevas
+    requests_made = range_file.requests_made
+    range_file.seek(15)
+    range_file.read(5)
+    assert range_file.requests_made == requests_made, label
+    print(f"✅ {label}: lecturas iguales al fichero ({range_file.requests_made} peticiones)")
+
+
+def check_metadata(label, range_file, data, expected):
+    with range_file, EpubProcessor(epub_file=range_file) as processor:
+        processor.process()
+        metadata = processor.get_metadata()
+    assert metadata == expected, (label, metadata, expected)
+    assert range_file.closed, label
+    assert range_file.bytes_fetched < len(data) / 4, (label, range_file.bytes_fetched, len(data))
+    print(f"✅ {label}: metadatos iguales leyendo {range_file.bytes_fetched / 1e3:.0f} KB de {len(data) / 1e6:.1f} MB")
+
+
+class LocalClient:
+    """Sustituto de DropboxClient que abre los ficheros en el servidor local y recuerda cuáles abrió."""
+
+    def __init__(self, base_url, block_size):
+        self.base_url = base_url
+        self.block_size = block_size
+        self.opened = []
+
+    def open_range_file(self, item, budget=None):
+        range_file = HTTPRangeFile(f"{self.base_url}/{item['path']}", size=item["size"], block_size=self.block_size,
+                                   budget=budget)
+        self.opened.append(range_file)
+        return range_file
+
+
+def check_fetch_closes_files(base_url, files, block_size, expected):
+    client = LocalClient(base_url, block_size)
+    items = [{"name": name, "path": name, "size": len(data)} for name, data in files.items()]
+    with redirect_stdout(io.StringIO()) as output:
+        results = fetch_epub_metadata_from_dropbox(items, client, max_workers=2)
+    assert sorted(item["name"] for item, _ in results) == ['libro.epub'], output.getvalue()
+    assert all(metadata == expected for _, metadata in results)
+    assert "Fallo en roto.epub" in output.getvalue(), output.getvalue()
+    assert len(client.opened) == len(items) and all(f.closed for f in client.opened), \
+        [(f.url, f.closed) for f in client.opened]
+    assert all(not f.blocks for f in client.opened)
+    print(f"✅ fetch_epub_metadata_from_dropbox: {len(client.opened)} ficheros cerrados, también el EPUB corrupto")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comprobación de los RangeFile contra un servidor local")
+    parser.add_argument('--image-mb', type=int, default=4, help="Tamaño de la imagen dentro del EPUB")
+    parser.add_argument('--block-kb', type=int, default=64, help="Tamaño de bloque de los RangeFile")
+    args = parser.parse_args()
+    block_size = args.block_kb * 1024
+
+    data = make_epub(args.image_mb)
+    with EpubProcessor(epub_content=data) as processor:
+        processor.process()
+        expected = processor.get_metadata()
+    assert expected['title'] == "Crónica de una muerte anunciada", expected
+
+    # EPUB truncado: se corta el directorio central, así que zipfile no puede abrirlo
+    files = {'libro.epub': data, 'roto.epub': data[:len(data) // 2]}
+    server, base_url = start_server(files)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'libro.epub')
+            with open(path, 'wb') as f:
+                f.write(data)
+            with LocalRangeFile(path, block_size=block_size) as range_file:
+                check_reads("LocalRangeFile", range_file, data)
+            check_metadata("LocalRangeFile", LocalRangeFile(path, block_size=block_size), data, expected)
+
+        url = f"{base_url}/libro.epub"
+        with HTTPRangeFile(url, size=len(data), block_size=block_size) as range_file:
+            check_reads("HTTPRangeFile", range_file, data)
+        with HTTPRangeFile(url, block_size=block_size) as range_file:
+            check_reads("HTTPRangeFile sin tamaño", range_file, data)
+        check_metadata("HTTPRangeFile", HTTPRangeFile(url, size=len(data), block_size=block_size), data, expected)
+        check_metadata("HTTPRangeFile sin tamaño", HTTPRangeFile(url, block_size=block_size), data, expected)
+
+        check_fetch_closes_files(base_url, files, block_size, expected)
+
+        RangeHandler.honor_range = False
+        with HTTPRangeFile(url, block_size=block_size) as range_file:
+            check_reads("HTTPRangeFile con servidor sin Range", range_file, data)
+    finally:
+        RangeHandler.honor_range = True
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Comprobación del analizador de trazas (python -m src.tracing): escribe una traza con
+llamadas 200, 206 (lecturas por rangos de Dropbox), 429 y una excepción, y verifica que
+solo las dos últimas cuentan como errores. Termina con error (AssertionError) si no.
+
+Uso:
+    python benchmarks/check_tracing.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.tracing import disable_tracing, enable_tracing, load_trace, summarize_trace, trace_context, \
+    trace_request
+
+
+def write_trace(path):
+    enable_tracing(path)
+    try:
+        with trace_context(book="Dune"):
+            for status in (200, 206, 206, "206", 429):
+                with trace_request("dropbox", "files/download", target="/Dune.epub") as info:
+                    info["status"] = status
+            try:
+                with trace_request("dropbox", "files/download", target="/Dune.epub"):
+                    raise ConnectionError("conexión cortada")
+            except ConnectionError:
+                pass
+        with trace_request("notion", "pages.create"):
+            pass
+    finally:
+        disable_tracing()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "trace.jsonl")
+        write_trace(path)
+        summary = summarize_trace(load_trace(path))
+
+    endpoints = {item["name"]: item for item in summary["endpoints"]}
+    assert summary["requests"] == 7, summary
+    assert endpoints["dropbox files/download"]["calls"] == 6, endpoints
+    assert endpoints["dropbox files/download"]["errors"] == 2, endpoints
+    assert endpoints["notion pages.create"]["errors"] == 0, endpoints
+    assert summary["throttling"]["calls"] == 1, summary["throttling"]
+    assert summary["books"][0]["name"] == "Dune" and summary["books"][0]["calls"] == 6, summary["books"]
+    print("✅ Analizador de trazas: 200 y 206 son éxitos; 429 y excepciones, errores")
+
+
+if __name__ == "__main__":
+    main()
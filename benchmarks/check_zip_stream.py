@@ -0,0 +1,197 @@
+"""
+Comprobación de la descarga masiva (carpeta completa como zip): iter_zip_stream frente a
+zipfile con zips construidos en memoria, y recuperación cuando el stream se corta a mitad.
+Termina con error (AssertionError) si algo no cuadra.
+
+Cubre entradas STORED y DEFLATED, con descriptor de datos (zip escrito sin seek, como los
+que genera Dropbox al vuelo), ZIP64 (en la cabecera local y en el descriptor), directorios
+y nombres UTF-8; un zip truncado; y que DropboxBookSource conserva los EPUB ya procesados
+del zip, cierra la respuesta y lee por rangos solo los que faltan.
+
+Uso:
+    python benchmarks/check_zip_stream.py [--books 6] [--chunk-kb 7]
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import zipfile
+from contextlib import contextmanager, redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.functions_dropbox import DropboxBookSource
+from src.functions_epub import EpubProcessor
+from src.metadata_cache import compute_content_hash_bytes
+from src.remote_file import RangeFile, iter_zip_stream
+from benchmarks.check_range_file import make_epub
+
+
+class Unseekable:
+    """Destino de escritura sin seek: zipfile escribe entonces descriptores de datos."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+
+class ChunkedStream:
+    """Stream de lectura que entrega trozos pequeños y, opcionalmente, falla tras `fail_after` bytes."""
+
+    def __init__(self, data, chunk_size, fail_after=None):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.fail_after = fail_after
+        self.position = 0
+
+    def read(self, n=-1):
+        if self.fail_after is not None and self.position >= self.fail_after:
+            raise ConnectionError("conexión cortada")
+        n = self.chunk_size if n is None or n < 0 else min(n, self.chunk_size)
+        data = self.data[self.position:self.position + n]
+        self.position += len(data)
+        return data
+
+
+def entries(seed=0):
+    rng = random.Random(seed)
+    text = ("Capítulo primero. " * 3000).encode()
+    return {
+        "mimetype": b"application/epub+zip",
+        "texto/capítulo ñ.xhtml": text,
+        "imagen.jpg": rng.randbytes(200_000),
+        "vacío.txt": b"",
+    }
+
+
+def build_zip(files, compression, seekable=True, force_zip64=False):
+    target = io.BytesIO() if seekable else Unseekable()
+    with zipfile.ZipFile(target, 'w', compression=compression) as archive:
+        archive.writestr(zipfile.ZipInfo("carpeta/"), b"")
+        for name, data in files.items():
+            with archive.open(name, 'w', force_zip64=force_zip64) as f:
+                f.write(data)
+    return target.getvalue() if seekable else target.buffer.getvalue()
+
+
+def check_iter(label, data, chunk_size):
+    expected = {}
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if not info.is_dir():
+                expected[info.filename] = archive.read(info)
+    streamed = dict(iter_zip_stream(ChunkedStream(data, chunk_size)))
+    assert streamed == expected, (label, sorted(streamed), sorted(expected))
+    print(f"✅ {label}: {len(streamed)} entradas iguales a zipfile")
+
+
+def check_formats(chunk_size):
+    files = entries()
+    cases = [
+        ("STORED", build_zip(files, zipfile.ZIP_STORED)),
+        ("DEFLATED", build_zip(files, zipfile.ZIP_DEFLATED)),
+        ("DEFLATED con descriptor de datos", build_zip(files, zipfile.ZIP_DEFLATED, seekable=False)),
+        ("STORED ZIP64", build_zip(files, zipfile.ZIP_STORED, force_zip64=True)),
+        ("DEFLATED ZIP64", build_zip(files, zipfile.ZIP_DEFLATED, force_zip64=True)),
+        ("DEFLATED ZIP64 con descriptor de datos",
+         build_zip(files, zipfile.ZIP_DEFLATED, seekable=False, force_zip64=True)),
+    ]
+    for label, data in cases:
+        flags = {info.flag_bits & 0x08 for info in zipfile.ZipFile(io.BytesIO(data)).infolist() if not info.is_dir()}
+        assert flags == ({0x08} if "descriptor" in label else {0}), (label, flags)
+        check_iter(label, data, chunk_size)
+
+    # Entrada almacenada con descriptor: sin tamaño no se puede delimitar, error explícito
+    try:
+        list(iter_zip_stream(ChunkedStream(build_zip(files, zipfile.ZIP_STORED, seekable=False), chunk_size)))
+    except ValueError as e:
+        assert "descriptor" in str(e), e
+    else:
+        raise AssertionError("STORED con descriptor de datos debería fallar")
+
+    data = cases[0][1]
+    for cut in (len(data) // 3, len(data) // 2):
+        try:
+            list(iter_zip_stream(ChunkedStream(data[:cut], chunk_size)))
+        except ValueError as e:
+            assert "truncado" in str(e), e
+        else:
+            raise AssertionError(f"Un zip cortado en el byte {cut} debería fallar")
+    print("✅ STORED con descriptor y zips truncados: error explícito")
+
+
+class BytesRangeFile(RangeFile):
+    def __init__(self, data):
+        self.data = data
+        super().__init__(size=len(data))
+
+    def fetch_range(self, start, end):
+        return self.data[start:end + 1]
+
+
+class FolderClient:
+    """Sustituto de DropboxClient: la carpeta como zip que se corta a mitad y lectura por rangos en memoria."""
+
+    def __init__(self, folder_zip, fail_after, files, chunk_size):
+        self.folder_zip = folder_zip
+        self.fail_after = fail_after
+        self.files = files
+        self.chunk_size = chunk_size
+        self.zip_closed = False
+        self.ranged = []
+
+    @contextmanager
+    def open_folder_zip(self, folder_path):
+        try:
+            yield ChunkedStream(self.folder_zip, self.chunk_size, fail_after=self.fail_after)
+        finally:
+            self.zip_closed = True
+
+    def open_range_file(self, item, budget=None):
+        self.ranged.append(item["name"])
+        return BytesRangeFile(self.files[item["path"]])
+
+
+def check_partial_bulk(books, chunk_size):
+    files = {f"/Kobo/Libro {i}.epub": make_epub(1, seed=i) for i in range(books)}
+    folder_zip = build_zip({path.lstrip('/'): data for path, data in files.items()}, zipfile.ZIP_STORED)
+    items = [{"name": os.path.basename(path), "path": path, "size": len(data),
+              "content_hash": compute_content_hash_bytes(data)} for path, data in files.items()]
+    with EpubProcessor(epub_content=next(iter(files.values()))) as processor:
+        processor.process()
+        expected = processor.get_metadata()
+
+    # El stream se corta hacia la mitad de la carpeta
+    client = FolderClient(folder_zip, len(folder_zip) // 2, files, chunk_size)
+    source = DropboxBookSource(folder_path="/Kobo", bulk_threshold=1)
+    source.client = client
+    with redirect_stdout(io.StringIO()) as output:
+        results = source.fetch_metadata(items)
+    assert sorted(item["name"] for item, _ in results) == sorted(item["name"] for item in items), output.getvalue()
+    assert all(metadata == expected for _, metadata in results)
+    assert client.zip_closed, "La respuesta del zip no se cerró"
+    from_zip = len(items) - len(client.ranged)
+    assert 0 < from_zip < len(items), (from_zip, output.getvalue())
+    assert not set(client.ranged) & {item["name"] for item, _ in results[:from_zip]}, client.ranged
+    print(f"✅ Descarga masiva cortada: {from_zip} EPUBs conservados del zip, {len(client.ranged)} leídos por "
+          f"rangos y respuesta cerrada")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comprobación de iter_zip_stream y de la descarga masiva")
+    parser.add_argument('--books', type=int, default=6, help="EPUBs en la carpeta simulada")
+    parser.add_argument('--chunk-kb', type=int, default=7, help="Tamaño de los trozos que entrega el stream")
+    args = parser.parse_args()
+
+    check_formats(args.chunk_kb * 1024)
+    check_partial_bulk(args.books, args.chunk_kb * 1024)
+
+
+if __name__ == "__main__":
+    main()
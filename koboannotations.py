@@ -0,0 +1,9 @@
+"""
+Punto de entrada de la CLI: python koboannotations.py <subcomando> [opciones]
+(ver src/cli.py; `python koboannotations.py --help` para la lista de subcomandos).
+"""
+import sys
+from src.cli import main
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,53 +1,232 @@
+import argparse
 import os
 import pandas as pd
 from notion_client import Client
-from src.functions_dropbox import manage_epub_metadata
-from src.functions_notion import create_books, create_annotations, create_book_pages
-from src.data_processor import process_data
+from src.functions_dropbox import manage_epub_metadata, DropboxBookSource
+from src.book_sources import LocalBookSource
+from src.functions_calibre import get_calibre_metadata
+from src.functions_notion import (create_books, create_annotations, create_book_pages, get_database_fingerprint,
+                                  get_all_pages, get_existing_annotation_ids, BookPageStream, PageUpdates)
+from src.data_processor import process_data, EPUB_METADATA_COLUMNS
 from src.db_manager import SQLiteWrapper
-from src.config import NOTION_API_TOKEN, NOTION_BOOKS_DATABASE_ID, NOTION_ANNOTATIONS_DATABASE_ID
+from src.book_keys import add_book_key
+from src.pipeline import Pipeline, Stage, file_fingerprint
+from src.metrics import registry, instrument_client, write_reports
+from src.tracing import enable_tracing, disable_tracing, trace_client
+from src.run_lock import run_coalesced
+from src.budget import SyncBudget, budget_client
+from src.config import (NOTION_API_TOKEN, NOTION_BOOKS_DATABASE_ID, NOTION_ANNOTATIONS_DATABASE_ID, EPUB_LOCAL_DIR,
+                        CALIBRE_LIBRARY_PATH, BOOK_FUZZY_THRESHOLD, PIPELINE_PARALLEL, METRICS_DIR,
+                        TRACE_PATH, SYNC_MAX_MINUTES, SYNC_MAX_CALLS)
 
-def main():
-    """
-    Sincroniza las anotaciones de Kobo con Notion de forma incremental.
-    """
-    # --- 1. Carga de datos desde la BBDD de Kobo ---
+KOBO_DB_PATH = os.path.join("data", "KoboReader.sqlite")
+EPUB_CACHE_PATH = os.path.join("data", "epub_metadata_cache.sqlite")
+DROPBOX_FOLDER = '/Aplicaciones/Rakuten Kobo'
+
+def load_kobo_data(db_path=KOBO_DB_PATH):
+    """Carga anotaciones y libros de la BBDD del Kobo."""
     print("📖 Cargando datos desde Kobo...")
-    db_path = os.path.join("data", "KoboReader.sqlite")
     db = SQLiteWrapper(db_path)
     db.connect()
     anotaciones_df = db.get_annotations()
     libros_ereader_df = db.get_books()
     db.close()
+    # Clave canónica de cada libro, calculada una sola vez y reutilizada en todos los cruces
+    libros_ereader_df = add_book_key(libros_ereader_df)
+    anotaciones_df = add_book_key(anotaciones_df, 'Título', 'Autor')
     print(f"✅ {len(anotaciones_df)} anotaciones y {len(libros_ereader_df)} libros cargados.")
+    return anotaciones_df, libros_ereader_df
 
-    # --- 2. Obtención de metadatos de Dropbox con caché inteligente ---
-    epub_metadata = manage_epub_metadata(
-        libros_ereader_df, 
-        cache_path=os.path.join("data", "epub_metadata.pkl"),
-        folder_path='/Aplicaciones/Rakuten Kobo'
+def get_book_source():
+    """Origen de los EPUB: el directorio local si está configurado, si no Dropbox."""
+    if EPUB_LOCAL_DIR:
+        return LocalBookSource(EPUB_LOCAL_DIR, state_path=os.path.join("data", "local_listing.json"))
+    return DropboxBookSource(DROPBOX_FOLDER, listing_state_path=os.path.join("data", "dropbox_listing.json"))
+
+def get_epub_metadata(libros_ereader_df, source=None, cache=None):
+    """
+    Metadatos de los libros: Calibre, o EPUBs de Dropbox / directorio local con caché inteligente.
+    El modo daemon pasa un origen y una caché ya abiertos que se reutilizan entre ejecuciones.
+    """
+    if CALIBRE_LIBRARY_PATH:
+        return get_calibre_metadata(CALIBRE_LIBRARY_PATH)
+    return manage_epub_metadata(
+        libros_ereader_df,
+        cache_path=EPUB_CACHE_PATH,
+        folder_path=DROPBOX_FOLDER,
+        source=source or get_book_source(),
+        columns=EPUB_METADATA_COLUMNS,
+        cache=cache
     )
 
-    # --- 3. Procesamiento y enriquecimiento de datos ---
-    libros_df = process_data(anotaciones_df, libros_ereader_df, epub_metadata)
+def build_pipeline(notion, db_path=KOBO_DB_PATH, state=None, budget=None):
+    """
+    Grafo de etapas de la sincronización:
+
+        kobo ──► metadatos ──► procesado ──► libros ──► páginas
+          │                                    ┆ (ids de libros nuevos, uno a uno)
+          └──────────────────────────────► anotaciones
+        libros_notion ···► libros, anotaciones
+        ids_anotaciones ···► anotaciones
+
+    - kobo solo se vuelve a leer si cambia la BBDD del Kobo.
+    - metadatos se ejecuta siempre (su propia caché ya evita descargas), pero si su
+      salida no cambia, procesado no se repite.
+    - Las etapas de Notion se repiten si cambian sus datos de entrada o si la base de
+      datos de Notion ha cambiado desde que empezaron la última vez (la huella se toma
+      antes de escribir: tras una ejecución que escribe, la siguiente las repite y, como
+      los hashes ya coinciden, no escribe nada).
+    - libros_notion e ids_anotaciones (lecturas completas de Notion) solo se piden si
+      una etapa que las usa tiene que ejecutarse. En paralelo, si la huella de Notion ya
+      dice que se ejecutará (Notion cambió desde la última vez, no hay caché o --force),
+      se piden al arrancar y se descargan mientras se obtienen el Kobo y los metadatos; si
+      no, solo tras comprobar la caché (cuando procesado ya ha terminado).
+    - anotaciones no espera a libros: crea enseguida las de libros que ya existen y las
+      de un libro nuevo en cuanto libros publica su id.
+
+    libros no envía los cambios de los libros que ya existen: los deja en PageUpdates y páginas
+    los manda en la misma llamada que el Content_Hash de cada página que reescribe; el resto se
+    envía al terminar páginas. Si alguno falla, libros no se da por cacheada.
+
+    Con `budget` (SyncBudget) las etapas de escritura en Notion aplazan lo que no quepa y, si
+    aplazan algo, no se guardan en caché: la siguiente ejecución continúa donde se quedó esta.
+
+    Con `state` (SyncState del modo daemon) las lecturas de Notion se actualizan de forma
+    incremental sobre copias en memoria, la caché de EPUB sigue abierta y las salidas de
+    las etapas se reutilizan de memoria en lugar de leerse del disco.
+    """
+    pipeline = Pipeline(cache_dir=os.path.join("data", "pipeline_cache"),
+                        memory=state.memory if state else None)
+    book_stream = BookPageStream()
+    page_updates = PageUpdates(notion)
+
+    if state:
+        read_books = state.books.refresh
+        read_annotation_ids = lambda: {annotation_id for annotation_id in state.annotations.refresh() if annotation_id}
+        read_epub_metadata = lambda libros: get_epub_metadata(libros, source=state.book_source, cache=state.epub_cache)
+    else:
+        read_books = lambda: get_all_pages(notion, NOTION_BOOKS_DATABASE_ID)
+        read_annotation_ids = lambda: get_existing_annotation_ids(notion, NOTION_ANNOTATIONS_DATABASE_ID)
+        read_epub_metadata = get_epub_metadata
+
+    def notion_fingerprint(*database_ids):
+        return lambda: [get_database_fingerprint(notion, database_id) for database_id in database_ids]
+
+    def sync_books(libros_df, existing_books):
+        print("\n   -> Sincronizando libros...")
+        return create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, existing_books=existing_books,
+                            book_stream=book_stream, budget=budget, page_updates=page_updates)
+
+    def sync_annotations(kobo, existing_books, existing_ids):
+        print("\n   -> Sincronizando anotaciones...")
+        _, failed, deferred = create_annotations(kobo[0], notion, NOTION_ANNOTATIONS_DATABASE_ID,
+                                                 NOTION_BOOKS_DATABASE_ID, existing_ids=existing_ids,
+                                                 all_books=existing_books, book_stream=book_stream, budget=budget)
+        return failed + deferred
+
+    def sync_pages(kobo, _):
+        print("\n   -> Actualizando páginas de libros...")
+        return create_book_pages(kobo[0], notion, NOTION_BOOKS_DATABASE_ID, budget=budget, page_updates=page_updates)
+
+    def flush_page_updates():
+        # Cambios de libros cuya página no se reescribió (o si páginas falló o vino de caché)
+        if page_updates.flush_all():
+            # Quedaron propiedades o hashes sin escribir: la siguiente ejecución repite libros
+            pipeline.invalidate("libros")
+
+    # version: la salida incluye la clave canónica de cada libro (cambiarla obliga a recalcularla)
+    pipeline.add(Stage("kobo", lambda: load_kobo_data(db_path), fingerprint=lambda: file_fingerprint(db_path),
+                       version=2))
+    pipeline.add(Stage("metadatos", lambda kobo: read_epub_metadata(kobo[1]), inputs=["kobo"], cache=False))
+    pipeline.add(Stage("libros_notion", read_books, cache=False, lazy=True))
+    pipeline.add(Stage("ids_anotaciones", read_annotation_ids, cache=False, lazy=True))
+    pipeline.add(Stage("procesado", lambda kobo, epub_metadata: process_data(kobo[0], kobo[1], epub_metadata),
+                       inputs=["kobo", "metadatos"], fingerprint=lambda: BOOK_FUZZY_THRESHOLD))
+    # Al terminar libros (aunque venga de caché o falle) se cierra el canal de libros nuevos.
+    # Las etapas de escritura devuelven lo que dejaron pendiente; si no es 0 no se cachean
+    pipeline.add(Stage("libros", sync_books, inputs=["procesado", "libros_notion"], untracked=["libros_notion"],
+                       fingerprint=notion_fingerprint(NOTION_BOOKS_DATABASE_ID), on_done=book_stream.close,
+                       cache_if=lambda pending: pending == 0))
+    # Si quedaron anotaciones sin crear (p. ej. su libro falló o se aplazaron) no se da la etapa por cacheada
+    pipeline.add(Stage("anotaciones", sync_annotations, inputs=["kobo", "libros_notion", "ids_anotaciones"],
+                       untracked=["libros_notion", "ids_anotaciones"],
+                       fingerprint=notion_fingerprint(NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_DATABASE_ID),
+                       cache_if=lambda failed: failed == 0, version=2))
+    pipeline.add(Stage("páginas", sync_pages, inputs=["kobo", "libros"],
+                       fingerprint=notion_fingerprint(NOTION_BOOKS_DATABASE_ID), on_done=flush_page_updates,
+                       cache_if=lambda pending: pending == 0))
+    return pipeline
 
-    # --- 4. Sincronización con Notion ---
-    print("\n🚀 Sincronizando con Notion...")
+def plan_sync(db_path=KOBO_DB_PATH):
+    """Muestra qué etapas ejecutaría la sincronización, sin ejecutar ninguna ni escribir en Notion."""
     notion = Client(auth=NOTION_API_TOKEN)
+    pipeline = build_pipeline(notion, db_path)
+    print("\n🗺️ Plan de sincronización:")
+    for name, status, detail in pipeline.plan():
+        print(f"   {name:<16} {status}" + (f" (si cambia {', '.join(detail)})" if detail else ""))
 
-    # Crear/actualizar libros
-    print("\n   -> Sincronizando libros...")
-    create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID)
+def create_notion_client():
+    """Cliente de Notion con métricas por endpoint (y traza, si está activada)."""
+    return instrument_client(trace_client(Client(auth=NOTION_API_TOKEN), "notion"), "notion")
 
-    # Crear nuevas anotaciones
-    print("\n   -> Sincronizando anotaciones...")
-    create_annotations(anotaciones_df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_DATABASE_ID)
+def main(force=False, state=None, db_path=KOBO_DB_PATH, max_minutes=SYNC_MAX_MINUTES, max_calls=SYNC_MAX_CALLS):
+    """
+    Sincroniza las anotaciones de Kobo con Notion de forma incremental.
 
-    # Actualizar contenido de las páginas de los libros (solo si hay cambios)
-    print("\n   -> Actualizando páginas de libros...")
-    create_book_pages(anotaciones_df, notion, NOTION_BOOKS_DATABASE_ID)
+    Args:
+        force: Si es True se ignora la caché de etapas y se ejecuta todo.
+        state: SyncState del modo daemon (cliente, copias de Notion y cachés que se mantienen
+            entre ejecuciones); el daemon gestiona también la traza.
+        db_path: BBDD del Kobo.
+        max_minutes: Minutos de reloj tras los que no se empieza trabajo nuevo en Notion (None = sin límite).
+        max_calls: Llamadas a Notion tras las que no se empieza trabajo nuevo (None = sin límite).
+    """
+    print("\n🚀 Sincronizando Kobo con Notion...")
+    registry.reset()
+    if TRACE_PATH and state is None:
+        enable_tracing(TRACE_PATH)
+        print(f"🔎 Traza de llamadas a la API en {TRACE_PATH}")
+    budget = SyncBudget(max_seconds=max_minutes * 60 if max_minutes else None, max_calls=max_calls)
+    if budget.limited:
+        print(f"⏳ Presupuesto: {f'{max_minutes:g} min' if max_minutes else 'sin límite de tiempo'}, "
+              f"{f'{max_calls} llamadas a Notion' if max_calls else 'sin límite de llamadas'}")
+    notion = budget_client(state.notion if state else create_notion_client(), budget)
+    pipeline = build_pipeline(notion, db_path, state=state, budget=budget if budget.limited else None)
+    status = "error"
+    try:
+        pipeline.run(force=force, parallel=PIPELINE_PARALLEL)
+        status = "ok"
+    finally:
+        pipeline.report()
+        if METRICS_DIR:
+            stages = [{"stage": name, "status": stage_status, "start_seconds": round(offset, 3),
+                       "seconds": round(seconds, 3)} for name, stage_status, offset, seconds in pipeline.timings]
+            write_reports(METRICS_DIR, {"status": status, "force": force, "stages": stages,
+                                        "wall_seconds": round(pipeline.wall_time, 3), "budget": budget.summary()})
+            print(f"📈 Métricas de la ejecución en {METRICS_DIR}")
+        if state is None:
+            disable_tracing()
 
     print("\n✨ ¡Sincronización completada! ✨")
 
+def run_sync(force=False, state=None, db_path=KOBO_DB_PATH, max_minutes=SYNC_MAX_MINUTES, max_calls=SYNC_MAX_CALLS):
+    """
+    main() con exclusión entre procesos (ver src/run_lock.py): si ya hay otra sincronización
+    en marcha la petición queda en cola y esa ejecutará una incremental más al terminar.
+
+    Returns:
+        int: Sincronizaciones ejecutadas por este proceso (0 si quedó en cola).
+    """
+    budget = {"max_minutes": max_minutes, "max_calls": max_calls}
+    return run_coalesced(lambda: main(force=force, state=state, db_path=db_path, **budget),
+                         followup=lambda: main(state=state, db_path=db_path, **budget))
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Sincroniza las anotaciones de Kobo con Notion")
+    parser.add_argument("--force", action="store_true", help="Ignorar la caché de etapas y ejecutarlo todo")
+    parser.add_argument("--max-minutes", type=float, default=SYNC_MAX_MINUTES,
+                        help="Dejar para la siguiente ejecución lo que no quepa en estos minutos")
+    parser.add_argument("--max-calls", type=int, default=SYNC_MAX_CALLS,
+                        help="Dejar para la siguiente ejecución lo que no quepa en estas llamadas a Notion")
+    args = parser.parse_args()
+    run_sync(force=args.force, max_minutes=args.max_minutes, max_calls=args.max_calls)
@@ -0,0 +1,216 @@
+"""
+Clave canónica de libro compartida por todos los pasos que cruzan libros.
+
+El Kobo, los metadatos del OPF, los nombres de fichero de Dropbox y Notion escriben
+el mismo libro de formas ligeramente distintas (tildes, mayúsculas, puntuación,
+"Apellido, Nombre"...). Todos los cruces usan canonical_key() para comparar.
+
+La clave conserva el subtítulo y el número de la serie: "El señor de los anillos: Las dos
+torres" y "Harry Potter (2)" son libros distintos de sus otros volúmenes. La clave sin
+subtítulo (base_key) solo sirve de respaldo para cruzar cuando no hay coincidencia exacta
+y es única; nunca para decidir que dos libros son el mismo. Para archivar páginas duplicadas
+de Notion, que es destructivo, hace falta además que coincida exact_key (título y autor
+literales, sin distinguir mayúsculas ni espacios).
+"""
+import re
+import unicodedata
+from difflib import SequenceMatcher
+import pandas as pd
+
+# Todo lo que va tras estos separadores se considera subtítulo
+SUBTITLE_PATTERN = re.compile(r"\s*(?::|\s[-–—]\s|\(|\[).*$")
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+SPACES_PATTERN = re.compile(r"\s+")
+NUMBER_PATTERN = re.compile(r"\d+")
+# Separa en la clave el título del subtítulo (fold_text nunca deja ':' en el texto)
+SUBTITLE_SEPARATOR = " : "
+
+
+def fold_text(text):
+    """Normaliza Unicode, quita tildes, pasa a minúsculas y elimina la puntuación."""
+    if not isinstance(text, str):
+        return ""
+    text = unicodedata.normalize('NFKD', text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    text = PUNCTUATION_PATTERN.sub(" ", text.replace("_", " "))
+    return SPACES_PATTERN.sub(" ", text).strip()
+
+
+def title_key(title):
+    """
+    Clave del título completo, sin tildes ni puntuación. El subtítulo (o número de volumen)
+    se conserva tras SUBTITLE_SEPARATOR para poder quitarlo en base_title_key.
+    """
+    if not isinstance(title, str):
+        return ""
+    title = title.strip()
+    match = SUBTITLE_PATTERN.search(title)
+    main_title = fold_text(title[:match.start()]) if match else ""
+    subtitle = fold_text(title[match.start():]) if match else ""
+    if not main_title:
+        return fold_text(title)
+    return f"{main_title}{SUBTITLE_SEPARATOR}{subtitle}" if subtitle else main_title
+
+
+def base_title_key(title):
+    """Clave del título sin subtítulo: solo para cruces de respaldo, distintos volúmenes comparten clave."""
+    return title_key(title).partition(SUBTITLE_SEPARATOR)[0]
+
+
+def author_key(author):
+    """Clave del autor: palabras ordenadas, para que 'Apellido, Nombre' y 'Nombre Apellido' coincidan."""
+    return " ".join(sorted(fold_text(author).split()))
+
+
+def canonical_key(title, author=None):
+    """Clave canónica de un libro (título y, si se conoce, autor)."""
+    if author is None:
+        return title_key(title)
+    return f"{title_key(title)}|{author_key(author)}"
+
+
+def exact_key(title, author):
+    """Título y autor literales (solo sin mayúsculas ni espacios sobrantes), como el antiguo cruce exacto."""
+    return tuple(SPACES_PATTERN.sub(" ", value).strip().casefold() if isinstance(value, str) else ""
+                 for value in (title, author))
+
+
+def base_key(key):
+    """Clave canónica sin el subtítulo del título (ver base_title_key)."""
+    title, separator, author = key.partition("|")
+    return f"{title.partition(SUBTITLE_SEPARATOR)[0]}{separator}{author}"
+
+
+def fold_text_expr(expr):
+    """fold_text como expresión de polars (mismo resultado, sin pasar por Python fila a fila)."""
+    return expr.str.normalize('NFKD').str.replace_all(r"\p{M}", "")\
+        .str.to_lowercase().str.replace_all("ß", "ss").str.replace_all("_", " ")\
+        .str.replace_all(PUNCTUATION_PATTERN.pattern, " ").str.replace_all(SPACES_PATTERN.pattern, " ")\
+        .str.strip_chars().fill_null("")
+
+
+def book_key_expr(title_col, author_col):
+    """canonical_key(título, autor) como expresión de polars, para el motor polars de process_data."""
+    import polars as pl
+
+    title = pl.col(title_col).cast(pl.String).str.strip_chars()
+    parts = title.str.extract_groups(f"^(.*?)({SUBTITLE_PATTERN.pattern})")
+    main_title = fold_text_expr(parts.struct.field("1"))
+    subtitle = fold_text_expr(parts.struct.field("2"))
+    title_part = pl.when(main_title == "").then(fold_text_expr(title))\
+        .when(subtitle == "").then(main_title)\
+        .otherwise(pl.concat_str([main_title, pl.lit(SUBTITLE_SEPARATOR), subtitle]))
+    author_part = fold_text_expr(pl.col(author_col).cast(pl.String)).str.split(" ").list.sort().list.join(" ")
+    return pl.concat_str([title_part, pl.lit("|"), author_part])
+
+
+def base_key_expr(key_col):
+    """base_key como expresión de polars."""
+    import polars as pl
+    return pl.col(key_col).str.replace(f"{re.escape(SUBTITLE_SEPARATOR)}[^|]*", "")
+
+
+def add_book_key(df, title_col='titulo', author_col='autor', key_col='book_key'):
+    """
+    Añade la columna de clave canónica a un DataFrame, calculándola una sola vez por
+    pareja (título, autor) distinta. La columna es categórica: cada fila solo guarda el
+    código de su clave. Si la columna ya existe no se recalcula.
+    """
+    if key_col in df.columns:
+        return df
+    groups = df.groupby([title_col, author_col], sort=False, observed=True, dropna=False)
+    pair_keys = [canonical_key(t, a) for t, a in groups.size().index]
+    categories = pd.Index(pair_keys, dtype=object).unique()
+    codes = categories.get_indexer(pair_keys)[groups.ngroup().to_numpy()] if len(df) else []
+    return df.assign(**{key_col: pd.Categorical.from_codes(codes, categories=categories)})
+
+
+class BlockedFuzzyMatcher:
+    """
+    Cruce aproximado de claves de libro sin comparar todas contra todas.
+
+    Las claves se agrupan en bloques por cada palabra significativa del autor (o del
+    título si no hay autor) y solo se comparan candidatos que comparten bloque. Claves
+    con números distintos o con subtítulos distintos (volúmenes de una serie) nunca se cruzan.
+
+    Args:
+        keys: Claves canónicas (canonical_key) contra las que buscar.
+        threshold: Similitud mínima (0-1) para aceptar un cruce.
+    """
+
+    def __init__(self, keys, threshold=0.9):
+        self.threshold = threshold
+        self.blocks = {}
+        for key in set(keys):
+            for block in self.block_keys(key):
+                self.blocks.setdefault(block, []).append(key)
+
+    @staticmethod
+    def block_keys(key):
+        title, _, author = key.partition("|")
+        words = [w for w in (author or title).split() if len(w) >= 3]
+        return set(words or (author or title).split()[:1])
+
+    @staticmethod
+    def subtitle(key):
+        return key.partition("|")[0].partition(SUBTITLE_SEPARATOR)[2]
+
+    def match(self, key):
+        """Devuelve la clave más parecida por encima del umbral, o None."""
+        candidates = set()
+        for block in self.block_keys(key):
+            candidates.update(self.blocks.get(block, ()))
+        best, best_ratio = None, self.threshold
+        numbers = NUMBER_PATTERN.findall(key)
+        subtitle = self.subtitle(key)
+        for candidate in candidates:
+            if NUMBER_PATTERN.findall(candidate) != numbers:
+                continue
+            candidate_subtitle = self.subtitle(candidate)
+            if (subtitle and candidate_subtitle
+                    and SequenceMatcher(None, subtitle, candidate_subtitle).ratio() < self.threshold):
+                continue
+            matcher = SequenceMatcher(None, key, candidate)
+            if matcher.quick_ratio() < best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = candidate, ratio
+        return best
+
+
+def match_book_keys(keys, known_keys, fuzzy_threshold=None):
+    """
+    Asocia cada clave con la clave conocida que le corresponde: la misma si existe; si no,
+    la que coincide sin subtítulo cuando en ambos lados es la única con ese título base y
+    una de las dos no tiene subtítulo (así "Dune" cruza con "Dune: Las crónicas de Dune"
+    pero un volumen nunca con otro) y,
+    si se indica fuzzy_threshold, la más parecida según BlockedFuzzyMatcher.
+
+    Returns:
+        dict: {clave: clave conocida} solo para las claves con pareja.
+    """
+    known_keys = set(known_keys)
+    matches = {key: key for key in set(keys) if key in known_keys}
+    missing = [key for key in set(keys) if key not in matches]
+    if missing:
+        known_by_base, keys_by_base = {}, {}
+        for key in known_keys:
+            known_by_base.setdefault(base_key(key), []).append(key)
+        for key in set(keys):
+            keys_by_base.setdefault(base_key(key), []).append(key)
+        for key in missing:
+            base = base_key(key)
+            if len(known_by_base.get(base, ())) == 1 and len(keys_by_base[base]) == 1:
+                known = known_by_base[base][0]
+                if SUBTITLE_SEPARATOR not in key or SUBTITLE_SEPARATOR not in known:
+                    matches[key] = known
+    if fuzzy_threshold:
+        missing = [key for key in set(keys) if key not in matches]
+        if missing:
+            matcher = BlockedFuzzyMatcher(known_keys, threshold=fuzzy_threshold)
+            for key in missing:
+                match = matcher.match(key)
+                if match is not None:
+                    matches[key] = match
+    return matches
@@ -0,0 +1,116 @@
+"""
+Orígenes de ficheros EPUB para la caché de metadatos.
+
+Un origen sabe listar sus EPUB (con su content_hash, para decidir qué procesar solo
+con el listado) y extraer los metadatos de los que se le pidan. Todos alimentan el
+mismo EpubProcessor y la misma EpubMetadataCache.
+"""
+import json
+import os
+from src.functions_epub import EpubProcessor
+from src.metadata_cache import compute_content_hash, atomic_write_bytes
+
+LOCAL_STATE_SCHEMA_VERSION = 1
+
+
+class BookSource:
+    """
+    Interfaz común de los orígenes de EPUB.
+
+    list_epubs() devuelve un dict por fichero con 'path', 'name', 'content_hash' y 'size'.
+    fetch_metadata(items) devuelve tuplas (item, metadatos) de los que se procesan bien.
+    """
+
+    name = "origen"
+
+    def list_epubs(self):
+        raise NotImplementedError
+
+    def fetch_metadata(self, items):
+        raise NotImplementedError
+
+
+class LocalBookSource(BookSource):
+    """
+    EPUB en un directorio local o en el Kobo montado como disco.
+
+    El árbol se recorre con os.scandir y se guarda (ruta, tamaño, mtime) de cada fichero
+    junto con su content_hash: solo se vuelve a calcular el hash de los ficheros cuyo
+    tamaño o mtime hayan cambiado.
+
+    Args:
+        root: Directorio raíz donde buscar los EPUB.
+        state_path: Fichero donde guardar el estado del último recorrido (opcional).
+    """
+
+    name = "disco local"
+
+    def __init__(self, root, state_path=None):
+        self.root = os.path.abspath(root)
+        self.state_path = state_path
+
+    def load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if state.get("schema_version") != LOCAL_STATE_SCHEMA_VERSION or state.get("root") != self.root:
+            return {}
+        return state.get("entries", {})
+
+    def save_state(self, entries):
+        state = {"schema_version": LOCAL_STATE_SCHEMA_VERSION, "root": self.root, "entries": entries}
+        atomic_write_bytes(self.state_path, json.dumps(state, ensure_ascii=False).encode('utf-8'))
+
+    def scan(self, directory):
+        """Recorre el árbol con os.scandir devolviendo las entradas de ficheros .epub."""
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self.scan(entry.path)
+                    elif entry.is_file() and entry.name.lower().endswith('.epub'):
+                        yield entry
+        except PermissionError:
+            return
+
+    def list_epubs(self):
+        previous = self.load_state()
+        entries = {}
+        hashed = 0
+
+        for entry in self.scan(self.root):
+            stat = entry.stat()
+            path = entry.path
+            known = previous.get(path)
+            if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                content_hash = known["content_hash"]
+            else:
+                content_hash = compute_content_hash(path)
+                hashed += 1
+            entries[path] = {"path": path, "name": entry.name, "content_hash": content_hash,
+                             "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+        if self.state_path and entries != previous:
+            self.save_state(entries)
+        if previous:
+            print(f"   -> {len(entries)} EPUBs en {self.root}, {hashed} nuevos o modificados.")
+        return list(entries.values())
+
+    def fetch_metadata(self, items):
+        results = []
+        for item in items:
+            try:
+                # zipfile lee del disco solo el directorio central y las entradas necesarias
+                with open(item["path"], 'rb') as epub_file, EpubProcessor(epub_file=epub_file) as processor:
+                    processor.process()
+                    metadata = processor.get_metadata()
+                results.append((item, metadata))
+            except Exception as e:
+                print(f"Fallo en {item['name']}: {e}")
+        return results
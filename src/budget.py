@@ -0,0 +1,98 @@
+"""
+Presupuesto de una sincronización: tiempo máximo de reloj y/o número máximo de llamadas
+a la API de Notion.
+
+Las funciones de functions_notion comprueban el presupuesto antes de empezar cada unidad
+de trabajo (un libro, una anotación, la página de un libro) y, si se ha agotado, la
+aplazan en lugar de empezarla: lo que ya está en curso termina, así que nunca queda una
+página a medio escribir y el límite de llamadas puede superarse en las de esas unidades.
+Las etapas con trabajo aplazado no se guardan en la caché del pipeline, de modo que la
+siguiente ejecución continúa donde se quedó esta. Como el trabajo se recorre de más a
+menos reciente, cada ejecución entrega primero lo más valioso.
+"""
+import threading
+import time
+from src.metrics import count
+
+
+class SyncBudget:
+    """
+    Args:
+        max_seconds: Segundos de reloj desde que se crea (None = sin límite).
+        max_calls: Llamadas a la API a través de budget_client (None = sin límite).
+    """
+
+    def __init__(self, max_seconds=None, max_calls=None):
+        self.max_seconds = max_seconds
+        self.max_calls = max_calls
+        self.started = time.monotonic()
+        self.calls = 0
+        self.exhausted_reason = None
+        self.lock = threading.Lock()
+
+    @property
+    def limited(self):
+        return self.max_seconds is not None or self.max_calls is not None
+
+    def spend(self, calls=1):
+        with self.lock:
+            self.calls += calls
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def exhausted(self):
+        """True si ya no se debe empezar trabajo nuevo (avisa una sola vez)."""
+        if self.exhausted_reason is not None:
+            return True
+        reason = None
+        if self.max_seconds is not None and self.elapsed() >= self.max_seconds:
+            reason = f"{self.max_seconds / 60:g} min"
+        elif self.max_calls is not None and self.calls >= self.max_calls:
+            reason = f"{self.max_calls} llamadas a Notion"
+        if reason is None:
+            return False
+        with self.lock:
+            if self.exhausted_reason is None:
+                self.exhausted_reason = reason
+                print(f"\n⏸️ Presupuesto agotado ({reason}): el resto queda para la siguiente ejecución.")
+        return True
+
+    def defer(self, stage, units):
+        """Registra las unidades de trabajo aplazadas por una etapa."""
+        if units:
+            count("budget_deferred", units, stage=stage)
+
+    def summary(self):
+        return {"max_seconds": self.max_seconds, "max_calls": self.max_calls, "calls": self.calls,
+                "seconds": round(self.elapsed(), 3), "exhausted": self.exhausted_reason}
+
+
+class BudgetedClient:
+    """
+    Envuelve un cliente de API y descuenta del presupuesto cada llamada a sus endpoints,
+    con la misma interfaz (ver InstrumentedClient).
+    """
+
+    def __init__(self, client, budget):
+        self._client = client
+        self._budget = budget
+        self._package = type(client).__module__.split(".")[0]
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if callable(value):
+            budget = self._budget
+
+            def call(*args, **kwargs):
+                budget.spend()
+                return value(*args, **kwargs)
+            return call
+        if type(value).__module__.split(".")[0] == self._package:
+            return BudgetedClient(value, self._budget)
+        return value
+
+
+def budget_client(client, budget):
+    """Devuelve el cliente envuelto si el presupuesto limita las llamadas, o el mismo cliente si no."""
+    return BudgetedClient(client, budget) if budget is not None and budget.max_calls is not None else client
@@ -0,0 +1,166 @@
+"""
+CLI única del proyecto:
+
+    python koboannotations.py sync [--force] [--max-minutes 15] [--max-calls 2000]
+    python koboannotations.py plan
+    python koboannotations.py cleanup {duplicados,paginas,todo} [--yes]
+    python koboannotations.py transfer --source OLD.sqlite --target NEW.sqlite [--dry-run]
+    python koboannotations.py koreader [--test | --sync-once | --setup]
+    python koboannotations.py export [--format markdown] [--output data/export]
+    python koboannotations.py daemon [start | sync | status | stop]
+
+Este módulo solo importa la biblioteca estándar: pandas, notion_client, dropbox, bs4
+o tqdm se importan dentro del subcomando que los usa, así que `--help` o las tareas
+programadas que no los necesitan arrancan en milisegundos
+(ver benchmarks/benchmark_import_time.py).
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+# Subcomandos que delegan sus argumentos en el main() de su módulo
+PASSTHROUGH_COMMANDS = ('transfer', 'koreader')
+
+
+def cmd_sync(args):
+    from main import run_sync
+    # Sin opciones se usa el presupuesto de la configuración (SYNC_MAX_MINUTES / SYNC_MAX_CALLS)
+    budget = {name: value for name, value in (("max_minutes", args.max_minutes), ("max_calls", args.max_calls))
+              if value is not None}
+    run_sync(force=args.force, **budget)
+
+
+def cmd_plan(args):
+    from main import plan_sync
+    plan_sync(db_path=args.db)
+
+
+def cmd_cleanup(args):
+    from notion_client import Client
+    from src.config import NOTION_API_TOKEN, NOTION_BOOKS_DATABASE_ID, NOTION_ANNOTATIONS_DATABASE_ID
+    from src import notion_cleanup
+
+    notion = Client(auth=NOTION_API_TOKEN)
+    if args.target == 'duplicados':
+        notion_cleanup.remove_duplicate_books(notion, NOTION_BOOKS_DATABASE_ID)
+    elif args.target == 'paginas':
+        notion_cleanup.clear_all_book_pages(notion, NOTION_BOOKS_DATABASE_ID, confirm=not args.yes)
+    else:
+        notion_cleanup.clean_all_notion_databases(notion, NOTION_BOOKS_DATABASE_ID, NOTION_ANNOTATIONS_DATABASE_ID,
+                                                  confirm=not args.yes)
+
+
+def cmd_transfer(args, extra):
+    from src.transfer_annotations import main as transfer_main
+    transfer_main(extra)
+
+
+def cmd_koreader(args, extra):
+    from src.koreader_sync import main as koreader_main
+    koreader_main(extra)
+
+
+def cmd_export(args):
+    from src.db_manager import SQLiteWrapper
+    from src.export import export_annotations
+
+    db = SQLiteWrapper(args.db)
+    db.connect()
+    anotaciones_df = db.get_annotations()
+    db.close()
+    output = args.output or (os.path.join("data", "export") if args.format == 'markdown'
+                             else os.path.join("data", f"anotaciones.{args.format}"))
+    exported = export_annotations(anotaciones_df, output, fmt=args.format, books=args.books)
+    print(f"✅ {exported} anotaciones exportadas a {output}")
+
+
+def send_daemon_command(command, port, timeout=10):
+    """Envía una orden al puerto de control del daemon y devuelve su respuesta (None si no está en marcha)."""
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=timeout) as connection:
+            connection.sendall(f"{command}\n".encode('utf-8'))
+            reply = connection.makefile('r', encoding='utf-8').readline()
+    except OSError:
+        return None
+    return json.loads(reply) if reply else None
+
+
+def cmd_daemon(args):
+    from src.config import DAEMON_PORT, DAEMON_INTERVAL_MINUTES
+    port = args.port if args.port is not None else DAEMON_PORT
+    if args.action == 'start':
+        from src.daemon import main as daemon_main
+        interval = args.interval if args.interval is not None else DAEMON_INTERVAL_MINUTES
+        return daemon_main(db_path=args.db, interval_minutes=interval, port=port)
+
+    reply = send_daemon_command(args.action, port)
+    if reply is None:
+        print(f"❌ No hay ningún daemon escuchando en 127.0.0.1:{port}")
+        return 1
+    print(json.dumps(reply, ensure_ascii=False, indent=2))
+    return 0 if reply.get("ok") else 1
+
+
+def build_parser():
+    default_db = os.path.join("data", "KoboReader.sqlite")
+    parser = argparse.ArgumentParser(prog="koboannotations",
+                                     description="Sincroniza las anotaciones de Kobo con Notion")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync = subparsers.add_parser("sync", help="Sincronizar Kobo con Notion (por defecto, incremental)")
+    sync.add_argument("--force", action="store_true", help="Ignorar la caché de etapas y ejecutarlo todo")
+    sync.add_argument("--max-minutes", type=float,
+                      help="Dejar para la siguiente ejecución lo que no quepa en estos minutos (lo más reciente primero)")
+    sync.add_argument("--max-calls", type=int,
+                      help="Dejar para la siguiente ejecución lo que no quepa en estas llamadas a Notion")
+    sync.set_defaults(handler=cmd_sync)
+
+    plan = subparsers.add_parser("plan", help="Mostrar qué etapas se ejecutarían, sin escribir nada")
+    plan.add_argument("--db", default=default_db, help="BBDD del Kobo")
+    plan.set_defaults(handler=cmd_plan)
+
+    cleanup = subparsers.add_parser("cleanup", help="Mantenimiento de las bases de datos de Notion")
+    cleanup.add_argument("target", choices=["duplicados", "paginas", "todo"], nargs="?", default="duplicados",
+                         help="duplicados: libros repetidos; paginas: contenido de las páginas; todo: vaciar ambas bases")
+    cleanup.add_argument("--yes", action="store_true", help="No pedir confirmación")
+    cleanup.set_defaults(handler=cmd_cleanup)
+
+    # Los argumentos (incluido --help) los procesa el propio módulo
+    transfer = subparsers.add_parser("transfer", add_help=False,
+                                     help="Transferir anotaciones entre BBDD de Kobo (--help para sus opciones)")
+    transfer.set_defaults(handler=cmd_transfer)
+    koreader = subparsers.add_parser("koreader", add_help=False,
+                                     help="Sincronización con KOReader por WebDAV (--help para sus opciones)")
+    koreader.set_defaults(handler=cmd_koreader)
+
+    export = subparsers.add_parser("export", help="Exportar las anotaciones del Kobo a ficheros")
+    export.add_argument("--format", choices=["markdown", "csv", "json"], default="markdown")
+    export.add_argument("--output", help="Carpeta (markdown) o fichero de salida")
+    export.add_argument("--db", default=default_db, help="BBDD del Kobo")
+    export.add_argument("--books", nargs="+", help="Títulos a exportar (por defecto todos)")
+    export.set_defaults(handler=cmd_export)
+
+    daemon = subparsers.add_parser("daemon", help="Proceso en segundo plano con cachés en memoria y puerto de control")
+    daemon.add_argument("action", choices=["start", "sync", "status", "stop"], nargs="?", default="start",
+                        help="start: arrancar el daemon; sync/status/stop: órdenes a un daemon en marcha")
+    daemon.add_argument("--interval", type=float, help="Minutos entre sincronizaciones programadas (0 = ninguna)")
+    daemon.add_argument("--port", type=int, help="Puerto de control en 127.0.0.1")
+    daemon.add_argument("--db", default=default_db, help="BBDD del Kobo que se vigila")
+    daemon.set_defaults(handler=cmd_daemon)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    if args.command in PASSTHROUGH_COMMANDS:
+        return args.handler(args, extra)
+    if extra:
+        parser.error(f"argumentos no reconocidos: {' '.join(extra)}")
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
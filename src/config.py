@@ -13,6 +13,48 @@ NOTION_ANNOTATIONS_DATABASE_ID = os.getenv('NOTION_ANNOTATIONS_DATABASE_ID')
 APP_KEY = os.getenv('APP_KEY')
 APP_SECRET = os.getenv('APP_SECRET')
 
+# Biblioteca de Calibre (carpeta con metadata.db); si se define, los metadatos se leen de ahí sin abrir EPUBs
+CALIBRE_LIBRARY_PATH = os.getenv('CALIBRE_LIBRARY_PATH')
+
+# Directorio local (o Kobo montado) con los EPUB; si se define se usa en lugar de Dropbox
+EPUB_LOCAL_DIR = os.getenv('EPUB_LOCAL_DIR')
+
+# Descargas simultáneas de Dropbox y límite de MB en vuelo
+DROPBOX_DOWNLOAD_WORKERS = int(os.getenv('DROPBOX_DOWNLOAD_WORKERS', '4'))
+DROPBOX_MAX_INFLIGHT_MB = int(os.getenv('DROPBOX_MAX_INFLIGHT_MB', '64'))
+
+# A partir de cuántos EPUB pendientes se descarga la carpeta completa como un único zip (0 = nunca)
+DROPBOX_BULK_THRESHOLD = int(os.getenv('DROPBOX_BULK_THRESHOLD', '50'))
+
+# Días que un libro sin EPUB en Dropbox se deja de buscar (si la carpeta no cambia)
+EPUB_MISS_TTL_DAYS = float(os.getenv('EPUB_MISS_TTL_DAYS', '7'))
+
+# Similitud mínima (0-1) para cruzar libros de forma aproximada cuando la clave canónica no coincide (vacío = desactivado)
+BOOK_FUZZY_THRESHOLD = float(os.getenv('BOOK_FUZZY_THRESHOLD') or 0) or None
+
+# Motor para process_data: 'pandas' (por defecto) o 'polars' (requiere instalar polars)
+PROCESS_DATA_BACKEND = os.getenv('PROCESS_DATA_BACKEND', 'pandas').lower()
+
+# Ejecutar en paralelo las etapas independientes de main.py (Kobo, Dropbox, lecturas de Notion)
+PIPELINE_PARALLEL = os.getenv('PIPELINE_PARALLEL', 'true').lower() not in ('0', 'false', 'no')
+
+# Carpeta donde se guardan las métricas de cada ejecución (JSON y formato Prometheus); vacío = desactivado
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join('data', 'metrics'))
+
+# Fichero JSONL con una línea por llamada a Notion y Dropbox (vacío = traza desactivada)
+TRACE_PATH = os.getenv('TRACE_PATH')
+
+# Presupuesto de cada sincronización (vacío = sin límite): al agotarse, lo pendiente se deja para la siguiente,
+# empezando siempre por los libros leídos más recientemente y las anotaciones más nuevas
+SYNC_MAX_MINUTES = float(os.getenv('SYNC_MAX_MINUTES') or 0) or None
+SYNC_MAX_CALLS = int(os.getenv('SYNC_MAX_CALLS') or 0) or None
+
+# Modo daemon: puerto local de control, minutos entre sincronizaciones programadas (0 = solo al cambiar
+# la BBDD del Kobo o a petición) y horas entre descargas completas de Notion
+DAEMON_PORT = int(os.getenv('DAEMON_PORT', '8765'))
+DAEMON_INTERVAL_MINUTES = float(os.getenv('DAEMON_INTERVAL_MINUTES', '60'))
+DAEMON_FULL_REFRESH_HOURS = float(os.getenv('DAEMON_FULL_REFRESH_HOURS', '6'))
+
 # SQLite Database Configuration
 SQLITE_PATH = os.getenv('SQLITE_PATH', 'KoboReader.sqlite')
 
@@ -0,0 +1,223 @@
+"""
+Modo daemon: un proceso que se queda en marcha y sincroniza Kobo con Notion sin pagar
+en cada ejecución el arranque del intérprete, las importaciones ni la descarga completa
+de Notion.
+
+Entre ejecuciones se mantienen en memoria:
+  - las páginas de la base de datos de libros y los Annotation_ID de la de anotaciones
+    (NotionSnapshot: solo se piden las páginas editadas desde la última vez y cada
+    DAEMON_FULL_REFRESH_HOURS se descargan enteras para ver las borradas);
+  - la caché de metadatos de EPUB abierta y el cliente de Dropbox / directorio local;
+  - la salida de cada etapa del pipeline (incluida la lectura del Kobo), para no leerla del disco.
+
+Las sincronizaciones usan el mismo cerrojo entre procesos que main.py (src/run_lock.py).
+Una sincronización se lanza cuando cambia la BBDD del Kobo (p. ej. la copia la sincronización
+de KOReader), cada DAEMON_INTERVAL_MINUTES o a petición por el puerto de control, que solo
+escucha en 127.0.0.1 y acepta una orden por línea (`sync`, `status`, `stop`) y responde con
+una línea JSON:
+
+    python koboannotations.py daemon            # arrancar
+    python koboannotations.py daemon sync       # sincronizar ahora
+    python koboannotations.py daemon status
+"""
+import json
+import os
+import socketserver
+import threading
+import time
+import traceback
+import main as sync
+from src.functions_notion import NotionSnapshot, get_annotation_id
+from src.metadata_cache import EpubMetadataCache
+from src.pipeline import file_fingerprint
+from src.tracing import enable_tracing, disable_tracing
+from src.config import (NOTION_BOOKS_DATABASE_ID, NOTION_ANNOTATIONS_DATABASE_ID, CALIBRE_LIBRARY_PATH,
+                        TRACE_PATH, DAEMON_PORT, DAEMON_INTERVAL_MINUTES, DAEMON_FULL_REFRESH_HOURS)
+
+# Segundos entre comprobaciones de la BBDD del Kobo
+WATCH_INTERVAL = 2
+
+
+class SyncState:
+    """Estado que el daemon reutiliza entre sincronizaciones (ver main.build_pipeline)."""
+
+    def __init__(self, full_refresh_hours=DAEMON_FULL_REFRESH_HOURS):
+        full_refresh_seconds = full_refresh_hours * 3600
+        self.notion = sync.create_notion_client()
+        self.books = NotionSnapshot(self.notion, NOTION_BOOKS_DATABASE_ID,
+                                    full_refresh_seconds=full_refresh_seconds)
+        self.annotations = NotionSnapshot(self.notion, NOTION_ANNOTATIONS_DATABASE_ID, transform=get_annotation_id,
+                                          full_refresh_seconds=full_refresh_seconds)
+        self.book_source = None if CALIBRE_LIBRARY_PATH else sync.get_book_source()
+        self.epub_cache = None if CALIBRE_LIBRARY_PATH else EpubMetadataCache(sync.EPUB_CACHE_PATH)
+        self.memory = {}
+
+    def invalidate(self):
+        """Descarta lo que hay en memoria (p. ej. tras un error): la siguiente ejecución lo relee todo."""
+        self.books.invalidate()
+        self.annotations.invalidate()
+        self.memory.clear()
+
+    def summary(self):
+        return {"libros_notion": len(self.books), "anotaciones_notion": len(self.annotations),
+                "epubs": len(self.epub_cache) if self.epub_cache is not None else None,
+                "etapas_en_memoria": sorted(self.memory)}
+
+    def close(self):
+        if self.epub_cache is not None:
+            self.epub_cache.close()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Una orden por conexión: se lee una línea y se responde con una línea JSON."""
+
+    def handle(self):
+        command = self.rfile.readline(1024).decode('utf-8', errors='replace').strip().lower()
+        reply = self.server.sync_daemon.handle_command(command)
+        self.wfile.write((json.dumps(reply, ensure_ascii=False, default=str) + "\n").encode('utf-8'))
+
+
+class ControlServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, sync_daemon, port):
+        self.sync_daemon = sync_daemon
+        super().__init__(("127.0.0.1", port), ControlHandler)
+
+
+class SyncDaemon:
+    """
+    Bucle del daemon. Las sincronizaciones se ejecutan de una en una en el hilo principal;
+    las peticiones que llegan durante una sincronización se agrupan en una sola posterior.
+
+    Args:
+        db_path: BBDD del Kobo que se vigila.
+        interval_minutes: Minutos entre sincronizaciones programadas (0 = ninguna).
+        port: Puerto de control en 127.0.0.1 (0 = sin puerto de control).
+    """
+
+    def __init__(self, db_path=sync.KOBO_DB_PATH, interval_minutes=DAEMON_INTERVAL_MINUTES, port=DAEMON_PORT):
+        self.db_path = db_path
+        self.interval = interval_minutes * 60
+        self.port = port
+        self.state = None
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.status = {"estado": "arrancando", "inicio": time.time(), "ejecuciones": 0, "ultima": None,
+                       "siguiente_programada": None}
+
+    def request_sync(self, reason):
+        with self.lock:
+            if reason not in self.pending:
+                self.pending.append(reason)
+        self.wake.set()
+
+    def handle_command(self, command):
+        if command == "sync":
+            self.request_sync("petición")
+            return {"ok": True, "mensaje": "sincronización en cola"}
+        if command == "status":
+            with self.lock:
+                status = {**self.status, "pendientes": list(self.pending)}
+            if self.state is not None:
+                status["memoria"] = self.state.summary()
+            return {"ok": True, **status}
+        if command == "stop":
+            self.stop()
+            return {"ok": True, "mensaje": "deteniendo el daemon"}
+        return {"ok": False, "error": f"orden desconocida: {command!r} (usa sync, status o stop)"}
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+    def run_cycle(self, reasons):
+        print(f"\n🔔 Sincronización por: {', '.join(reasons)}")
+        with self.lock:
+            self.status["estado"] = "sincronizando"
+        start = time.time()
+        result = {"motivo": reasons, "inicio": start}
+        try:
+            runs = sync.run_sync(state=self.state, db_path=self.db_path)
+            # Con otra sincronización en marcha (p. ej. una manual) esa hará la nuestra al terminar
+            result["estado"] = "ok" if runs else "en cola en otro proceso"
+        except Exception as e:
+            traceback.print_exc()
+            result.update(estado="error", error=f"{type(e).__name__}: {e}")
+            # Tras un fallo no se confía en lo que quedó en memoria
+            self.state.invalidate()
+        result["segundos"] = round(time.time() - start, 3)
+        with self.lock:
+            self.status.update(estado="esperando", ultima=result, ejecuciones=self.status["ejecuciones"] + 1)
+
+    def run(self):
+        """Arranca el daemon y bloquea hasta recibir `stop` o Ctrl+C."""
+        if TRACE_PATH:
+            enable_tracing(TRACE_PATH)
+            print(f"🔎 Traza de llamadas a la API en {TRACE_PATH}")
+        self.state = SyncState()
+        server = None
+        if self.port:
+            server = ControlServer(self, self.port)
+            threading.Thread(target=server.serve_forever, name="daemon-control", daemon=True).start()
+
+        print(f"""
+    🤖 DAEMON DE SINCRONIZACIÓN ACTIVO
+
+    - BBDD vigilada: {self.db_path}
+    - Programada: {f'cada {self.interval / 60:g} min' if self.interval else 'no'}
+    - Control: {f'127.0.0.1:{self.port} (sync, status, stop)' if server else 'desactivado'}
+
+    📝 Para parar: Ctrl+C o `python koboannotations.py daemon stop`
+    """)
+
+        fingerprint = file_fingerprint(self.db_path)
+        changed = None
+        next_run = time.time() + self.interval if self.interval else None
+        self.request_sync("arranque")
+        try:
+            while not self.stopping.is_set():
+                with self.lock:
+                    self.status["siguiente_programada"] = next_run
+                self.wake.wait(timeout=WATCH_INTERVAL)
+                self.wake.clear()
+                if self.stopping.is_set():
+                    break
+
+                # La BBDD se copia entera (p. ej. desde KOReader): se espera a que deje de cambiar
+                current = file_fingerprint(self.db_path)
+                if current != fingerprint:
+                    fingerprint, changed = current, current
+                elif changed is not None and current == changed:
+                    self.request_sync("cambio en el Kobo")
+                    changed = None
+                if next_run is not None and time.time() >= next_run:
+                    self.request_sync("programada")
+
+                with self.lock:
+                    reasons, self.pending = self.pending, []
+                if reasons:
+                    self.run_cycle(reasons)
+                    if next_run is not None:
+                        next_run = time.time() + self.interval
+        except KeyboardInterrupt:
+            print("\n🛑 Daemon detenido por el usuario")
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            self.state.close()
+            disable_tracing()
+        print("👋 Daemon detenido")
+
+
+def main(db_path=sync.KOBO_DB_PATH, interval_minutes=DAEMON_INTERVAL_MINUTES, port=DAEMON_PORT):
+    os.makedirs("data", exist_ok=True)
+    SyncDaemon(db_path, interval_minutes=interval_minutes, port=port).run()
+
+
+if __name__ == "__main__":
+    main()
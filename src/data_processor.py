@@ -1,38 +1,180 @@
 import pandas as pd
+from src.book_keys import (add_book_key, match_book_keys, book_key_expr, base_key_expr, BlockedFuzzyMatcher,
+                           SUBTITLE_SEPARATOR)
+from src.config import BOOK_FUZZY_THRESHOLD, PROCESS_DATA_BACKEND
 
-def process_data(anotaciones_df, libros_ereader_df, epub_metadata):
+# Columnas de los metadatos de EPUB que usa process_data (las únicas que hace falta leer de la caché)
+EPUB_METADATA_COLUMNS = ['title', 'author', 'language', 'subjects', 'pages', 'publication_date']
+
+def clean_generos(generos):
+    if isinstance(generos, list) and len(generos) == 1 and isinstance(generos[0], str):
+        return generos[0].split(", ")
+    return generos
+
+def prepare_epub_metadata(epub_metadata):
+    """Columnas de los metadatos de EPUB que se añaden a cada libro (una fila por clave canónica)."""
+    return add_book_key(epub_metadata, 'title', 'author')\
+        .rename(columns = {"subjects": "generos", "pages": "paginas", "publication_date": "fecha_publicacion"})\
+        .assign(generos = lambda x: x.generos.apply(clean_generos))\
+        [['book_key', 'generos', 'paginas', 'fecha_publicacion']]\
+        .drop_duplicates('book_key')
+
+def process_data(anotaciones_df, libros_ereader_df, epub_metadata, fuzzy_threshold=BOOK_FUZZY_THRESHOLD,
+                 backend=PROCESS_DATA_BACKEND):
     """
     Procesa y enriquece los datos de libros y anotaciones.
+
+    Los cruces se hacen por la clave canónica del libro (columna 'book_key'), así que
+    diferencias de tildes, mayúsculas o puntuación no impiden el cruce.
+    Con fuzzy_threshold, las claves sin pareja exacta se cruzan de forma aproximada.
+
+    Args:
+        backend: 'pandas' (por defecto) o 'polars', que calcula las claves, las limpia,
+            agrega y cruza en un plan lazy multihilo y devuelve el mismo DataFrame de pandas
+            (equivalencia: benchmarks/check_process_data_backends.py).
     """
     print("\n🔧 Procesando y enriqueciendo datos...")
-    
+
+    libros_df = None
+    if backend == 'polars':
+        try:
+            libros_df = join_books_polars(anotaciones_df, libros_ereader_df, epub_metadata, fuzzy_threshold)
+        except ImportError:
+            print("⚠️ polars no está instalado, se usa pandas.")
+    if libros_df is None:
+        libros_df = join_books_pandas(anotaciones_df, libros_ereader_df, epub_metadata, fuzzy_threshold)
+
+    # Mismos tipos sea cual sea el motor y aunque todos los libros tengan anotaciones
+    libros_df = libros_df.assign(book_key = lambda x: x.book_key.astype(object),
+                                 num_anotaciones = lambda x: x.num_anotaciones.astype(float))
+    print("✅ Datos procesados.")
+    return libros_df
+
+def join_books_pandas(anotaciones_df, libros_ereader_df, epub_metadata, fuzzy_threshold):
+    anotaciones_df = add_book_key(anotaciones_df, 'Título', 'Autor')
+    libros_ereader_df = add_book_key(libros_ereader_df)
+    libros_dropbox = prepare_epub_metadata(epub_metadata)
+    matches = match_book_keys(libros_ereader_df['book_key'], libros_dropbox['book_key'], fuzzy_threshold)
+
     libros_anotaciones_df = anotaciones_df\
-        [['Autor', 'Título','Fecha de creación']]\
+        [['book_key', 'Fecha de creación']]\
         .assign(num_anotaciones = 1)\
-        .groupby(['Autor', 'Título'])\
+        .groupby('book_key', observed = True)\
         .agg({"Fecha de creación": ["min", "max"], "num_anotaciones": "sum"})\
         .reset_index()\
-        .set_axis(['autor', 'titulo', 'fecha_primera_nota', 'fecha_ultima_nota', 'num_anotaciones'], axis = 1)
-
-    def clean_generos(generos):
-        if isinstance(generos, list) and len(generos) == 1 and isinstance(generos[0], str):
-            return generos[0].split(", ")
-        return generos
-
-    libros_dropbox = epub_metadata\
-        .rename(columns = {"title": "titulo",
-                           "author": "autor", "subjects": "generos", "pages": "paginas",
-                           "publication_date": "fecha_publicacion"})\
-        .assign(idioma = lambda x: x.language.str.extract("(es|en)").fillna("en"))\
-        .assign(idioma = lambda x: x.idioma.map({"es": "Español", "en": "Inglés"}))\
-        .assign(generos = lambda x: x.generos.apply(clean_generos))\
-        [['autor', 'titulo', 'generos', 'paginas', 'fecha_publicacion']]
+        .set_axis(['book_key', 'fecha_primera_nota', 'fecha_ultima_nota', 'num_anotaciones'], axis = 1)
 
-    libros_df = libros_ereader_df\
-        .merge(libros_anotaciones_df, how = "left")\
-        .merge(libros_dropbox, on = ["autor", "titulo"], how = "left")\
+    return libros_ereader_df\
+        .merge(libros_anotaciones_df, on = "book_key", how = "left")\
+        .assign(epub_key = lambda x: x.book_key.map(matches))\
+        .merge(libros_dropbox.rename(columns = {"book_key": "epub_key"}), on = "epub_key", how = "left")\
+        .drop(columns = "epub_key")\
+        .loc[lambda x: x.autor.notna()]\
+        .assign(num_anotaciones = lambda x: x.num_anotaciones.fillna(0))
+
+def match_book_keys_polars(claves, conocidas, fuzzy_threshold):
+    """
+    match_book_keys sobre LazyFrames (columnas 'book_key' y 'epub_key'): coincidencia exacta
+    y por clave sin subtítulo (mismas condiciones) como cruces del plan; el cruce aproximado
+    (Python) solo recibe las claves que quedan sin pareja.
+    """
+    import polars as pl
+
+    claves = claves.unique().with_columns(base = base_key_expr('book_key'))
+    conocidas = conocidas.unique().with_columns(base = base_key_expr('epub_key'))
+    exactas = claves.join(conocidas, left_on = 'book_key', right_on = 'epub_key', how = 'inner')\
+        .select('book_key', epub_key = pl.col('book_key'))
+    bases_unicas = claves.group_by('base').agg(pl.len().alias('n')).filter(pl.col('n') == 1).select('base')
+    conocidas_unicas = conocidas.group_by('base').agg(pl.col('epub_key').first(), pl.len().alias('n'))\
+        .filter(pl.col('n') == 1).select('base', 'epub_key')
+    por_base = claves.join(exactas, on = 'book_key', how = 'anti')\
+        .join(bases_unicas, on = 'base', how = 'semi')\
+        .join(conocidas_unicas, on = 'base', how = 'inner')\
+        .filter(~pl.col('book_key').str.contains(SUBTITLE_SEPARATOR, literal = True) |
+                ~pl.col('epub_key').str.contains(SUBTITLE_SEPARATOR, literal = True))\
+        .select('book_key', 'epub_key')
+    matches = pl.concat([exactas, por_base])
+    if not fuzzy_threshold:
+        return matches
+
+    matches = matches.collect()
+    sin_pareja = claves.join(matches.lazy(), on = 'book_key', how = 'anti').select('book_key').collect()
+    if not len(sin_pareja):
+        return matches.lazy()
+    matcher = BlockedFuzzyMatcher(conocidas.select('epub_key').collect()['epub_key'].to_list(),
+                                  threshold = fuzzy_threshold)
+    aproximadas = [(key, matcher.match(key)) for key in sin_pareja['book_key'].to_list()]
+    aproximadas = pl.DataFrame([pair for pair in aproximadas if pair[1] is not None],
+                               schema = {'book_key': pl.String, 'epub_key': pl.String}, orient = 'row')
+    return pl.concat([matches, aproximadas]).lazy()
+
+def join_books_polars(anotaciones_df, libros_ereader_df, epub_metadata, fuzzy_threshold):
+    """
+    Mismo resultado que join_books_pandas con un plan lazy de polars: las claves canónicas
+    (si no vienen ya calculadas), la limpieza de géneros, la agregación de las anotaciones
+    y los cruces se ejecutan en paralelo y sin copias intermedias. Los valores que se copian
+    tal cual de los metadatos (páginas, fecha) viajan como un índice de fila y se recuperan
+    de pandas al final, así el esquema de salida es idéntico.
+    """
+    import polars as pl
+
+    def to_polars(df, columns):
+        # Las categóricas se pasan como texto: los cruces entre categorías distintas no son fiables
+        df = df[columns]
+        return pl.from_pandas(df.astype({c: object for c in columns if isinstance(df[c].dtype, pd.CategoricalDtype)}))\
+            .lazy()
+
+    def with_book_key(df, title_col, author_col, key_col = 'book_key', columns = ()):
+        # Como add_book_key: si la clave ya está calculada (p. ej. la etapa kobo) no se recalcula
+        if 'book_key' in df.columns:
+            return to_polars(df, ['book_key', *columns]).rename({'book_key': key_col})
+        # Una vez por pareja (título, autor) distinta, como add_book_key
+        filas = to_polars(df, [title_col, author_col, *columns])
+        parejas = filas.select(title_col, author_col).unique()\
+            .with_columns(book_key_expr(title_col, author_col).alias(key_col))
+        return filas.join(parejas, on = [title_col, author_col], how = 'left', nulls_equal = True,
+                          maintain_order = 'left').select(key_col, *columns)
+
+    anotaciones = with_book_key(anotaciones_df, 'Título', 'Autor', columns = ['Fecha de creación'])\
+        .group_by('book_key')\
+        .agg(fecha_primera_nota = pl.col('Fecha de creación').min(),
+             fecha_ultima_nota = pl.col('Fecha de creación').max(),
+             num_anotaciones = pl.len().cast(pl.Float64))
+
+    libros = with_book_key(libros_ereader_df, 'titulo', 'autor').with_row_index('ereader_row')
+
+    # prepare_epub_metadata: una fila por clave (la primera) con los géneros limpios (clean_generos)
+    generos = pl.Series('generos', epub_metadata['subjects'].tolist(), dtype = pl.List(pl.String), strict = False)
+    un_genero = (pl.col('generos').list.len() == 1) & pl.col('generos').list.first().is_not_null()
+    epub = with_book_key(epub_metadata, 'title', 'author', 'epub_key')\
+        .with_columns(generos)\
+        .with_row_index('epub_row')\
+        .unique('epub_key', keep = 'first', maintain_order = True)\
+        .with_columns(generos = pl.when(un_genero).then(pl.col('generos').list.first().str.split(', '))
+                      .otherwise(pl.col('generos')))
+
+    claves = match_book_keys_polars(libros.select('book_key'), epub.select('epub_key'), fuzzy_threshold)
+
+    resultado = libros\
+        .join(anotaciones, on = 'book_key', how = 'left')\
+        .join(claves, on = 'book_key', how = 'left')\
+        .join(epub, on = 'epub_key', how = 'left')\
+        .sort('ereader_row')\
+        .collect()
+
+    libros_df = libros_ereader_df.iloc[resultado['ereader_row'].to_numpy()].reset_index(drop = True)
+    if 'book_key' not in libros_df.columns:
+        libros_df['book_key'] = resultado['book_key'].to_list()
+    for column in ['fecha_primera_nota', 'fecha_ultima_nota', 'num_anotaciones']:
+        libros_df[column] = resultado[column].to_pandas()
+    epub_row = resultado['epub_row'].to_pandas()
+    # Valores que no eran listas (sin géneros) se copian tal cual, como en pandas
+    originales = epub_metadata['subjects'].reset_index(drop = True).reindex(epub_row)
+    libros_df['generos'] = pd.Series([generos if generos is not None else original for generos, original
+                                      in zip(resultado['generos'].to_list(), originales)], dtype = object)
+    for column, source in [('paginas', 'pages'), ('fecha_publicacion', 'publication_date')]:
+        libros_df[column] = epub_metadata[source].reset_index(drop = True).reindex(epub_row).set_axis(libros_df.index)
+
+    return libros_df\
         .loc[lambda x: x.autor.notna()]\
         .assign(num_anotaciones = lambda x: x.num_anotaciones.fillna(0))
-        
-    print("✅ Datos procesados.")
-    return libros_df
@@ -1,16 +1,24 @@
 import sqlite3
 import pandas as pd
-import time 
+from src.metrics import timed, count
+
+# Columnas de texto muy repetidas que se guardan como categóricas (cada fila solo guarda un código)
+ANNOTATION_CATEGORY_COLUMNS = ['Autor', 'Título', 'Capítulo', 'Tipo']
+
+# Estados de lectura del Kobo (ReadStatus 0, 1, 2)
+ESTADOS = ["Sin empezar", "En progreso", "Leído"]
 
 class SQLiteWrapper:
-    def __init__(self, db_path):
+    def __init__(self, db_path, name="kobo"):
         """
         Inicializa la conexión a la base de datos SQLite.
         
         Args:
             db_path (str): Ruta al archivo SQLite.
+            name (str): Nombre de la base de datos en las métricas ('kobo', 'calibre'...).
         """
         self.db_path = db_path
+        self.name = name
         self.connection = None
 
     def connect(self):
@@ -37,7 +45,10 @@ class SQLiteWrapper:
 
         try:
             # Ejecutar la consulta y devolver un DataFrame
-            return pd.read_sql_query(query, self.connection, params=params)
+            with timed("sqlite_query", db=self.name):
+                df = pd.read_sql_query(query, self.connection, params=params)
+            count("sqlite_rows", len(df), db=self.name)
+            return df
         except Exception as e:
             print(f"Error ejecutando la consulta: {e}")
             raise
@@ -153,7 +164,8 @@ class SQLiteWrapper:
             )\
         .sort_values(["Título", "Autor", "Progreso del libro", "last_point"])\
         [['Autor', 'Título', 'Capítulo', 'Progreso del libro',
-            'Texto', 'Anotación', 'Tipo', 'Fecha de creación']]
+            'Texto', 'Anotación', 'Tipo', 'Fecha de creación']]\
+        .astype({column: 'category' for column in ANNOTATION_CATEGORY_COLUMNS})
         
     	# El filtro de point.notna() es para quedarnos solo con las notas de los epubs, ya que las de los kepubs son distintas
         # Si se quiere guardar las de los kepubs habría que hacer un tratamiento aparte
@@ -161,24 +173,30 @@ class SQLiteWrapper:
         return anotaciones_df
 
     def get_books(self):
+        # Todas las transformaciones se hacen en SQLite: estado, idioma y tiempo de lectura
+        # llegan ya calculados y los libros sin empezar ni siquiera salen de la base de datos
+        # (los de ReadStatus NULL se conservan, con estado vacío, como hacía el filtro en pandas)
         QUERY_BOOKS = """
-            SELECT Title, Attribution, Description, ___SyncTime, DateCreated, DateLastRead, 
-            NumShortcovers, ReadStatus, ___PercentRead, Language, ReadStateSynced, TimeSpentReading 
+            SELECT
+                Attribution AS autor,
+                Title AS titulo,
+                CASE
+                    WHEN instr(Language, 'es') > 0
+                         AND (instr(Language, 'en') = 0 OR instr(Language, 'es') < instr(Language, 'en'))
+                    THEN 'Español'
+                    ELSE 'Inglés'
+                END AS idioma,
+                CASE ReadStatus WHEN 1 THEN 'En progreso' WHEN 2 THEN 'Leído' END AS estado,
+                printf('%02d:%02d:%02d', (COALESCE(TimeSpentReading, 0) / 3600) % 24,
+                       (COALESCE(TimeSpentReading, 0) % 3600) / 60, COALESCE(TimeSpentReading, 0) % 60) AS tiempo_lectura,
+                DateLastRead AS fecha_ultima_lectura
             FROM content
             WHERE ContentType = "6" AND EpubType = -1 AND ContentID LIKE 'file%'
+                AND (ReadStatus IS NULL OR ReadStatus != 0)
         """
 
         libros_df = self.get_query_df(QUERY_BOOKS)\
-            .assign(estado = lambda x: x.ReadStatus.map({0: "Sin empezar", 1: "En progreso", 2: "Leído"}))\
-            .assign(tiempo_lectura = lambda x: x.TimeSpentReading.apply(lambda y: time.strftime('%H:%M:%S', time.gmtime(y))))\
-            .rename(columns = {'Language': 'idioma', 'Title': 'titulo', 'Attribution': 'autor',
-                            'DateLastRead': 'fecha_ultima_lectura'})\
-            [['autor', 'titulo', 'idioma', 'estado', 'tiempo_lectura', 'fecha_ultima_lectura']]\
-            .assign(idioma = lambda x: x.idioma.str.extract("(es|en)").fillna("en"))\
-            .assign(idioma = lambda x: x.idioma.map({"es": "Español", "en": "Inglés"}))
-        
-        libros_df = libros_df\
-            .loc[lambda x: x.estado != "Sin Comenzar"]
+            .astype({'estado': pd.CategoricalDtype(ESTADOS), 'idioma': 'category'})
         return libros_df
 
     def close(self):
@@ -0,0 +1,71 @@
+"""
+Exportación de las anotaciones del Kobo a ficheros (sin pasar por Notion).
+
+Formatos:
+  - csv / json: una fila por anotación, con las columnas de SQLiteWrapper.get_annotations.
+  - markdown: un fichero por libro, con las anotaciones agrupadas por capítulo.
+"""
+import json
+import os
+import re
+import pandas as pd
+
+EXPORT_FORMATS = ('csv', 'json', 'markdown')
+
+
+def safe_filename(name):
+    """Nombre de fichero válido en Windows y Linux a partir de un título."""
+    return re.sub(r'[\\/:*?"<>|]+', ' ', str(name)).strip()[:120] or "sin_titulo"
+
+
+def annotations_to_markdown(group):
+    """Markdown de las anotaciones de un libro, ordenadas por progreso y agrupadas por capítulo."""
+    group = group.sort_values('Progreso del libro', kind='stable')
+    lines = [f"# {group['Título'].iloc[0]}", f"*{group['Autor'].iloc[0]}*", ""]
+    current_chapter = None
+    for capitulo, texto, anotacion in zip(group['Capítulo'], group['Texto'], group['Anotación']):
+        if capitulo != current_chapter:
+            lines += [f"## {capitulo}", ""]
+            current_chapter = capitulo
+        if pd.notna(texto) and str(texto).strip():
+            lines += [f"> {line}" for line in str(texto).strip().splitlines()] + [""]
+        if pd.notna(anotacion) and str(anotacion).strip():
+            lines += [f"📝 {str(anotacion).strip()}", ""]
+    return "\n".join(lines)
+
+
+def export_annotations(anotaciones_df, output, fmt='markdown', books=None):
+    """
+    Exporta las anotaciones.
+
+    Args:
+        anotaciones_df: DataFrame de SQLiteWrapper.get_annotations.
+        output: Fichero de salida (csv/json) o carpeta (markdown).
+        fmt: 'csv', 'json' o 'markdown'.
+        books: Títulos a exportar (por defecto todos).
+
+    Returns:
+        int: Número de anotaciones exportadas.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato no soportado: {fmt} (usa {', '.join(EXPORT_FORMATS)})")
+    df = anotaciones_df
+    if books:
+        df = df[df['Título'].isin(books)]
+
+    if fmt == 'markdown':
+        os.makedirs(output, exist_ok=True)
+        for titulo, group in df.groupby('Título', sort=False, observed=True):
+            path = os.path.join(output, f"{safe_filename(titulo)}.md")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(annotations_to_markdown(group))
+    else:
+        directory = os.path.dirname(os.path.abspath(output))
+        os.makedirs(directory, exist_ok=True)
+        plain = df.astype({column: 'object' for column in df.select_dtypes('category').columns})
+        if fmt == 'csv':
+            plain.to_csv(output, index=False, encoding='utf-8-sig')
+        else:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump(plain.to_dict('records'), f, ensure_ascii=False, indent=2, default=str)
+    return len(df)
@@ -0,0 +1,86 @@
+"""
+Metadatos de libros leídos directamente de una biblioteca de Calibre (metadata.db).
+
+Calibre ya guarda título, autores, etiquetas, idiomas, fecha de publicación y columnas
+personalizadas como #pages para toda la biblioteca, así que basta una consulta SQLite
+para obtener lo mismo que se extrae abriendo cada EPUB.
+"""
+import os
+from src.db_manager import SQLiteWrapper
+from src.functions_epub import parse_dates
+
+# Separador para group_concat que no aparece en nombres de etiquetas
+SEPARATOR = chr(31)
+
+# Calibre guarda los idiomas como ISO 639-2 (3 letras); process_data espera 'es'/'en'
+LANGUAGE_CODES = {
+    'spa': 'es', 'eng': 'en', 'fra': 'fr', 'fre': 'fr', 'deu': 'de', 'ger': 'de',
+    'ita': 'it', 'por': 'pt', 'cat': 'ca', 'glg': 'gl', 'eus': 'eu', 'baq': 'eu',
+}
+
+
+def get_pages_column_table(db, pages_column):
+    """Devuelve la tabla de la columna personalizada (p. ej. '#pages') o None si no existe."""
+    label = pages_column.lstrip('#')
+    columns = db.get_query_df("SELECT id FROM custom_columns WHERE label = ?", params=(label,))
+    if columns.empty:
+        return None
+    return f"custom_column_{int(columns['id'].iloc[0])}"
+
+
+def get_calibre_metadata(library_path, pages_column='#pages'):
+    """
+    Lee los metadatos de todos los libros de una biblioteca de Calibre en una sola consulta.
+
+    Args:
+        library_path: Carpeta de la biblioteca (la que contiene metadata.db) o ruta al propio fichero.
+        pages_column: Columna personalizada con el número de páginas.
+
+    Returns:
+        DataFrame con las mismas columnas que la caché de metadatos de EPUB
+        ('title', 'author', 'language', 'subjects', 'pages', 'publication_date'...).
+    """
+    db_path = library_path
+    if os.path.isdir(library_path):
+        db_path = os.path.join(library_path, 'metadata.db')
+    print(f"\n📚 Leyendo metadatos de Calibre ({db_path})...")
+
+    db = SQLiteWrapper(db_path, name="calibre")
+    db.connect()
+    try:
+        pages_table = get_pages_column_table(db, pages_column)
+        pages_select = f"(SELECT value FROM {pages_table} WHERE book = b.id)" if pages_table else "NULL"
+
+        query = f"""
+            SELECT
+                b.id AS calibre_id,
+                b.title AS title,
+                (SELECT a.name FROM books_authors_link bal JOIN authors a ON a.id = bal.author
+                 WHERE bal.book = b.id ORDER BY bal.id LIMIT 1) AS author,
+                (SELECT p.name FROM books_publishers_link bpl JOIN publishers p ON p.id = bpl.publisher
+                 WHERE bpl.book = b.id LIMIT 1) AS publisher,
+                (SELECT l.lang_code FROM books_languages_link bll JOIN languages l ON l.id = bll.lang_code
+                 WHERE bll.book = b.id ORDER BY bll.item_order LIMIT 1) AS language,
+                (SELECT c.text FROM comments c WHERE c.book = b.id) AS description,
+                (SELECT group_concat(t.name, '{SEPARATOR}') FROM books_tags_link btl JOIN tags t ON t.id = btl.tag
+                 WHERE btl.book = b.id) AS subjects,
+                b.pubdate AS publication_date,
+                {pages_select} AS pages,
+                b.path AS path,
+                (SELECT d.name FROM data d WHERE d.book = b.id AND d.format = 'EPUB') AS filename
+            FROM books b
+        """
+        metadata_df = db.get_query_df(query)
+    finally:
+        db.close()
+
+    metadata_df = metadata_df\
+        .assign(language=lambda x: x.language.map(lambda code: LANGUAGE_CODES.get(code, code)))\
+        .assign(subjects=lambda x: x.subjects.map(lambda s: sorted(s.split(SEPARATOR)) if isinstance(s, str) else []))\
+        .assign(publication_date=lambda x: x.publication_date.map(
+            # Calibre usa el año 101 como "fecha desconocida"
+            lambda d: parse_dates(d) if isinstance(d, str) and not d.startswith('0101') else None))\
+        .assign(filename=lambda x: x.filename.map(lambda n: f"{n}.epub" if isinstance(n, str) else None))
+
+    print(f"✅ {len(metadata_df)} libros leídos de Calibre.")
+    return metadata_df
@@ -1,11 +1,28 @@
 import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import dropbox
 import json
 import os
 import pandas as pd
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from src.functions_epub import EpubProcessor
-from src.config import APP_KEY, APP_SECRET, TOKEN_FILE
+from src.remote_file import DropboxRangeFile, DROPBOX_DOWNLOAD_URL, DROPBOX_DOWNLOAD_ZIP_URL, iter_zip_stream
+from src.book_sources import BookSource
+from src.book_keys import add_book_key, match_book_keys, base_title_key
+from src.metrics import instrument_client, timed, count
+from src.tracing import trace_client, trace_request, in_trace_context
+from src.metadata_cache import (EpubMetadataCache, MissingEpubCache, listing_fingerprint, atomic_write_bytes,
+                                compute_content_hash_bytes)
+from src.config import (APP_KEY, APP_SECRET, TOKEN_FILE, EPUB_MISS_TTL_DAYS,
+                        DROPBOX_DOWNLOAD_WORKERS, DROPBOX_MAX_INFLIGHT_MB, DROPBOX_BULK_THRESHOLD,
+                        BOOK_FUZZY_THRESHOLD)
+
+DROPBOX_TOKEN_URL = "https://api.dropbox.com/oauth2/token"
+# Segundos antes de la caducidad en los que el token ya se renueva (que no caduque a mitad de una descarga)
+TOKEN_REFRESH_MARGIN = 60
 
 def authenticate(APP_KEY, APP_SECRET, TOKEN_FILE):
     """Autentica al usuario la primera vez y guarda el token."""
@@ -18,7 +35,7 @@ def authenticate(APP_KEY, APP_SECRET, TOKEN_FILE):
 
     # Intercambiar el código por un token de acceso y refresco
     response = requests.post(
-        "https://api.dropbox.com/oauth2/token",
+        DROPBOX_TOKEN_URL,
         data={
             "code": auth_code,
             "grant_type": "authorization_code",
@@ -49,19 +66,19 @@ def load_tokens(TOKEN_FILE):
     else:
         return None
 
-def refresh_token(APP_KEY, APP_SECRET, TOKEN_FILE):
-    """Renueva el token de acceso si ha expirado."""
+def refresh_token(APP_KEY, APP_SECRET, TOKEN_FILE, margin=TOKEN_REFRESH_MARGIN, token_url=DROPBOX_TOKEN_URL):
+    """Renueva el token de acceso si ha expirado o le quedan menos de `margin` segundos."""
     tokens = load_tokens(TOKEN_FILE)
     if not tokens:
         raise Exception("No hay tokens almacenados. Por favor, autentícate primero.")
 
-    if tokens["expires_at"] > time.time():
+    if tokens["expires_at"] - margin > time.time():
         # El token aún es válido
         return tokens["access_token"]
 
-    # El token ha expirado, renueva usando el refresh_token
+    # El token ha expirado (o está a punto), renueva usando el refresh_token
     response = requests.post(
-        "https://api.dropbox.com/oauth2/token",
+        token_url,
         data={
             "grant_type": "refresh_token",
             "refresh_token": tokens["refresh_token"],
@@ -79,53 +96,298 @@ def refresh_token(APP_KEY, APP_SECRET, TOKEN_FILE):
     else:
         raise Exception("Error al renovar el token: ", response.json())
 
-def get_access_token(APP_KEY, APP_SECRET, TOKEN_FILE):
+def get_access_token(APP_KEY, APP_SECRET, TOKEN_FILE, margin=TOKEN_REFRESH_MARGIN, token_url=DROPBOX_TOKEN_URL):
     """Obtiene un token de acceso válido, renovándolo si es necesario."""
     tokens = load_tokens(TOKEN_FILE)
     if not tokens:
         print("No se encontraron tokens. Autenticando por primera vez...")
         authenticate(APP_KEY, APP_SECRET, TOKEN_FILE)
         tokens = load_tokens(TOKEN_FILE)
-    return refresh_token(APP_KEY, APP_SECRET, TOKEN_FILE)
+    return refresh_token(APP_KEY, APP_SECRET, TOKEN_FILE, margin=margin, token_url=token_url)
+
+class DropboxClient:
+    """
+    Cliente de Dropbox compartible entre hilos.
+
+    El token se obtiene (y renueva) una sola vez bajo un lock, en lugar de leer
+    dropbox_token.json en cada llamada, y todas las peticiones reutilizan un único
+    pool de conexiones HTTP.
+    """
+
+    def __init__(self, app_key=APP_KEY, app_secret=APP_SECRET, token_file=TOKEN_FILE,
+                 pool_size=DROPBOX_DOWNLOAD_WORKERS, download_url=DROPBOX_DOWNLOAD_URL,
+                 download_zip_url=DROPBOX_DOWNLOAD_ZIP_URL, token_url=DROPBOX_TOKEN_URL):
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.token_file = token_file
+        self.download_url = download_url
+        self.download_zip_url = download_zip_url
+        self.token_url = token_url
+        self.access_token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_token(self):
+        """Devuelve un token válido; solo un hilo lo renueva cuando está a punto de caducar."""
+        with self.lock:
+            # Mismo margen que refresh_token: al llegar a él se renueva de verdad, en vez de
+            # releer dropbox_token.json en cada llamada hasta que el token caduque
+            if self.access_token is None or self.expires_at - TOKEN_REFRESH_MARGIN <= time.time():
+                self.access_token = get_access_token(self.app_key, self.app_secret, self.token_file,
+                                                     margin=TOKEN_REFRESH_MARGIN, token_url=self.token_url)
+                tokens = load_tokens(self.token_file) or {}
+                self.expires_at = tokens.get("expires_at", time.time() + 3600)
+            return self.access_token
+
+    def dbx(self):
+        """Cliente del SDK de Dropbox sobre la sesión compartida (con métricas por endpoint)."""
+        return instrument_client(trace_client(dropbox.Dropbox(self.get_token(), session=self.session), "dropbox"),
+                                 "dropbox")
+
+    def open_range_file(self, item, budget=None):
+        """Abre un fichero del listado para leerlo por rangos (con un ByteBudget opcional por petición)."""
+        return DropboxRangeFile(self.get_token(), item["path"], size=item["size"],
+                                session=self.session, url=self.download_url, budget=budget)
+
+    @contextmanager
+    def open_folder_zip(self, folder_path):
+        """
+        Abre en streaming la carpeta completa como un único zip (/2/files/download_zip).
+        Dropbox limita este endpoint a carpetas de menos de 20 GB y 10.000 ficheros.
+        La respuesta se cierra (y la conexión vuelve al pool) al salir del bloque `with`.
+        """
+        with timed("api_request", service="dropbox", endpoint="files/download_zip"), \
+                trace_request("dropbox", "files/download_zip", target=folder_path) as info:
+            response = self.session.post(
+                self.download_zip_url,
+                headers={"Authorization": f"Bearer {self.get_token()}",
+                         "Dropbox-API-Arg": json.dumps({"path": folder_path})},
+                stream=True, timeout=300,
+            )
+            info["status"] = response.status_code
+        with response:
+            if response.status_code != 200:
+                raise IOError(f"Error {response.status_code} descargando {folder_path} como zip: {response.text[:200]}")
+            response.raw.decode_content = True
+            yield response.raw
+
+
+class ByteBudget:
+    """
+    Limita los bytes en vuelo entre varios hilos. Un elemento mayor que el límite
+    se admite solo, cuando no hay nada más en vuelo.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + size <= self.max_bytes)
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+LISTING_SCHEMA_VERSION = 1
+
+def load_listing_state(state_path, folder_path):
+    """Carga el cursor y el último listado conocido de la carpeta (None si no hay o es de otra carpeta)."""
+    if not state_path or not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("schema_version") != LISTING_SCHEMA_VERSION or state.get("folder_path") != folder_path:
+        return None
+    return state
+
+def save_listing_state(state_path, folder_path, cursor, entries):
+    """Guarda de forma atómica el cursor de Dropbox y el listado de la carpeta."""
+    state = {"schema_version": LISTING_SCHEMA_VERSION, "folder_path": folder_path,
+             "cursor": cursor, "entries": entries}
+    atomic_write_bytes(state_path, json.dumps(state, ensure_ascii=False).encode('utf-8'))
+
+def apply_listing_entries(entries, dropbox_entries, folder_path):
+    """Aplica al listado (dict por ruta) las entradas devueltas por list_folder / list_folder_continue."""
+    for entry in dropbox_entries:
+        path = entry.path_lower or f"{folder_path}/{entry.name}".lower()
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            entries.pop(path, None)
+        elif isinstance(entry, dropbox.files.FileMetadata) and entry.name.endswith('.epub'):
+            entries[path] = {"path": path, "name": entry.name,
+                             "content_hash": entry.content_hash, "size": entry.size}
+
+def list_dropbox_epubs(dbx, folder_path, state_path=None):
+    """
+    Lista los EPUB de una carpeta de Dropbox.
+
+    Sigue la paginación completa (has_more) y, si se indica state_path, guarda el cursor
+    entre ejecuciones: las siguientes llamadas solo piden los cambios desde ese cursor.
+
+    Returns:
+        list: Un dict por fichero con 'path', 'name', 'content_hash' y 'size'.
+    """
+    state = load_listing_state(state_path, folder_path)
+    response = None
+    if state:
+        entries = state["entries"]
+        try:
+            response = dbx.files_list_folder_continue(state["cursor"])
+        except dropbox.exceptions.ApiError as e:
+            if not (hasattr(e.error, 'is_reset') and e.error.is_reset()):
+                raise
+            print("   -> Cursor de Dropbox caducado, listando la carpeta completa...")
+    if response is None:
+        entries = {}
+        response = dbx.files_list_folder(path=folder_path)
+
+    changes = len(response.entries)
+    apply_listing_entries(entries, response.entries, folder_path)
+    while response.has_more:
+        response = dbx.files_list_folder_continue(response.cursor)
+        changes += len(response.entries)
+        apply_listing_entries(entries, response.entries, folder_path)
+
+    if state_path:
+        if state:
+            print(f"   -> {changes} cambios en Dropbox desde la última ejecución.")
+        save_listing_state(state_path, folder_path, response.cursor, entries)
+    return list(entries.values())
+
+def wait_for_dropbox_changes(dbx, folder_path, state_path, timeout=480):
+    """
+    Espera (long polling, sin consumir llamadas a la API) hasta que cambie la carpeta
+    o venza el timeout. Pensado para el modo servicio.
+
+    Returns:
+        bool: True si hay cambios pendientes (o no hay cursor guardado todavía).
+    """
+    state = load_listing_state(state_path, folder_path)
+    if not state:
+        return True
+    result = dbx.files_list_folder_longpoll(state["cursor"], timeout=timeout)
+    if result.backoff:
+        time.sleep(result.backoff)
+    return result.changes
+
+def fetch_epub_metadata_from_dropbox(items, client, max_workers=DROPBOX_DOWNLOAD_WORKERS,
+                                     max_inflight_bytes=DROPBOX_MAX_INFLIGHT_MB * 1024 * 1024):
+    """
+    Obtiene los metadatos de una lista de EPUB de Dropbox (salida de list_dropbox_epubs).
+    Cada EPUB se lee por rangos (HTTP Range): solo se descargan el directorio central
+    del zip y las entradas necesarias (container.xml, OPF y, si hace falta, el ToC).
+    Los ficheros se procesan en paralelo, limitando los bytes en vuelo: cada petición
+    Range carga al límite solo los bytes que pide, no el tamaño del fichero.
+
+    Args:
+        items: Ficheros a procesar.
+        client: DropboxClient compartido.
+        max_workers: Descargas simultáneas.
+        max_inflight_bytes: Máximo de bytes pedidos en vuelo a la vez (suma de los rangos).
+
+    Returns:
+        list: Tuplas (item, metadatos) de los ficheros procesados correctamente.
+    """
+    budget = ByteBudget(max_inflight_bytes)
+
+    def process_item(item):
+        # Abrir el .epub en remoto, leyendo solo los rangos que pida zipfile; el zip y los
+        # bloques descargados se liberan también si el EPUB está corrupto
+        with client.open_range_file(item, budget=budget) as epub_file, \
+                EpubProcessor(epub_file=epub_file) as processor:
+            processor.process()
+            metadata = processor.get_metadata()
+        return item, metadata, epub_file.bytes_fetched
+
+    results = []
+    bytes_fetched = 0
+    bytes_total = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(in_trace_context(process_item, book=item["name"]), item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                item, metadata, fetched = future.result()
+            except Exception as e:
+                print(f"Fallo en {item['name']}: {e}")
+                continue
+            results.append((item, metadata))
+            bytes_fetched += fetched
+            bytes_total += item["size"]
+
+    if bytes_total:
+        print(f"   -> Descargados {bytes_fetched / 1e6:.1f} MB de {bytes_total / 1e6:.1f} MB ({len(results)} EPUBs)")
+    return results
+
+def fetch_epub_metadata_from_folder_zip(items, stream):
+    """
+    Modo masivo: procesa los EPUB de un zip con la carpeta completa leído en streaming,
+    sin extraer nada a disco. Cada EPUB interno se identifica por su content_hash,
+    así que solo se procesan los que están en items.
+
+    Args:
+        items: Ficheros a procesar (salida de list_dropbox_epubs).
+        stream: Zip de la carpeta (respuesta de download_zip o un fichero local equivalente).
+
+    Returns:
+        list: Tuplas (item, metadatos) de los ficheros procesados correctamente. Si el
+            stream se corta a mitad, los ya procesados (el resto se leerá por rangos).
+    """
+    wanted = {item["content_hash"]: item for item in items}
+    results = []
+    bytes_total = 0
+    try:
+        for name, content in iter_zip_stream(stream):
+            bytes_total += len(content)
+            if not name.endswith('.epub'):
+                continue
+            item = wanted.pop(compute_content_hash_bytes(content), None)
+            if item is None:
+                continue
+            try:
+                with EpubProcessor(epub_content=content) as processor:
+                    processor.process()
+                    metadata = processor.get_metadata()
+                results.append((item, metadata))
+            except Exception as e:
+                print(f"Fallo en {item['name']}: {e}")
+    except Exception as e:
+        print(f"   -> La descarga masiva se cortó ({e}) tras {len(results)} EPUBs procesados.")
+    finally:
+        count("api_bytes", bytes_total, service="dropbox", endpoint="files/download_zip")
+
+    print(f"   -> Descarga masiva: {len(results)} EPUBs procesados ({bytes_total / 1e6:.1f} MB leídos del zip)")
+    return results
 
 # Función para obtener metadatos desde Dropbox
 def get_epub_metadata_from_dropbox(folder_path='/Aplicaciones/Rakuten Kobo', books_df_to_process=None):
-    ACCESS_TOKEN = get_access_token(APP_KEY, APP_SECRET, TOKEN_FILE)
-    all_metadata = []
+    client = DropboxClient()
     try:
-        dbx = dropbox.Dropbox(ACCESS_TOKEN)
-        response = dbx.files_list_folder(path=folder_path)
+        dbx = client.dbx()
+        items = list_dropbox_epubs(dbx, folder_path)
 
-        # Crear un conjunto de títulos de libros a procesar para una búsqueda más rápida
+        # Si se especifica una lista de libros, procesar solo esos (comparando con el nombre del archivo)
         if books_df_to_process is not None:
-            titles_to_process = set(books_df_to_process['titulo'])
-        else:
-            titles_to_process = None
-
-        for entry in response.entries:
-            if entry.name.endswith('.epub'):
-                # Extraer el título del nombre del archivo para comparar
-                file_title = os.path.splitext(entry.name)[0]
-
-                # Si se especifica una lista de libros, procesar solo esos
-                if titles_to_process and file_title not in titles_to_process:
-                    continue
-
-                try:
-                    # Descargar el archivo .epub directamente en memoria
-                    metadata, res = dbx.files_download(path=f"{folder_path}/{entry.name}")
-                    epub_content = res.content
-
-                    # Usar la clase EpubProcessor para procesar el archivo
-                    processor = EpubProcessor(epub_content=epub_content)
-                    processor.process()
+            # Filtro previo por título sin subtítulo (el cruce real se hace después con los metadatos del OPF)
+            titles_to_process = {base_title_key(titulo) for titulo in books_df_to_process['titulo']}
+            items = [item for item in items if base_title_key(os.path.splitext(item["name"])[0]) in titles_to_process]
 
-                    # Obtener los metadatos
-                    metadata = processor.get_metadata()
-                    metadata['filename'] = entry.name
-                    all_metadata.append(metadata)
-                except Exception as e:
-                    print(f"Fallo en {entry.name}: {e}")
+        all_metadata = []
+        for item, metadata in fetch_epub_metadata_from_dropbox(items, client):
+            metadata['filename'] = item["name"]
+            all_metadata.append(metadata)
 
         df = pd.DataFrame(all_metadata)
         return df
@@ -149,55 +411,171 @@ def calculate_pages_kobo_style(epub_content, chars_per_page=1024):
     num_pages = len(text) // chars_per_page
     return num_pages
 
-def manage_epub_metadata(libros_ereader_df, cache_path="data/epub_metadata.pkl", folder_path='/Aplicaciones/Rakuten Kobo'):
+def get_unmatched_books(libros_ereader_df, epub_metadata, fuzzy_threshold=BOOK_FUZZY_THRESHOLD):
+    """
+    Devuelve los libros (titulo, autor) del E-Reader que no tienen metadatos de EPUB,
+    con el mismo criterio de cruce que process_data (clave canónica y, opcionalmente,
+    cruce aproximado).
+    """
+    libros_ereader_df = add_book_key(libros_ereader_df)
+    known = add_book_key(epub_metadata, 'title', 'author')['book_key']
+    matches = match_book_keys(libros_ereader_df['book_key'], known, fuzzy_threshold)
+    return [
+        (titulo, autor)
+        for titulo, autor, key in zip(libros_ereader_df['titulo'], libros_ereader_df['autor'],
+                                      libros_ereader_df['book_key'])
+        if key not in matches
+    ]
+
+class DropboxBookSource(BookSource):
+    """
+    EPUB en una carpeta de Dropbox: listado incremental por cursor y lectura por rangos.
+
+    Args:
+        folder_path: Carpeta de Dropbox.
+        listing_state_path: Fichero donde guardar el cursor (listado incremental).
+    """
+
+    name = "Dropbox"
+
+    def __init__(self, folder_path='/Aplicaciones/Rakuten Kobo', listing_state_path="data/dropbox_listing.json",
+                 bulk_threshold=DROPBOX_BULK_THRESHOLD):
+        self.folder_path = folder_path
+        self.listing_state_path = listing_state_path
+        self.bulk_threshold = bulk_threshold
+        self.client = None
+
+    def list_epubs(self):
+        if self.client is None:
+            self.client = DropboxClient()
+        return list_dropbox_epubs(self.client.dbx(), self.folder_path, state_path=self.listing_state_path)
+
+    def fetch_metadata(self, items):
+        """
+        Con muchos ficheros pendientes (primera ejecución o caché reconstruida) se descarga
+        la carpeta entera como un único zip; si no, cada EPUB se lee por rangos.
+        """
+        if self.client is None:
+            self.client = DropboxClient()
+
+        results = []
+        if self.bulk_threshold and len(items) >= self.bulk_threshold:
+            print(f"   -> {len(items)} EPUBs pendientes: descargando la carpeta completa como zip...")
+            try:
+                with self.client.open_folder_zip(self.folder_path) as stream:
+                    results = fetch_epub_metadata_from_folder_zip(items, stream)
+            except Exception as e:
+                print(f"   -> Falló la descarga masiva ({e}), se descargarán uno a uno.")
+            done = {item["content_hash"] for item, _ in results}
+            items = [item for item in items if item["content_hash"] not in done]
+
+        if items:
+            results += fetch_epub_metadata_from_dropbox(items, self.client)
+        return results
+
+def manage_epub_metadata(libros_ereader_df, cache_path="data/epub_metadata_cache.sqlite", folder_path='/Aplicaciones/Rakuten Kobo',
+                         legacy_cache_path="data/epub_metadata.pkl", misses_path="data/epub_misses.json",
+                         miss_ttl_days=EPUB_MISS_TTL_DAYS, listing_state_path="data/dropbox_listing.json",
+                         source=None, legacy_json_path="data/epub_metadata_cache.json", columns=None, cache=None):
     """
-    Gestiona la caché de metadatos de epub desde Dropbox.
-    Solo descarga metadatos de libros nuevos que no estén en la caché.
+    Gestiona la caché de metadatos de epub (por defecto desde Dropbox).
+    La caché está indexada por el content_hash de cada fichero, así que qué descargar
+    se decide solo con el listado de la carpeta: únicamente se procesan los EPUB cuyo
+    contenido no se haya visto antes (nuevos o modificados).
+
+    Los libros del E-Reader sin EPUB en la carpeta se guardan en una caché negativa junto
+    con la huella de la carpeta; mientras la carpeta no cambie y no venza el TTL no se
+    vuelven a buscar. Para saber si ha cambiado basta el listado incremental (una llamada
+    con el cursor de Dropbox, o un stat por fichero en un directorio local).
     
     Args:
         libros_ereader_df: DataFrame con los libros del E-Reader (columnas: 'titulo', 'autor')
-        cache_path: Ruta al archivo de caché
+        cache_path: Ruta a la caché de metadatos (SQLite)
         folder_path: Ruta a la carpeta de Dropbox
+        legacy_cache_path: Caché antigua (pickle por título) a migrar si existe
+        legacy_json_path: Caché JSON anterior (por content_hash) a migrar si existe
+        misses_path: Ruta a la caché de libros sin EPUB
+        miss_ttl_days: Días tras los que se vuelve a buscar un libro sin EPUB
+        listing_state_path: Ruta donde se guarda el cursor de Dropbox (listado incremental)
+        source: BookSource alternativo (p. ej. LocalBookSource); por defecto Dropbox
+        columns: Columnas de metadatos a devolver (por defecto todas)
+        cache: EpubMetadataCache ya abierta que se mantiene entre llamadas (modo daemon); no se cierra
         
     Returns:
         DataFrame con los metadatos de todos los libros (columnas: 'title', 'author', etc.)
     """
-    print("\n🔄 Obteniendo metadatos de Dropbox...")
-    
-    # Cargar caché si existe
-    if os.path.exists(cache_path):
-        print("   -> Usando caché de metadatos.")
-        epub_metadata = pd.read_pickle(cache_path)
-    else:
-        print("   -> No se encontró caché inicial.")
-        epub_metadata = pd.DataFrame()
-
-    # Identificar libros nuevos que no están en la caché
-    if not epub_metadata.empty and 'title' in epub_metadata.columns:
-        # Los metadatos de Dropbox usan 'title', los del E-Reader usan 'titulo'
-        libros_en_cache = set(epub_metadata['title'].dropna().unique())
-        libros_nuevos_df = libros_ereader_df[~libros_ereader_df['titulo'].isin(libros_en_cache)]
-    else:
-        # Si la caché está vacía o no tiene la columna correcta, procesar todos
-        libros_nuevos_df = libros_ereader_df
-
-    # Si hay libros nuevos, obtener sus metadatos y actualizar la caché
-    if not libros_nuevos_df.empty:
-        print(f"   -> {len(libros_nuevos_df)} libros nuevos detectados. Obteniendo sus metadatos de Dropbox...")
-        nuevos_metadatos = get_epub_metadata_from_dropbox(
-            folder_path=folder_path, 
-            books_df_to_process=libros_nuevos_df
-        )
-        
-        if not nuevos_metadatos.empty:
-            epub_metadata = pd.concat([epub_metadata, nuevos_metadatos], ignore_index=True)
-            epub_metadata.to_pickle(cache_path)
-            print("   -> Caché de metadatos actualizada.")
-        else:
-            print("   -> No se pudieron obtener metadatos para los libros nuevos.")
+    if source is None:
+        source = DropboxBookSource(folder_path, listing_state_path)
+    print(f"\n🔄 Obteniendo metadatos de {source.name}...")
+
+    if cache is not None:
+        return update_epub_metadata_cache(cache, source, libros_ereader_df, legacy_cache_path, legacy_json_path,
+                                          misses_path, miss_ttl_days, columns)
+    cache = EpubMetadataCache(cache_path)
+    try:
+        return update_epub_metadata_cache(cache, source, libros_ereader_df, legacy_cache_path, legacy_json_path,
+                                          misses_path, miss_ttl_days, columns)
+    finally:
+        cache.close()
+
+def update_epub_metadata_cache(cache, source, libros_ereader_df, legacy_cache_path, legacy_json_path,
+                               misses_path, miss_ttl_days, columns):
+    """Cuerpo de manage_epub_metadata con la caché ya abierta."""
+    # Migrar la caché JSON anterior (ya indexada por content_hash, no necesita listado)
+    if not len(cache) and legacy_json_path and os.path.exists(legacy_json_path):
+        imported = cache.import_json(legacy_json_path)
+        cache.save()
+        print(f"   -> {imported} EPUBs migrados desde la caché JSON anterior.")
+
+    misses = MissingEpubCache(misses_path, ttl_seconds=miss_ttl_days * 24 * 3600)
+    print(f"   -> {len(cache)} EPUBs en caché de metadatos, {len(misses)} libros sin EPUB conocidos.")
+
+    # Si todos los libros del E-Reader tienen metadatos, no hace falta listar
+    unmatched = get_unmatched_books(libros_ereader_df, cache.to_dataframe(['title', 'author']))
+    if len(cache) and not unmatched:
+        print(f"   -> No hay libros nuevos que procesar desde {source.name}.")
+        return cache.to_dataframe(columns)
+
+    try:
+        listing = source.list_epubs()
+    except Exception as e:
+        print(f"   -> No se pudo listar {source.name} ({e}). Usando solo la caché.")
+        return cache.to_dataframe(columns)
+
+    # Los fallos se comparan con el estado actual de la carpeta, no con el de la última ejecución
+    misses.set_folder_fingerprint(listing_fingerprint(listing))
+    if len(cache) and all(misses.is_suppressed(*book) for book in unmatched):
+        misses.save()
+        print(f"   -> {len(unmatched)} libros sin EPUB y la carpeta no ha cambiado desde que se buscaron.")
+        return cache.to_dataframe(columns)
+
+    # Migrar la caché antigua la primera vez (evita volver a descargar lo ya conocido)
+    if not len(cache) and legacy_cache_path and os.path.exists(legacy_cache_path):
+        imported = cache.import_legacy(pd.read_pickle(legacy_cache_path), listing)
+        print(f"   -> {imported} EPUBs migrados desde la caché antigua.")
+
+    # Decidir qué descargar solo con el listado (content_hash)
+    to_fetch = cache.plan(listing)
+    if to_fetch:
+        print(f"   -> {len(to_fetch)} EPUBs nuevos o modificados. Obteniendo sus metadatos de {source.name}...")
+        for item, metadata in source.fetch_metadata(to_fetch):
+            cache.put(item["content_hash"], item["path"], metadata)
     else:
-        print("   -> No hay libros nuevos que procesar desde Dropbox.")
-    
+        print(f"   -> No hay libros nuevos que procesar desde {source.name}.")
+
+    if cache.dirty:
+        cache.save()
+        print("   -> Caché de metadatos actualizada.")
+
+    epub_metadata = cache.to_dataframe(columns)
+
+    # Registrar los libros que siguen sin EPUB con la huella actual de la carpeta
+    unmatched = get_unmatched_books(libros_ereader_df, cache.to_dataframe(['title', 'author']))
+    misses.record(unmatched)
+    misses.save()
+    if unmatched:
+        print(f"   -> {len(unmatched)} libros del E-Reader sin EPUB en {source.name} (no se volverán a buscar hasta que cambie la carpeta).")
+
     return epub_metadata
 
 def refresh_access_token(refresh_token, app_key, app_secret):
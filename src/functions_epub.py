@@ -5,8 +5,23 @@ import json
 import re
 from bs4 import BeautifulSoup
 import math
+import posixpath
+from functools import cached_property
+from urllib.parse import unquote
 import pandas as pd
 from datetime import datetime
+from src.metrics import timed
+
+NS_OPF = 'http://www.idpf.org/2007/opf'
+NS_NCX = 'http://www.daisy.org/z3986/2005/ncx/'
+NS_XHTML = 'http://www.w3.org/1999/xhtml'
+NS_OPS = 'http://www.idpf.org/2007/ops'
+NS_DC = 'http://purl.org/dc/elements/1.1/'
+
+# Campos que salen solo del OPF (unos pocos KB del EPUB)
+OPF_FIELDS = ('title', 'author', 'publisher', 'language', 'description', 'subjects', 'publication_date', 'pages')
+# Estimaciones que requieren leer y parsear todo el texto del libro
+TEXT_FIELDS = ('pages_calc_pr', 'pages_calc')
 
 def parse_dates(date_str):
     try:
@@ -22,13 +37,47 @@ def parse_dates(date_str):
             return None
 
 class EpubProcessor:
-    def __init__(self, epub_content=None, epub_path=None):
+    def __init__(self, epub_content=None, epub_path=None, epub_file=None):
         """
-        Se inicializa con el contenido del archivo EPUB en memoria o con la ruta del archivo.
+        Se inicializa con el contenido del archivo EPUB en memoria, con la ruta del archivo
+        o con un fichero con seek (p. ej. un RangeFile que lee por rangos desde Dropbox).
+        Los metadatos se calculan de forma perezosa: cada campo es una propiedad que solo
+        se evalúa (y se guarda en caché) cuando alguien la pide.
         """
         self.epub_path = epub_path
         self.epub_content = epub_content
+        self.epub_file = epub_file
         self.metadata = {}
+        # Cachés: el zip se abre una vez, el OPF se parsea una sola vez y el orden del ToC se calcula bajo demanda
+        self.epub = None
+        self.opf_root = None
+        self.opf_path = None
+        self.toc_files = None
+
+    def open_epub(self):
+        """
+        Abre el EPUB como zip (una sola vez) y devuelve el objeto ZipFile.
+        """
+        if self.epub is None:
+            if self.epub_file is not None:
+                # Solo se leen el directorio central y las entradas que se abran
+                self.epub = zipfile.ZipFile(self.epub_file, 'r')
+            else:
+                content = self.epub_content if self.epub_content else open(self.epub_path, 'rb').read()
+                self.epub = zipfile.ZipFile(BytesIO(content), 'r')
+        return self.epub
+
+    def close(self):
+        """Cierra el zip abierto, si lo hay."""
+        if self.epub is not None:
+            self.epub.close()
+            self.epub = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def find_opf_path(self, epub):
         """
@@ -46,139 +95,260 @@ class EpubProcessor:
     def extract_opf_content(self):
         """
         Extrae el archivo OPF del archivo EPUB y lo procesa como XML.
+        El resultado se guarda en caché para no volver a parsear el OPF.
         """
-        content = self.epub_content if self.epub_content else open(self.epub_path, 'rb').read()
+        if self.opf_root is not None:
+            return self.opf_root
+
+        epub = self.open_epub()
+        try:
+            opf_path = self.find_opf_path(epub)
+        except FileNotFoundError:
+            opf_path = next((file for file in epub.namelist() if file.endswith('.opf')), None)
+            if not opf_path:
+                raise FileNotFoundError("No se encontró ningún archivo OPF en el EPUB.")
 
-        with zipfile.ZipFile(BytesIO(content), 'r') as epub:
-            try:
-                opf_path = self.find_opf_path(epub)
-            except FileNotFoundError:
-                opf_path = next((file for file in epub.namelist() if file.endswith('.opf')), None)
-                if not opf_path:
-                    raise FileNotFoundError("No se encontró ningún archivo OPF en el EPUB.")
+        with epub.open(opf_path) as f:
+            tree = ET.parse(f)
+            self.opf_path = opf_path
+            self.opf_root = tree.getroot()
+            return self.opf_root
 
-            with epub.open(opf_path) as f:
-                tree = ET.parse(f)
-                return tree.getroot()
+    # --- Campos del OPF (baratos) ---
+
+    @cached_property
+    def title(self):
+        return self.extract_opf_content().findtext(f'.//{{{NS_DC}}}title', default='')
+
+    @cached_property
+    def author(self):
+        return self.extract_opf_content().findtext(f'.//{{{NS_DC}}}creator', default='')
+
+    @cached_property
+    def publisher(self):
+        return self.extract_opf_content().findtext(f'.//{{{NS_DC}}}publisher', default='')
+
+    @cached_property
+    def language(self):
+        return self.extract_opf_content().findtext(f'.//{{{NS_DC}}}language', default='')
+
+    @cached_property
+    def description(self):
+        return self.extract_opf_content().findtext(f'.//{{{NS_DC}}}description', default='')
+
+    @cached_property
+    def subjects(self):
+        return [elem.text for elem in self.extract_opf_content().findall(f'.//{{{NS_DC}}}subject')]
+
+    @cached_property
+    def publication_date(self):
+        return parse_dates(self.extract_opf_content().findtext(f'.//{{{NS_DC}}}date', default=''))
+
+    @cached_property
+    def pages(self):
+        """
+        Número de páginas guardado por Calibre en la etiqueta <meta> correspondiente.
+        """
+        ns = {'opf': NS_OPF}
+        pages_meta = self.extract_opf_content().find('.//opf:meta[@name="calibre:user_metadata:#pages"]', namespaces=ns)
+        if pages_meta is None:
+            return None
+        try:
+            content = pages_meta.attrib.get('content', '')
+            parsed_content = json.loads(content.replace('&quot;', '"'))
+            return parsed_content.get('#value#', 0)
+        except json.JSONDecodeError:
+            return None
+
+    # --- Estimaciones a partir del texto (caras) ---
+
+    @cached_property
+    def pages_calc_pr(self):
+        return self.calculate_precise_page_count(chars_per_page=1300)
+
+    @cached_property
+    def pages_calc(self):
+        return self.calculate_precise_page_count(chars_per_page=1024)
 
     def parse_opf_metadata(self, root):
         """
         Analiza el contenido del archivo OPF (como XML) para extraer metadatos relevantes.
+        Solo incluye los campos del OPF; las estimaciones de páginas se piden aparte.
         """
-        ns = {'opf': 'http://www.idpf.org/2007/opf'}  # Namespace OPF
-
-        self.metadata = {
-            'title': root.findtext('.//{http://purl.org/dc/elements/1.1/}title', default=''),
-            'author': root.findtext('.//{http://purl.org/dc/elements/1.1/}creator', default=''),
-            'publisher': root.findtext('.//{http://purl.org/dc/elements/1.1/}publisher', default=''),
-            'language': root.findtext('.//{http://purl.org/dc/elements/1.1/}language', default=''),
-            'description': root.findtext('.//{http://purl.org/dc/elements/1.1/}description', default=''),
-            'subjects': [elem.text for elem in root.findall('.//{http://purl.org/dc/elements/1.1/}subject')],
-            'publication_date': root.findtext('.//{http://purl.org/dc/elements/1.1/}date', default=''),
-            'pages_calc_pr': self.calculate_precise_page_count(chars_per_page=1300),
-            'pages_calc': self.calculate_precise_page_count(chars_per_page=1024)
-        }
-        self.metadata['publication_date'] = parse_dates(self.metadata['publication_date'])
+        self.opf_root = root
+        self.metadata.update({field: getattr(self, field) for field in OPF_FIELDS if field != 'pages'})
 
     def parse_pages_metadata(self, root):
         """
         Extrae el número de páginas desde la etiqueta <meta> correspondiente.
-																								
-        """
-        ns = {'opf': 'http://www.idpf.org/2007/opf'}
-        pages_meta = root.find('.//opf:meta[@name="calibre:user_metadata:#pages"]', namespaces=ns)
-        
-        if pages_meta is not None:
-            try:
-                content = pages_meta.attrib.get('content', '')
-                parsed_content = json.loads(content.replace('&quot;', '"'))
-                pages = parsed_content.get('#value#', 0)
-                self.metadata['pages'] = pages
-            except json.JSONDecodeError:
-                self.metadata['pages'] = None
-        else:
-            self.metadata['pages'] = None
-
+        """
+        self.opf_root = root
+        self.metadata['pages'] = self.pages
 
     def calculate_precise_page_count(self, chars_per_page=1300, calculo_pags="cap",
                                      debug = False):
         from bs4 import BeautifulSoup  # Para analizar HTML
 
-        content = self.epub_content if self.epub_content else open(self.epub_path, 'rb').read()
         total_chars = 0
         total_paginas = 0
-        with zipfile.ZipFile(BytesIO(content), 'r') as epub:
-            # Obtener el orden de los capítulos según el ToC
-            toc_files = self.get_toc_order(epub)
-            available_files = epub.namelist()  # Lista de archivos disponibles en el EPUB
-            toc_files = [f"OEBPS/{t}" for t in toc_files]
-
-            for file_name in toc_files:
-                if file_name in available_files:
-                    with epub.open(file_name) as f:
-                        file_content = f.read().decode('utf-8')
-                        soup = BeautifulSoup(file_content, 'html.parser')
-                        text = soup.get_text()  # Extrae solo el texto visible
-                        if calculo_pags == "total":
-                            total_chars += len(text)
-                        else:
-                            pags_cap = max(len(text) // chars_per_page, 1)
-                            total_paginas += pags_cap
-                            if ("articulo" not in file_name) and debug: 
-                                print(file_name, total_paginas, pags_cap, len(text))
-                else:
-                    print(f"{self.metadata['title']}, {self.metadata['author']}: Archivo '{file_name}' no encontrado en el EPUB.")
-            if calculo_pags == "total":
-                total_paginas = max(total_chars // chars_per_page, 1)
-            else: 
-                total_paginas += 1
+        epub = self.open_epub()
+
+        # Obtener el orden de los capítulos según el ToC
+        toc_files = self.get_toc_order(epub)
+        available_files = epub.namelist()  # Lista de archivos disponibles en el EPUB
+
+        for file_name in toc_files:
+            if file_name in available_files:
+                with epub.open(file_name) as f:
+                    file_content = f.read().decode('utf-8')
+                    soup = BeautifulSoup(file_content, 'html.parser')
+                    text = soup.get_text()  # Extrae solo el texto visible
+                    if calculo_pags == "total":
+                        total_chars += len(text)
+                    else:
+                        pags_cap = max(len(text) // chars_per_page, 1)
+                        total_paginas += pags_cap
+                        if ("articulo" not in file_name) and debug: 
+                            print(file_name, total_paginas, pags_cap, len(text))
+            else:
+                print(f"{self.title}, {self.author}: Archivo '{file_name}' no encontrado en el EPUB.")
+        if calculo_pags == "total":
+            total_paginas = max(total_chars // chars_per_page, 1)
+        else: 
+            total_paginas += 1
         return total_paginas
 
 
 
+    @staticmethod
+    def resolve_href(base_path, href):
+        """
+        Convierte un href relativo (respecto a base_path) en una ruta dentro del zip.
+        """
+        href = unquote(href.split('#')[0])
+        base_dir = posixpath.dirname(base_path) if base_path else ''
+        return posixpath.normpath(posixpath.join(base_dir, href)).lstrip('/')
+
     def get_spine_files(self):
         root = self.extract_opf_content()
-        ns = {'opf': 'http://www.idpf.org/2007/opf'}
+        ns = {'opf': NS_OPF}
         spine_ids = [item.attrib['idref'] for item in root.findall('.//opf:spine/opf:itemref', namespaces=ns)]
 
         manifest = {item.attrib['id']: item.attrib['href'] for item in root.findall('.//opf:manifest/opf:item', namespaces=ns)}
         spine_files = [manifest[idref] for idref in spine_ids if idref in manifest]
 
         # Ajusta las rutas relativas basándote en la ubicación del OPF
-        opf_path = self.find_opf_path(zipfile.ZipFile(BytesIO(self.epub_content)))
-        opf_folder = '/'.join(opf_path.split('/')[:-1])
-        return [f"{opf_folder}/{file}" for file in spine_files]
+        return [self.resolve_href(self.opf_path, file) for file in spine_files]
+
+    def find_toc_path(self, root):
+        """
+        Localiza el documento de navegación a partir del manifest del OPF.
+        Prioriza el toc.ncx (EPUB2) y, si no existe, usa el nav.xhtml (EPUB3).
+
+        Returns:
+            tuple: (ruta dentro del zip, 'ncx' | 'nav') o (None, None) si no hay ToC.
+        """
+        ns = {'opf': NS_OPF}
+        items = root.findall('.//opf:manifest/opf:item', namespaces=ns)
+        spine = root.find('.//opf:spine', namespaces=ns)
+        ncx_id = spine.attrib.get('toc') if spine is not None else None
+
+        for item in items:
+            # Sin atributo toc en el spine, ncx_id es None y no debe casar con un item sin id
+            if (ncx_id is not None and item.attrib.get('id') == ncx_id) \
+                    or item.attrib.get('media-type') == 'application/x-dtbncx+xml':
+                return self.resolve_href(self.opf_path, item.attrib['href']), 'ncx'
+
+        for item in items:
+            if 'nav' in item.attrib.get('properties', '').split():
+                return self.resolve_href(self.opf_path, item.attrib['href']), 'nav'
+
+        return None, None
+
+    def parse_ncx_order(self, f, toc_path):
+        """
+        Recorre el toc.ncx en streaming y devuelve los ficheros de cada navPoint en orden.
+        """
+        ordered_files = []
+        parents = []
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == f'{{{NS_NCX}}}content' and parents and parents[-1] == f'{{{NS_NCX}}}navPoint':
+                    src = elem.attrib.get('src')
+                    if src:
+                        ordered_files.append(self.resolve_href(toc_path, src))
+                parents.append(elem.tag)
+            else:
+                parents.pop()
+                elem.clear()
+        return ordered_files
+
+    def parse_nav_order(self, f, toc_path):
+        """
+        Recorre el nav.xhtml (EPUB3) en streaming y devuelve los enlaces del <nav epub:type="toc">.
+        """
+        ordered_files = []
+        toc_depth = 0
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if elem.tag == f'{{{NS_XHTML}}}nav':
+                is_toc = 'toc' in elem.attrib.get(f'{{{NS_OPS}}}type', '').split()
+                if is_toc or toc_depth:
+                    toc_depth += 1 if event == 'start' else -1
+            elif event == 'start' and toc_depth and elem.tag == f'{{{NS_XHTML}}}a':
+                href = elem.attrib.get('href')
+                if href:
+                    ordered_files.append(self.resolve_href(toc_path, href))
+        return ordered_files
 
     def get_toc_order(self, epub):
         """
-        Extrae el orden de los capítulos desde el archivo toc.ncx.
+        Extrae el orden de los capítulos desde el ToC (toc.ncx o nav.xhtml) localizado en el OPF.
+        Si no hay ToC utilizable se recurre al spine. El resultado se guarda en caché.
         """
+        if self.toc_files is not None:
+            return self.toc_files
+
         try:
-            toc_path = next((file for file in epub.namelist() if file.endswith('toc.ncx')), None)
+            root = self.extract_opf_content()
+            toc_path, toc_type = self.find_toc_path(root)
             if not toc_path:
-                raise FileNotFoundError("No se encontró ningún archivo toc.ncx en el EPUB.")
+                raise FileNotFoundError("No se encontró ningún toc.ncx ni nav.xhtml en el EPUB.")
 
             with epub.open(toc_path) as f:
-                soup = BeautifulSoup(f.read(), 'xml')
-                nav_points = soup.find_all('navPoint')
-                ordered_files = [nav_point.content['src'].split('#')[0] for nav_point in nav_points if nav_point.content]
-                return list(dict.fromkeys(ordered_files))  # Eliminar duplicados conservando el orden
+                if toc_type == 'ncx':
+                    ordered_files = self.parse_ncx_order(f, toc_path)
+                else:
+                    ordered_files = self.parse_nav_order(f, toc_path)
+            if not ordered_files:
+                raise ValueError(f"El ToC '{toc_path}' no contiene entradas.")
+            self.toc_files = list(dict.fromkeys(ordered_files))  # Eliminar duplicados conservando el orden
         except Exception as e:
-            print(f"Error al procesar el archivo toc.ncx: {e}")
-            return self.get_spine_files()
+            print(f"Error al procesar el ToC: {e}")
+            self.toc_files = self.get_spine_files()
+        return self.toc_files
 
     def process(self):
         """
         Procesa el archivo EPUB: extrae el contenido del OPF y analiza los metadatos.
+        No recorre el texto del libro; las estimaciones de páginas se calculan en get_metadata.
         """
-        root = self.extract_opf_content()
-        self.parse_opf_metadata(root)
-        self.parse_pages_metadata(root)
+        with timed("epub_parse", step="opf"):
+            root = self.extract_opf_content()
+            self.parse_opf_metadata(root)
+            self.parse_pages_metadata(root)
 
-    def get_metadata(self):
+    def get_metadata(self, fields=None):
         """
-        Devuelve los metadatos extraídos del archivo OPF.
+        Devuelve los metadatos del EPUB.
+
+        Args:
+            fields: Campos a calcular. Por defecto solo los del OPF; las estimaciones de
+                páginas a partir del texto se añaden únicamente si Calibre no trae '#pages'.
         """
+        if fields is None:
+            fields = OPF_FIELDS + (TEXT_FIELDS if self.pages is None else ())
+        with timed("epub_parse", step="metadata"):
+            self.metadata.update({field: getattr(self, field) for field in fields})
         return self.metadata
 
     def get_content(self):
@@ -188,11 +358,10 @@ class EpubProcessor:
         return self.epub_content
 
     def get_file(self, file_name, format = "processed"):
-        with zipfile.ZipFile(BytesIO(self.epub_content), 'r') as epub:
-            with epub.open(file_name) as f:
-                file_content = f.read().decode('utf-8')
-                if format == "processed":
-                    soup = BeautifulSoup(file_content, 'html.parser')
-                    file_content = soup.get_text()  # Extrae solo el texto visible
-                
-                return file_content
\ No newline at end of file
+        with self.open_epub().open(file_name) as f:
+            file_content = f.read().decode('utf-8')
+            if format == "processed":
+                soup = BeautifulSoup(file_content, 'html.parser')
+                file_content = soup.get_text()  # Extrae solo el texto visible
+
+            return file_content
\ No newline at end of file
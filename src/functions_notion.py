@@ -1,15 +1,20 @@
 import pandas as pd
 import hashlib
 import json
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 from tqdm import tqdm
+from src.book_keys import add_book_key, canonical_key, title_key, exact_key
+from src.metrics import timed_function, count
+from src.tracing import trace_context, in_trace_context, record, current_fields
 
 # Función para limpiar los géneros en una lista
 def clean_generos_list(generos):
     # Asegúrate de que generos no sea None y que cada elemento sea una cadena válida
     return [genero.replace(",", " ") if genero is not None else "" for genero in generos]
 
+@timed_function("hash", kind="book")
 def create_book_hash(row):
     """Crear hash del contenido del libro para detectar cambios"""
     book_data = {
@@ -46,7 +51,120 @@ def ensure_database_properties(notion, database_id, required_properties):
     except Exception as e:
         print(f"⚠️ No se pudieron añadir campos automáticamente: {e}")
 
-def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False):
+def get_all_pages(notion, database_id, query_filter=None):
+    """Obtener TODAS las páginas de una base de datos (o las que cumplan `query_filter`) con paginación optimizada"""
+    pages = []
+    has_more = True
+    start_cursor = None
+    
+    while has_more:
+        query_params = {
+            "database_id": database_id,
+            "page_size": 100  # Máximo tamaño de página para mejor performance
+        }
+        if query_filter:
+            query_params["filter"] = query_filter
+        if start_cursor:
+            query_params["start_cursor"] = start_cursor
+        
+        response = notion.databases.query(**query_params)
+        pages.extend(response["results"])
+        has_more = response.get("has_more", False)
+        start_cursor = response.get("next_cursor")
+    
+    return pages
+
+class NotionSnapshot:
+    """
+    Copia en memoria de una base de datos de Notion para procesos que siguen en marcha
+    entre sincronizaciones (modo daemon).
+
+    La primera vez se descarga entera; después solo se piden las páginas editadas desde
+    la última edición vista (Notion redondea last_edited_time al minuto, por eso se usa
+    on_or_after y alguna página se recibe dos veces). Las páginas archivadas no aparecen
+    en las consultas, así que cada `full_refresh_seconds` se vuelve a descargar entera.
+
+    Args:
+        transform: Función que reduce cada página a lo que se guarda (por defecto la página entera).
+    """
+
+    def __init__(self, notion, database_id, transform=None, full_refresh_seconds=6 * 3600):
+        self.notion = notion
+        self.database_id = database_id
+        self.transform = transform
+        self.full_refresh_seconds = full_refresh_seconds
+        self.entries = {}
+        self.watermark = None
+        self.full_refresh_at = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """La siguiente actualización descargará la base de datos entera."""
+        with self.lock:
+            self.watermark = None
+
+    def refresh(self):
+        """Actualiza la copia y devuelve sus entradas."""
+        with self.lock:
+            full = (self.watermark is None or
+                    time.monotonic() - self.full_refresh_at >= self.full_refresh_seconds)
+            if full:
+                pages = get_all_pages(self.notion, self.database_id)
+                self.entries = {}
+                self.full_refresh_at = time.monotonic()
+            else:
+                pages = get_all_pages(self.notion, self.database_id, query_filter={
+                    "timestamp": "last_edited_time", "last_edited_time": {"on_or_after": self.watermark}})
+            for page in pages:
+                if page.get("archived") or page.get("in_trash"):
+                    self.entries.pop(page["id"], None)
+                else:
+                    self.entries[page["id"]] = self.transform(page) if self.transform else page
+            self.watermark = max([page["last_edited_time"] for page in pages] +
+                                 ([self.watermark] if self.watermark else []), default=None)
+            count("notion_snapshot_pages", len(pages), mode="completa" if full else "incremental")
+            return list(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+class BookPageStream:
+    """
+    Canal entre create_books y create_annotations: cada libro creado se publica en
+    cuanto Notion devuelve su id, para que sus anotaciones se creen sin esperar al
+    resto de libros. Al cerrarlo, quien espera deja de hacerlo.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.books = []
+        self.closed = False
+
+    def publish(self, title, author, page_id):
+        with self.condition:
+            self.books.append((title, author, page_id))
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def follow(self):
+        """Itera por los libros publicados (también los anteriores) hasta que se cierre el canal."""
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.books) and not self.closed:
+                    self.condition.wait()
+                batch = self.books[index:]
+                index = len(self.books)
+            if not batch:
+                return
+            yield from batch
+
+def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False, existing_books=None,
+                 book_stream=None, budget=None, page_updates=None):
     """
     Crear/actualizar libros en Notion
     
@@ -55,6 +173,16 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
         notion: Cliente de Notion
         NOTION_BOOKS_DATABASE_ID: ID de la base de datos
         force_update: Si True, actualiza todos los libros ignorando el hash
+        existing_books: Páginas ya descargadas de la base de datos (si es None se descargan aquí)
+        book_stream: BookPageStream en el que publicar cada libro nuevo en cuanto se crea
+        budget: SyncBudget; agotado, los libros pendientes se aplazan (se procesan primero los leídos
+            más recientemente)
+        page_updates: PageUpdates en el que dejar los cambios de los libros existentes, para enviarlos
+            junto con el Content_Hash de create_book_pages (si es None se envían aquí)
+
+    Returns:
+        int: Libros aplazados por el presupuesto o con error, incluidos los duplicados que no se
+            pudieron archivar (0 si se procesaron todos)
     """
     # Asegurar que existan los campos necesarios
     required_props = {
@@ -63,35 +191,19 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
     }
     ensure_database_properties(notion, NOTION_BOOKS_DATABASE_ID, required_props)
     
-    # Obtener TODOS los libros existentes con paginación optimizada
-    print("🔍 Cargando libros existentes de Notion...")
-    existing_books = []
-    has_more = True
-    start_cursor = None
-    
-    while has_more:
-        query_params = {
-            "database_id": NOTION_BOOKS_DATABASE_ID,
-            "page_size": 100  # Máximo tamaño de página para mejor performance
-        }
-        if start_cursor:
-            query_params["start_cursor"] = start_cursor
-        
-        response = notion.databases.query(**query_params)
-        existing_books.extend(response["results"])
-        has_more = response.get("has_more", False)
-        start_cursor = response.get("next_cursor")
-    
+    # Obtener TODOS los libros existentes (salvo que ya vengan descargados)
+    if existing_books is None:
+        print("🔍 Cargando libros existentes de Notion...")
+        existing_books = get_all_pages(notion, NOTION_BOOKS_DATABASE_ID)
     print(f"   📚 Total de libros en Notion: {len(existing_books)}")
 
     existing_books_dict = {}
     existing_books_hash = {}
-    books_to_delete = {}
+    books_to_delete = []
+    near_duplicates = []
+    existing_exact_keys = {}
     existing_completion_dates = {}
 
-    def normalize_text(text):
-        return text.strip().lower() if isinstance(text, str) else ""
-
     # Mapear libros existentes con sus hashes
     for page in existing_books:
         if "Título" in page["properties"] and "Autor" in page["properties"]:
@@ -108,14 +220,19 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
                         completion_date = date_value.get("start")
                 
                 if title and author:
-                    book_key = (
-                        normalize_text(title[0]["text"]["content"]),
-                        normalize_text(author[0]["text"]["content"])
-                    )
+                    title_text, author_text = title[0]["text"]["content"], author[0]["text"]["content"]
+                    book_key = canonical_key(title_text, author_text)
                     if book_key in existing_books_dict:
-                        books_to_delete[page["id"]] = book_key  # Duplicados a eliminar
+                        # Solo se archiva si título y autor coinciden literalmente; si solo coinciden
+                        # tras normalizar (tildes, puntuación...) se avisa y se deja la página
+                        duplicate = (page["id"], title_text, author_text, existing_books_dict[book_key])
+                        if exact_key(title_text, author_text) == existing_exact_keys[book_key]:
+                            books_to_delete.append(duplicate)
+                        else:
+                            near_duplicates.append(duplicate)
                     else:
                         existing_books_dict[book_key] = page["id"]
+                        existing_exact_keys[book_key] = exact_key(title_text, author_text)
                         if completion_date:
                             existing_completion_dates[book_key] = completion_date
                         
@@ -126,27 +243,34 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
             except (IndexError, KeyError, TypeError) as e:
                 continue
 
+    books_created = 0
+    books_updated = 0
+    books_skipped = 0
+    books_deferred = 0
+    books_failed = 0
+
+    if near_duplicates:
+        print(f"⚠️ {len(near_duplicates)} libros parecen duplicados pero su título o autor no es idéntico; "
+              f"no se archivan:")
+        for page_id, title_text, author_text, kept_id in near_duplicates:
+            print(f"   - {title_text} — {author_text} ({page_id}), se usa {kept_id}")
+
     # Eliminar duplicados
     if books_to_delete:
         print(f"🗑️ Eliminando {len(books_to_delete)} libros duplicados...")
-        for book_id in books_to_delete:
+        for page_id, title_text, author_text, kept_id in books_to_delete:
+            print(f"   🗑️ {title_text} — {author_text} ({page_id}), se conserva {kept_id}")
             try:
-                notion.pages.update(**{"page_id": book_id, "archived": True})
+                notion.pages.update(**{"page_id": page_id, "archived": True})
             except Exception as e:
+                books_failed += 1
                 print(f"⚠️ Error eliminando duplicado: {e}")
 
-    books_created = 0
-    books_updated = 0
-    books_skipped = 0
-
     def process_book(row_tuple):
         """Procesa un libro individual (para paralelización)"""
         idx, row = row_tuple
         try:
-            book_key = (
-                normalize_text(row["titulo"]),
-                normalize_text(row["autor"])
-            )
+            book_key = row["book_key"]
             
             # Crear hash del libro actual
             current_hash = create_book_hash(row)
@@ -156,6 +280,9 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
                 existing_hash = existing_books_hash.get(book_key, "")
                 if not force_update and current_hash == existing_hash:
                     return "skipped", book_key, None
+
+            if budget is not None and budget.exhausted():
+                return "deferred", book_key, None
             
             # Construir propiedades básicas
             properties = {
@@ -204,6 +331,10 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
                         # Limpiar la fecha de finalización si el libro no está finalizado
                         properties["Fecha de finalización"] = {"date": None}
                     
+                    if page_updates is not None:
+                        page_updates.add(page_id, properties)
+                        return "updated", book_key, None
+
                     def _update():
                         return notion.pages.update(
                             **{
@@ -227,15 +358,23 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
                         parent={"database_id": NOTION_BOOKS_DATABASE_ID},
                         properties=properties,
                     )
-                retry_api_call(_create, max_retries=3, initial_delay=1)
+                response = retry_api_call(_create, max_retries=3, initial_delay=1)
+                if book_stream is not None and response:
+                    book_stream.publish(row["titulo"], row["autor"], response["id"])
                 return "created", book_key, None
 
         except Exception as e:
             return "error", None, f"Error procesando libro {row.get('titulo', 'desconocido')}: {e}"
 
+    # Los leídos más recientemente primero: con presupuesto son los que no se aplazan
+    libros_df = add_book_key(libros_df)
+    if 'fecha_ultima_lectura' in libros_df.columns:
+        libros_df = libros_df.sort_values('fecha_ultima_lectura', ascending=False, na_position='last', kind='stable')
+
     # Procesar libros en paralelo con barra de progreso
     with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(process_book, row_tuple) for row_tuple in libros_df.iterrows()]
+        futures = [executor.submit(in_trace_context(process_book, book=row_tuple[1]["titulo"]), row_tuple)
+                   for row_tuple in libros_df.iterrows()]
         
         # Procesar resultados con barra de progreso
         for future in tqdm(as_completed(futures), total=len(futures), desc="📚 Sincronizando libros"):
@@ -248,10 +387,19 @@ def create_books(libros_df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False
                 books_updated += 1
             elif result == "skipped":
                 books_skipped += 1
-            elif result == "error" and error:
-                print(f"\n❌ {error}")
+            elif result == "deferred":
+                books_deferred += 1
+            elif result == "error":
+                books_failed += 1
+                if error:
+                    print(f"\n❌ {error}")
 
-    print(f"\n📚 Libros procesados: {books_created} creados, {books_updated} actualizados, {books_skipped} sin cambios")
+    print(f"\n📚 Libros procesados: {books_created} creados, {books_updated} actualizados, {books_skipped} sin cambios"
+          + (f", {books_deferred} aplazados" if books_deferred else "")
+          + (f", {books_failed} con error" if books_failed else ""))
+    if budget is not None:
+        budget.defer("libros", books_deferred)
+    return books_deferred + books_failed
 
 def get_last_annotation_date_notion(notion, NOTION_ANNOTATIONS_DATABASE_ID):
     response = notion.databases.query(
@@ -267,17 +415,38 @@ def get_last_annotation_date_notion(notion, NOTION_ANNOTATIONS_DATABASE_ID):
         last_date_in_notion = None
     
     return last_date_in_notion
+
+def get_database_fingerprint(notion, database_id):
+    """
+    Huella barata del estado de una base de datos de Notion: la página editada más
+    recientemente (id y last_edited_time, que Notion redondea al minuto).
+    """
+    response = notion.databases.query(
+        database_id=database_id,
+        sorts=[{"timestamp": "last_edited_time", "direction": "descending"}],
+        page_size=1
+    )
+    if not response['results']:
+        return None
+    page = response['results'][0]
+    return [page["id"], page["last_edited_time"]]
+
 def retry_api_call(func, max_retries=3, initial_delay=1):
     """Reintentar llamadas a la API con backoff exponencial"""
     for attempt in range(max_retries):
         try:
-            return func()
+            with trace_context(retry=attempt):
+                return func()
         except Exception as e:
             error_str = str(e)
             # Reintentar solo en errores temporales
-            if any(code in error_str for code in ['502', '503', '504', '429', 'timeout', 'timed out']):
+            reason = next((code for code in ['502', '503', '504', '429', 'timeout', 'timed out'] if code in error_str), None)
+            if reason:
                 if attempt < max_retries - 1:
                     delay = initial_delay * (2 ** attempt)
+                    count("api_retries", service="notion", reason=reason)
+                    count("api_retry_wait_seconds", delay, service="notion", reason=reason)
+                    record("backoff", service="notion", reason=reason, wait_ms=delay * 1000)
                     print(f"⏳ Error temporal ({error_str[:50]}...), reintentando en {delay}s... (intento {attempt + 1}/{max_retries})")
                     time.sleep(delay)
                 else:
@@ -288,45 +457,48 @@ def retry_api_call(func, max_retries=3, initial_delay=1):
                 raise
     return None
 
-def get_book_ids_batch(book_titles, notion, NOTION_BOOKS_DATABASE_ID):
-    """Obtener IDs de libros en batch para evitar múltiples consultas"""
-    cache = {}
-    cache_normalized = {}
-    
-    def normalize_text(text):
-        return text.strip().lower() if isinstance(text, str) else ""
-    
-    # Obtener TODOS los libros con paginación optimizada
-    all_books = []
-    has_more = True
-    start_cursor = None
+def add_book_id(ids_by_title, ids_by_key, title, author, page_id):
+    """Registrar un libro en las caches de IDs por clave canónica (título+autor) y por clave del título"""
+    # El primero gana: es el que conserva create_books al eliminar duplicados
+    if author:
+        ids_by_key.setdefault(canonical_key(title, author), page_id)
+    # Todas las páginas con ese título: solo se cruza por título si hay una única
+    ids_by_title.setdefault(title_key(title), set()).add(page_id)
+
+def get_book_ids_batch(book_titles, notion, NOTION_BOOKS_DATABASE_ID, all_books=None):
+    """
+    Obtener IDs de libros en batch para evitar múltiples consultas.
+
+    Returns:
+        tuple: (clave del título -> conjunto de IDs, clave canónica título+autor -> ID)
+    """
+    ids_by_title = {}
+    ids_by_key = {}
     
-    while has_more:
-        query_params = {
-            "database_id": NOTION_BOOKS_DATABASE_ID,
-            "page_size": 100  # Máximo tamaño de página
-        }
-        if start_cursor:
-            query_params["start_cursor"] = start_cursor
-        
-        response = notion.databases.query(**query_params)
-        all_books.extend(response["results"])
-        has_more = response.get("has_more", False)
-        start_cursor = response.get("next_cursor")
+    # Obtener TODOS los libros con paginación optimizada (salvo que ya vengan descargados)
+    if all_books is None:
+        all_books = get_all_pages(notion, NOTION_BOOKS_DATABASE_ID)
     
-    # Crear cache con títulos originales y normalizados
+    # Crear caches por título y por título+autor
     for page in all_books:
         try:
             title_prop = page["properties"].get("Título", {}).get("title", [])
             if title_prop:
-                title = title_prop[0]["text"]["content"]
-                cache[title] = page["id"]
-                # También guardar versión normalizada para búsqueda flexible
-                cache_normalized[normalize_text(title)] = page["id"]
+                author_prop = page["properties"].get("Autor", {}).get("rich_text", [])
+                author = author_prop[0]["text"]["content"] if author_prop else None
+                add_book_id(ids_by_title, ids_by_key, title_prop[0]["text"]["content"], author, page["id"])
         except (IndexError, KeyError):
             continue
     
-    return cache, cache_normalized
+    return ids_by_title, ids_by_key
+
+def get_annotation_id(page):
+    """ID único (Annotation_ID) de una página de la base de datos de anotaciones, o None"""
+    try:
+        id_prop = page["properties"].get("Annotation_ID", {}).get("rich_text", [])
+        return id_prop[0]["text"]["content"] if id_prop else None
+    except (IndexError, KeyError):
+        return None
 
 def get_existing_annotation_ids(notion, NOTION_ANNOTATIONS_DATABASE_ID):
     """Obtener IDs únicos de anotaciones ya existentes en Notion"""
@@ -345,13 +517,9 @@ def get_existing_annotation_ids(notion, NOTION_ANNOTATIONS_DATABASE_ID):
         response = notion.databases.query(**query_params)
         
         for page in response["results"]:
-            try:
-                # Obtener el ID único de la anotación
-                id_prop = page["properties"].get("Annotation_ID", {}).get("rich_text", [])
-                if id_prop:
-                    existing_ids.add(id_prop[0]["text"]["content"])
-            except (IndexError, KeyError):
-                continue
+            annotation_id = get_annotation_id(page)
+            if annotation_id:
+                existing_ids.add(annotation_id)
         
         has_more = response.get("has_more", False)
         start_cursor = response.get("next_cursor")
@@ -364,7 +532,21 @@ def create_annotation_id(row):
     annotation_data = f"{row['Título']}|{row['Capítulo']}|{row['Texto']}|{row['Progreso del libro']}"
     return hashlib.md5(annotation_data.encode()).hexdigest()
 
-def create_annotations(df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_DATABASE_ID):
+def create_annotations(df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_DATABASE_ID, existing_ids=None,
+                       all_books=None, book_stream=None, budget=None):
+    """
+    Crear en Notion las anotaciones que todavía no existen.
+
+    Args:
+        existing_ids: IDs de anotaciones ya en Notion (si es None se consultan aquí)
+        all_books: Páginas ya descargadas de la base de datos de libros (si es None se descargan aquí)
+        book_stream: BookPageStream por el que llegan los libros que se están creando en paralelo;
+            las anotaciones de un libro que aún no existe esperan a que se publique su id
+        budget: SyncBudget; agotado, las anotaciones pendientes se aplazan (se crean primero las más nuevas)
+
+    Returns:
+        tuple: (anotaciones creadas, anotaciones fallidas, anotaciones aplazadas)
+    """
     # Asegurar que exista el campo Annotation_ID en la base de datos
     required_props = {
         "Annotation_ID": {"rich_text": {}}
@@ -382,8 +564,9 @@ def create_annotations(df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_
         print(f"🔄 Eliminados {duplicates_in_df} duplicados dentro del DataFrame")
     
     # Obtener IDs de anotaciones ya existentes en Notion
-    print("🔍 Verificando anotaciones existentes en Notion...")
-    existing_ids = get_existing_annotation_ids(notion, NOTION_ANNOTATIONS_DATABASE_ID)
+    if existing_ids is None:
+        print("🔍 Verificando anotaciones existentes en Notion...")
+        existing_ids = get_existing_annotation_ids(notion, NOTION_ANNOTATIONS_DATABASE_ID)
     
     # Filtrar solo las anotaciones nuevas (que no existen en Notion)
     df_new = df_unique[~df_unique['Annotation_ID'].isin(existing_ids)]
@@ -392,38 +575,35 @@ def create_annotations(df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_
     
     if len(df_new) == 0:
         print("✅ No hay anotaciones nuevas que procesar")
-        return
+        return 0, 0, 0
 
     # Obtener IDs de libros en batch para eficiencia
-    book_ids_cache, book_ids_normalized = get_book_ids_batch(df_new['Título'].unique(), notion, NOTION_BOOKS_DATABASE_ID)
-    
-    def normalize_text(text):
-        return text.strip().lower() if isinstance(text, str) else ""
+    book_ids_by_title, book_ids_by_key = get_book_ids_batch(df_new['Título'].unique(), notion, NOTION_BOOKS_DATABASE_ID,
+                                                             all_books=all_books)
+    df_new = add_book_key(df_new, 'Título', 'Autor')
+    # Las más nuevas primero: con presupuesto son las que no se aplazan
+    df_new = df_new.sort_values('Fecha de creación', ascending=False, na_position='last', kind='stable')
     
     annotations_created = 0
     annotations_failed = 0
+    annotations_deferred = 0
     
-    # Preparar datos para procesamiento en batch
-    annotations_to_create = []
-    
-    for _, row in df_new.iterrows():
-        # Intentar búsqueda exacta primero
-        book_id = book_ids_cache.get(row['Título'])
-        
-        # Si no encuentra, intentar búsqueda normalizada
-        if not book_id:
-            book_id = book_ids_normalized.get(normalize_text(row['Título']))
-        
-        if not book_id:
-            print(f"⚠️ Libro no encontrado: {row['Título']}")
-            annotations_failed += 1
-            continue
+    def find_book_id(row, title_only=False):
+        # Por clave canónica (título+autor); solo por título si lo permite el llamador y hay una
+        # única página con ese título (si no, podría ser el libro de otro autor)
+        book_id = book_ids_by_key.get(row['book_key'])
+        if book_id is None and title_only:
+            candidates = book_ids_by_title.get(title_key(row['Título']), ())
+            if len(candidates) == 1:
+                book_id = next(iter(candidates))
+        return book_id
 
+    def build_annotation(row, book_id):
         # Limitar texto para evitar errores de Notion
         texto = str(row['Texto'])[:2000] if pd.notna(row['Texto']) else ""
         anotacion = str(row['Anotación'])[:2000] if pd.notna(row['Anotación']) else ""
         
-        annotations_to_create.append({
+        return {
             "parent": {"database_id": NOTION_ANNOTATIONS_DATABASE_ID},
             "properties": {
                 "Texto": {"title": [{"text": {"content": texto}}]},
@@ -435,15 +615,34 @@ def create_annotations(df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_
                 "Libro": {"relation": [{"id": book_id}]},
                 "Annotation_ID": {"rich_text": [{"text": {"content": row['Annotation_ID']}}]}
             }
-        })
+        }
+
+    # Preparar datos para procesamiento en batch; las de libros que aún no existen quedan pendientes
+    annotations_to_create = []
+    pending_rows = []
+    
+    for _, row in df_new.iterrows():
+        # Con book_stream el libro puede estar aún por crear: el cruce por título espera al final
+        book_id = find_book_id(row, title_only=book_stream is None)
+        if book_id:
+            annotations_to_create.append((row['Título'], build_annotation(row, book_id)))
+        elif book_stream is not None:
+            pending_rows.append(row)
+        else:
+            print(f"⚠️ Libro no encontrado: {row['Título']}")
+            annotations_failed += 1
     
     # Crear anotaciones en paralelo con threading (mucho más rápido)
     errors = []  # Almacenar errores para análisis
     
-    if annotations_to_create:
-        print(f"📝 Creando {len(annotations_to_create)} anotaciones en paralelo...")
+    if annotations_to_create or pending_rows:
+        print(f"📝 Creando {len(annotations_to_create)} anotaciones en paralelo"
+              + (f" ({len(pending_rows)} esperan a que se cree su libro)..." if pending_rows else "..."))
         
         def create_annotation(annotation_data):
+            if budget is not None and budget.exhausted():
+                return (None, None)
+
             def _create():
                 return notion.pages.create(**annotation_data)
             
@@ -454,14 +653,46 @@ def create_annotations(df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_
                 return (False, str(e))
         
         with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = [executor.submit(create_annotation, ann) for ann in annotations_to_create]
+            futures = [executor.submit(in_trace_context(create_annotation, book=title), ann)
+                       for title, ann in annotations_to_create]
+            
+            # Las anotaciones pendientes se lanzan en cuanto create_books publica el id de su libro
+            if pending_rows:
+                for title, author, page_id in book_stream.follow():
+                    add_book_id(book_ids_by_title, book_ids_by_key, title, author, page_id)
+                    still_pending = []
+                    for row in pending_rows:
+                        book_id = find_book_id(row)
+                        if book_id:
+                            futures.append(executor.submit(in_trace_context(create_annotation, book=row['Título']),
+                                                           build_annotation(row, book_id)))
+                        else:
+                            still_pending.append(row)
+                    pending_rows = still_pending
+                    if not pending_rows:
+                        break
+                if pending_rows and budget is not None and budget.exhausted():
+                    # Su libro se aplazó: se crearán en la siguiente ejecución
+                    annotations_deferred += len(pending_rows)
+                    pending_rows = []
+                for row in pending_rows:
+                    # Ya existen todos los libros de la ejecución: último intento por título único
+                    book_id = find_book_id(row, title_only=True)
+                    if book_id:
+                        futures.append(executor.submit(in_trace_context(create_annotation, book=row['Título']),
+                                                       build_annotation(row, book_id)))
+                    else:
+                        print(f"⚠️ Libro no encontrado: {row['Título']}")
+                        annotations_failed += 1
             
             # Usar tqdm para mostrar progreso
-            with tqdm(total=len(annotations_to_create), desc="Creando anotaciones", unit="anotación") as pbar:
+            with tqdm(total=len(futures), desc="Creando anotaciones", unit="anotación") as pbar:
                 for future in as_completed(futures):
                     success, error = future.result()
                     if success:
                         annotations_created += 1
+                    elif success is None:
+                        annotations_deferred += 1
                     else:
                         annotations_failed += 1
                         if error and error not in errors:
@@ -484,12 +715,20 @@ def create_annotations(df, notion, NOTION_ANNOTATIONS_DATABASE_ID, NOTION_BOOKS_
             print(f"   {i}. {error[:100]}...")  # Truncar errores largos
         if len(errors) > 3:
             print(f"   ... y {len(errors)-3} tipos más")
+    
+    if annotations_deferred:
+        print(f"⏸️ {annotations_deferred} anotaciones aplazadas hasta la siguiente ejecución")
+        budget.defer("anotaciones", annotations_deferred)
+    return annotations_created, annotations_failed, annotations_deferred
 
+@timed_function("hash", kind="content")
 def create_content_hash(group):
     """Crear hash del contenido de anotaciones para detectar cambios"""
-    content_str = ""
-    for _, row in group.sort_values('Progreso del libro').iterrows():
-        content_str += f"{row['Capítulo']}|{row['Texto']}|{row['Progreso del libro']}|"
+    group = group.sort_values('Progreso del libro')
+    content_str = "".join(
+        f"{capitulo}|{texto}|{progreso}|"
+        for capitulo, texto, progreso in zip(group['Capítulo'], group['Texto'], group['Progreso del libro'])
+    )
     return hashlib.md5(content_str.encode()).hexdigest()
 
 def get_existing_content_hash(notion, book_id):
@@ -502,94 +741,160 @@ def get_existing_content_hash(notion, book_id):
         return ""  # Si no existe el campo o hay error, asume que no hay hash
 
 def update_content_hash(notion, book_id, content_hash):
-    """Actualizar hash en las propiedades del libro"""
-    try:
-        notion.pages.update(
-            page_id=book_id,
-            properties={"Content_Hash": {"rich_text": [{"text": {"content": content_hash}}]}}
-        )
-    except Exception as e:
-        # Si falla (ej: campo no existe), continúa sin el hash
-        pass
+    """Actualizar hash en las propiedades del libro (los errores se propagan: un hash viejo solo obliga a reescribir)"""
+    notion.pages.update(
+        page_id=book_id,
+        properties={"Content_Hash": {"rich_text": [{"text": {"content": content_hash}}]}}
+    )
 
-def clear_book_annotations(notion, book_id):
-    """Limpiar solo las anotaciones del libro, preservando el resumen si existe"""
-    try:
-        # Obtener todos los bloques
-        response = notion.blocks.children.list(block_id=book_id, page_size=100)
-        blocks = response.get('results', [])
-        
-        # Buscar el divisor "--- ANOTACIONES ---" o similar
-        # Todo lo que está después del divisor son anotaciones y se puede borrar
-        # Todo lo que está antes es el resumen y se preserva
-        
-        separator_found = False
-        blocks_to_delete = []
-        
-        for block in blocks:
-            # Buscar el divisor
-            block_type = block.get('type')
-            if block_type == 'divider':
-                separator_found = True
-                blocks_to_delete.append(block['id'])  # También borrar el divisor
-                continue
-            
-            # Si ya encontramos el separador, todo lo demás son anotaciones
-            if separator_found:
-                blocks_to_delete.append(block['id'])
-        
-        # Si no hay separador, borrar todo (comportamiento por defecto)
-        if not separator_found:
-            blocks_to_delete = [block['id'] for block in blocks]
-        
-        # Eliminar bloques en paralelo
-        if blocks_to_delete:
-            def delete_block(block_id):
-                try:
-                    notion.blocks.delete(block_id=block_id)
-                    return True
-                except:
-                    return False
-            
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                futures = [executor.submit(delete_block, bid) for bid in blocks_to_delete]
-                for future in as_completed(futures):
-                    future.result()
-        
+class PageUpdates:
+    """
+    Cambios de propiedades pendientes por página durante una sincronización, para enviar todos
+    los de una página en un único pages.update: create_books deja aquí los datos y el Data_Hash
+    de los libros existentes y create_book_pages los envía junto con el Content_Hash tras
+    reescribir la página. Lo que quede (libros cuya página no se reescribe) se envía con flush_all.
+
+    Los errores no se ocultan: flush lanza la excepción y la página queda en `failed`.
+    """
+
+    def __init__(self, notion):
+        self.notion = notion
+        self.pending = {}
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def add(self, page_id, properties):
+        with self.lock:
+            self.pending.setdefault(page_id, {}).update(properties)
+
+    def flush(self, page_id, properties=None):
+        """Envía lo pendiente de la página junto con `properties` en una sola llamada; devuelve si hubo llamada."""
+        with self.lock:
+            merged = self.pending.pop(page_id, {})
+        if merged and properties:
+            count("page_updates_merged")
+        merged.update(properties or {})
+        if not merged:
+            return False
+        try:
+            retry_api_call(lambda: self.notion.pages.update(page_id=page_id, properties=merged),
+                           max_retries=3, initial_delay=1)
+        except Exception:
+            with self.lock:
+                self.failed.append(page_id)
+            raise
         return True
-    except Exception as e:
-        return False
 
-def clear_book_content(notion, book_id):
-    """Limpiar contenido existente del libro"""
-    try:
-        response = notion.blocks.children.list(block_id=book_id)
-        for block in response['results']:
-            notion.blocks.delete(block['id'])
-    except Exception as e:
-        print(f"⚠️ Error limpiando contenido: {e}")
+    def flush_all(self, max_workers=5):
+        """Envía todo lo pendiente en paralelo; devuelve cuántas páginas fallaron (también en flush anteriores)."""
+        with self.lock:
+            page_ids = list(self.pending)
+
+        def flush_page(page_id):
+            try:
+                self.flush(page_id)
+            except Exception as e:
+                print(f"\n❌ Error actualizando las propiedades de la página {page_id}: {e}")
+
+        if page_ids:
+            print(f"📝 Actualizando propiedades de {len(page_ids)} libros...")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(flush_page, page_ids))
+        return len(self.failed)
+
+def list_block_children(notion, block_id):
+    """Todos los bloques hijos de una página (paginando de 100 en 100)"""
+    blocks = []
+    start_cursor = None
+    while True:
+        params = {"block_id": block_id, "page_size": 100}
+        if start_cursor:
+            params["start_cursor"] = start_cursor
+        response = notion.blocks.children.list(**params)
+        blocks.extend(response.get('results', []))
+        if not response.get('has_more'):
+            return blocks
+        start_cursor = response.get('next_cursor')
+
+def delete_blocks(notion, block_ids, executor=None):
+    """
+    Borrar bloques en paralelo (el orden no importa, a diferencia de los append).
+    Con `executor` se comparte el pool entre libros: los libros largos reparten sus
+    borrados entre todos los hilos en lugar de alargar la cola de uno solo.
+
+    Si algún bloque no se puede borrar se lanza la excepción (tras esperar a los demás): escribir
+    encima dejaría contenido duplicado en la página.
+
+    Returns:
+        int: Bloques borrados
+    """
+    def delete_block(block_id):
+        return retry_api_call(lambda: notion.blocks.delete(block_id=block_id), max_retries=3, initial_delay=1)
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=10) as own_executor:
+            return delete_blocks(notion, block_ids, own_executor)
+    delete_in_context = in_trace_context(delete_block, **current_fields())
+    futures = [executor.submit(delete_in_context, block_id) for block_id in block_ids]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        raise RuntimeError(f"{len(errors)} de {len(block_ids)} bloques sin borrar: {errors[0]}") from errors[0]
+    return len(block_ids)
+
+def clear_book_annotations(notion, book_id, executor=None):
+    """Limpiar solo las anotaciones del libro, preservando el resumen si existe (los errores se propagan)"""
+    # Obtener todos los bloques
+    blocks = list_block_children(notion, book_id)
+    
+    # Buscar el divisor "--- ANOTACIONES ---" o similar
+    # Todo lo que está después del divisor son anotaciones y se puede borrar
+    # Todo lo que está antes es el resumen y se preserva
+    
+    separator_found = False
+    blocks_to_delete = []
+    
+    for block in blocks:
+        # Buscar el divisor
+        block_type = block.get('type')
+        if block_type == 'divider':
+            separator_found = True
+            blocks_to_delete.append(block['id'])  # También borrar el divisor
+            continue
+        
+        # Si ya encontramos el separador, todo lo demás son anotaciones
+        if separator_found:
+            blocks_to_delete.append(block['id'])
+    
+    # Si no hay separador, borrar todo (comportamiento por defecto)
+    if not separator_found:
+        blocks_to_delete = [block['id'] for block in blocks]
+    
+    # Eliminar bloques en paralelo
+    if blocks_to_delete:
+        delete_blocks(notion, blocks_to_delete, executor)
+    
+    return True
+
+def clear_book_content(notion, book_id, executor=None):
+    """Limpiar contenido existente del libro (los errores se propagan: no se escribe encima de lo que quede)"""
+    blocks = list_block_children(notion, book_id)
+    delete_blocks(notion, [block['id'] for block in blocks], executor)
+
+def estimate_page_blocks(group):
+    """Bloques que escribirá create_book_pages para un libro (un párrafo por anotación y un título por capítulo)"""
+    chapters = group['Capítulo'].astype(str)
+    return len(group) + int((chapters != chapters.shift()).sum())
 
 def get_books_info_batch(book_titles, notion, NOTION_BOOKS_DATABASE_ID):
     """Obtener IDs y hashes de contenido de libros en batch para evitar múltiples consultas"""
     books_info = {}
     
     # Obtener todos los libros con paginación optimizada
-    all_books = []
-    has_more = True
-    start_cursor = None
-    
-    while has_more:
-        query_params = {
-            "database_id": NOTION_BOOKS_DATABASE_ID,
-            "page_size": 100  # Máximo tamaño de página
-        }
-        if start_cursor:
-            query_params["start_cursor"] = start_cursor
-        
-        response = notion.databases.query(**query_params)
-        all_books.extend(response["results"])
-        has_more = response.get("has_more", False)
-        start_cursor = response.get("next_cursor")
+    all_books = get_all_pages(notion, NOTION_BOOKS_DATABASE_ID)
     
     for page in all_books:
         try:
@@ -621,7 +926,7 @@ def get_books_info_batch(book_titles, notion, NOTION_BOOKS_DATABASE_ID):
     
     return books_info
 
-def create_book_pages(df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False):
+def create_book_pages(df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False, budget=None, page_updates=None):
     """
     Actualizar contenido de páginas de libros
     
@@ -630,13 +935,22 @@ def create_book_pages(df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False):
         notion: Cliente de Notion
         NOTION_BOOKS_DATABASE_ID: ID de la base de datos
         force_update: Si True, actualiza todos los libros ignorando el hash (excepto los que tienen Resumen="Listo")
+        budget: SyncBudget; agotado, las páginas pendientes se aplazan (primero los libros con
+            anotaciones más recientes)
+        page_updates: PageUpdates con los cambios de create_books, que se envían en la misma llamada
+            que el Content_Hash de cada página reescrita
+
+    Returns:
+        int: Páginas aplazadas por el presupuesto o con error (0 si se procesaron todas)
     """
-    # Agrupar por el título del libro
-    grouped = df.groupby('Título', sort=False)
+    # Agrupar por el título del libro (con Título categórico se agrupa por código; observed evita grupos vacíos)
+    grouped = df.groupby('Título', sort=False, observed=True)
     
     pages_created = 0
     pages_skipped = 0
     pages_updated = 0
+    pages_deferred = 0
+    pages_failed = 0
 
     # Obtener información de todos los libros en una sola consulta (optimización crítica)
     print("🔍 Obteniendo información de libros...")
@@ -674,14 +988,17 @@ def create_book_pages(df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False):
         # Solo procesar si el contenido ha cambiado (o si se fuerza la actualización)
         if not force_update and current_hash == existing_hash:
             return {"status": "skipped", "title": título}
+
+        if budget is not None and budget.exhausted():
+            return {"status": "deferred", "title": título}
         
         try:
             # Si el resumen está "En progreso", solo limpiar las anotaciones (preservar resumen)
             # Si está vacío o en otro estado, limpiar todo
             if resumen_status == "En progreso":
-                clear_book_annotations(notion, book_id)
+                clear_book_annotations(notion, book_id, delete_executor)
             else:
-                clear_book_content(notion, book_id)
+                clear_book_content(notion, book_id, delete_executor)
 
             # Crear contenido estructurado por capítulos
             chapter_blocks = []
@@ -739,10 +1056,14 @@ def create_book_pages(df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False):
                     )
                 retry_api_call(_append, max_retries=3, initial_delay=1)
             
-            # Actualizar hash de contenido
-            def _update_hash():
-                return update_content_hash(notion, book_id, current_hash)
-            retry_api_call(_update_hash, max_retries=3, initial_delay=1)
+            # Actualizar hash de contenido (solo ahora que la página está escrita), junto con los
+            # cambios de create_books pendientes para la misma página
+            if page_updates is not None:
+                page_updates.flush(book_id, {"Content_Hash": {"rich_text": [{"text": {"content": current_hash}}]}})
+            else:
+                def _update_hash():
+                    return update_content_hash(notion, book_id, current_hash)
+                retry_api_call(_update_hash, max_retries=3, initial_delay=1)
             
             if existing_hash:
                 return {"status": "updated", "title": título}
@@ -752,11 +1073,22 @@ def create_book_pages(df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False):
         except Exception as e:
             return {"status": "error", "title": título, "error": str(e)}
     
-    # Procesar LIBROS en paralelo (cada libro se procesa secuencialmente)
-    print(f"📖 Procesando {len(grouped)} libros en paralelo...")
+    # Procesar LIBROS en paralelo (cada libro escribe sus bloques en orden, así que sus append son secuenciales)
+    items = list(grouped)
+    if budget is not None and 'Fecha de creación' in df.columns:
+        # Con presupuesto, primero los libros con las anotaciones más recientes
+        print(f"📖 Procesando {len(grouped)} libros en paralelo (primero los más recientes)...")
+        latest = df.groupby('Título', sort=False, observed=True)['Fecha de creación'].max()
+        items.sort(key=lambda item: "" if pd.isna(latest.get(item[0])) else str(latest.get(item[0])), reverse=True)
+    else:
+        # Sin presupuesto, primero los más largos (LPT): un libro con cientos de subrayados que empieza
+        # al final alarga la ejecución mientras el resto de hilos esperan sin trabajo
+        print(f"📖 Procesando {len(grouped)} libros en paralelo (primero los más largos)...")
+        items.sort(key=lambda item: estimate_page_blocks(item[1]), reverse=True)
     
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(process_single_book, item) for item in grouped]
+    # Los borrados de bloques de todos los libros comparten un pool aparte (no dependen del orden)
+    with ThreadPoolExecutor(max_workers=10) as delete_executor, ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(in_trace_context(process_single_book, book=item[0]), item) for item in items]
         
         # Usar tqdm para mostrar progreso
         with tqdm(total=len(grouped), desc="Procesando libros", unit="libro") as pbar:
@@ -769,10 +1101,20 @@ def create_book_pages(df, notion, NOTION_BOOKS_DATABASE_ID, force_update=False):
                     pages_updated += 1
                 elif result["status"] == "skipped":
                     pages_skipped += 1
+                elif result["status"] == "deferred":
+                    pages_deferred += 1
+                elif result["status"] == "error":
+                    pages_failed += 1
+                    print(f"\n❌ Error actualizando la página de {result['title']}: {result['error']}")
                 
                 pbar.update(1)
 
-    print(f"📚 Páginas procesadas: {pages_created} creadas, {pages_updated} actualizadas, {pages_skipped} sin cambios")
+    print(f"📚 Páginas procesadas: {pages_created} creadas, {pages_updated} actualizadas, {pages_skipped} sin cambios"
+          + (f", {pages_deferred} aplazadas" if pages_deferred else "")
+          + (f", {pages_failed} con error" if pages_failed else ""))
+    if budget is not None:
+        budget.defer("páginas", pages_deferred)
+    return pages_deferred + pages_failed
 
 def split_into_chunks(blocks, max_length):
     """
@@ -525,6 +525,13 @@ class KOReaderCloudSync:
     def execute_main_sync(self):
         """Ejecutar el proceso principal de sincronización"""
         try:
+            # Si hay un daemon en marcha se le pide la sincronización: ya tiene Notion y las cachés en memoria
+            from src.cli import send_daemon_command
+            from src.config import DAEMON_PORT
+            if send_daemon_command("sync", DAEMON_PORT) is not None:
+                self.logger.info("⚡ Sincronización con Notion solicitada al daemon")
+                return
+            
             self.logger.info("⚡ Ejecutando sincronización completa con Notion...")
             
             # Ejecutar main.py
@@ -580,17 +587,18 @@ class KOReaderCloudSync:
         except Exception as e:
             self.logger.error(f"\n❌ Error en el servicio: {e}")
 
-def main():
+def main(argv=None):
     """Función principal"""
     import argparse
     from dotenv import load_dotenv
     
-    parser = argparse.ArgumentParser(description='KOReader Cloud Sync')
+    parser = argparse.ArgumentParser(prog='koboannotations koreader' if argv is not None else None,
+                                     description='KOReader Cloud Sync')
     parser.add_argument('--test', action='store_true', help='Probar conexión y salir')
     parser.add_argument('--sync-once', action='store_true', help='Sincronizar una vez y salir')
     parser.add_argument('--setup', action='store_true', help='Mostrar instrucciones de configuración')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     if args.setup:
         print(KOReaderCloudSync.get_setup_instructions())
@@ -0,0 +1,417 @@
+"""
+Caché de metadatos de EPUB direccionada por contenido.
+
+Cada entrada se identifica por el hash de contenido del fichero (el `content_hash`
+que devuelve Dropbox en el listado, o el mismo hash calculado en local) más su ruta.
+Así una ejecución puede decidir qué descargar solo con el listado de la carpeta,
+sin depender de que el título del OPF coincida con el título del Kobo.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import pandas as pd
+from src.book_keys import canonical_key
+from src.metrics import timed, count
+
+# Versión del esquema de la tabla SQLite de metadatos (PRAGMA user_version)
+METADATA_SCHEMA_VERSION = 2
+
+# Columnas garantizadas en el DataFrame de salida aunque la caché esté vacía
+METADATA_COLUMNS = ['title', 'author', 'publisher', 'language', 'description', 'subjects',
+                    'publication_date', 'pages', 'filename', 'path', 'content_hash']
+
+# Columnas de metadatos con columna propia en la tabla (el resto va a 'extra' en JSON); al añadir
+# una, sube METADATA_SCHEMA_VERSION para que las cachés existentes la creen al abrirse
+STORED_COLUMNS = ['title', 'author', 'publisher', 'language', 'description', 'subjects',
+                  'publication_date', 'pages', 'pages_calc_pr', 'pages_calc', 'extra']
+LIST_COLUMNS = ('subjects',)
+
+# Dropbox calcula el content_hash en bloques de 4 MB
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def compute_content_hash(path):
+    """
+    Calcula el content_hash de un fichero local con el mismo algoritmo que Dropbox:
+    SHA-256 de la concatenación de los SHA-256 de cada bloque de 4 MB.
+    Así los ficheros locales y los de Dropbox comparten claves en la caché.
+    """
+    block_hashes = b""
+    size = 0
+    with timed("hash", kind="epub"), open(path, 'rb') as f:
+        while True:
+            block = f.read(DROPBOX_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            size += len(block)
+            block_hashes += hashlib.sha256(block).digest()
+    count("hash_bytes", size, kind="epub")
+    return hashlib.sha256(block_hashes).hexdigest()
+
+
+def compute_content_hash_bytes(data):
+    """content_hash (algoritmo de Dropbox) de un contenido ya cargado en memoria."""
+    with timed("hash", kind="epub"):
+        block_hashes = b"".join(
+            hashlib.sha256(data[i:i + DROPBOX_HASH_BLOCK_SIZE]).digest()
+            for i in range(0, len(data), DROPBOX_HASH_BLOCK_SIZE)
+        )
+    count("hash_bytes", len(data), kind="epub")
+    return hashlib.sha256(block_hashes).hexdigest()
+
+
+def atomic_write_bytes(path, data):
+    """Escribe un fichero de forma atómica (fichero temporal + rename en el mismo directorio)."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def to_python(value):
+    """Convierte valores de pandas/numpy (NaN, int64...) a tipos serializables en JSON."""
+    if isinstance(value, list):
+        return value
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+class EpubMetadataCache:
+    """
+    Caché persistente de metadatos de EPUB indexada por content_hash, guardada en SQLite.
+
+    Cada EPUB es una fila de la tabla `epub_metadata` (una columna por campo de
+    METADATA_COLUMNS, listas en JSON y cualquier campo adicional en `extra`), así que:
+      - añadir un libro es un INSERT, no reescribir toda la caché;
+      - se pueden leer solo las columnas necesarias (to_dataframe(columns=...));
+      - el esquema se actualiza en el sitio (ALTER TABLE) al añadir columnas nuevas;
+      - los cambios se confirman en una transacción: un corte a mitad de escritura
+        deja la caché en el estado anterior, nunca corrupta.
+    """
+
+    def __init__(self, cache_path="data/epub_metadata_cache.sqlite"):
+        self.cache_path = cache_path
+        directory = os.path.dirname(os.path.abspath(cache_path))
+        os.makedirs(directory, exist_ok=True)
+        # Un proceso de larga duración (modo daemon) la reutiliza desde los hilos de cada etapa, uno a la vez
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.dirty = False
+        self.check_schema()
+        # content_hash -> ruta; basta para planificar sin leer los metadatos
+        self.paths = dict(self.connection.execute("SELECT content_hash, path FROM epub_metadata"))
+        # DataFrames ya leídos por columnas, válidos hasta la siguiente modificación
+        self.frames = {}
+
+    def check_schema(self):
+        """
+        Compara PRAGMA user_version con METADATA_SCHEMA_VERSION al abrir: una caché al día se
+        usa tal cual, una antigua (o nueva, versión 0) se actualiza en el sitio y una escrita
+        por una versión posterior del programa se vacía y se reconstruye.
+        """
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == METADATA_SCHEMA_VERSION:
+            return
+        if version > METADATA_SCHEMA_VERSION:
+            print(f"⚠️ Caché de metadatos con esquema {version} (posterior al {METADATA_SCHEMA_VERSION}), "
+                  f"se reconstruirá.")
+            with self.connection:
+                self.connection.execute("DROP TABLE IF EXISTS epub_metadata")
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        """Crea la tabla o añade en el sitio las columnas que falten (sin perder filas)."""
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS epub_metadata (content_hash TEXT PRIMARY KEY, path TEXT NOT NULL)")
+            existing = {row[1] for row in self.connection.execute("PRAGMA table_info(epub_metadata)")}
+            for column in STORED_COLUMNS:
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE epub_metadata ADD COLUMN "{column}"')
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_epub_metadata_path ON epub_metadata(path)")
+            self.connection.execute(f"PRAGMA user_version = {METADATA_SCHEMA_VERSION}")
+
+    def save(self):
+        """Confirma los cambios pendientes, solo si ha cambiado algo."""
+        if not self.dirty:
+            return
+        self.connection.commit()
+        self.dirty = False
+
+    def close(self):
+        self.connection.close()
+
+    def __contains__(self, content_hash):
+        return content_hash in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, content_hash, path=None):
+        """
+        Devuelve los metadatos de un fichero. Si el contenido ya estaba cacheado con
+        otra ruta (fichero renombrado o movido) se actualiza la ruta sin volver a descargar.
+        """
+        if content_hash not in self.paths:
+            return None
+        if path is not None and self.paths[content_hash] != path:
+            self.connection.execute("UPDATE epub_metadata SET path = ? WHERE content_hash = ?", (path, content_hash))
+            self.paths[content_hash] = path
+            self.dirty = True
+            self.frames = {}
+        row = self.connection.execute(
+            f"SELECT {', '.join(quote(c) for c in STORED_COLUMNS)} FROM epub_metadata WHERE content_hash = ?",
+            (content_hash,)).fetchone()
+        return decode_row(dict(zip(STORED_COLUMNS, row)))
+
+    def put(self, content_hash, path, metadata):
+        """
+        Añade o reemplaza la entrada de un fichero. Si la ruta tenía otro contenido
+        (fichero modificado), la entrada antigua se elimina para no duplicar el libro.
+        """
+        replaced = self.connection.execute("DELETE FROM epub_metadata WHERE path = ? AND content_hash != ?",
+                                           (path, content_hash)).rowcount
+        if replaced:
+            # Solo cuando el fichero ha cambiado: en una importación masiva no se recorre el dict
+            for old_hash in [h for h, p in self.paths.items() if p == path and h != content_hash]:
+                del self.paths[old_hash]
+        values = encode_metadata(metadata)
+        columns = ['content_hash', 'path'] + STORED_COLUMNS
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO epub_metadata ({', '.join(quote(c) for c in columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            [content_hash, path] + [values.get(c) for c in STORED_COLUMNS])
+        self.paths[content_hash] = path
+        self.dirty = True
+        self.frames = {}
+
+    def plan(self, listing):
+        """
+        Decide qué ficheros hay que descargar a partir únicamente del listado.
+
+        Args:
+            listing: Iterable de dicts con al menos 'path' y 'content_hash'.
+
+        Returns:
+            list: Elementos del listado cuyo contenido no está en la caché.
+        """
+        to_fetch = []
+        for item in listing:
+            known_path = self.paths.get(item["content_hash"])
+            if known_path is None:
+                to_fetch.append(item)
+            elif known_path != item["path"]:
+                self.get(item["content_hash"], item["path"])
+        return to_fetch
+
+    def import_legacy(self, legacy_df, listing):
+        """
+        Migra la caché antigua (pickle indexado por título) asociando cada fila a su
+        fichero del listado por nombre, para no volver a descargar lo ya conocido.
+        """
+        if legacy_df is None or legacy_df.empty or 'filename' not in legacy_df.columns:
+            return 0
+        by_name = {os.path.basename(item["path"]).lower(): item for item in listing}
+        imported = 0
+        for record in legacy_df.to_dict('records'):
+            item = by_name.get(str(record.get('filename', '')).lower())
+            if item is None or item["content_hash"] in self:
+                continue
+            metadata = {k: to_python(v) for k, v in record.items() if k != 'filename'}
+            self.put(item["content_hash"], item["path"], metadata)
+            imported += 1
+        return imported
+
+    def import_json(self, json_path):
+        """Migra la caché JSON anterior (mismas claves por content_hash)."""
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        imported = 0
+        for content_hash, entry in data.get("entries", {}).items():
+            if content_hash not in self:
+                self.put(content_hash, entry["path"], entry["metadata"])
+                imported += 1
+        return imported
+
+    def to_dataframe(self, columns=None):
+        """
+        Devuelve las entradas como DataFrame (una fila por fichero).
+
+        Args:
+            columns: Columnas a leer (p. ej. solo las que usa process_data). Por defecto todas.
+        """
+        memo_key = tuple(columns) if columns is not None else None
+        if memo_key in self.frames:
+            return self.frames[memo_key].copy()
+        if columns is None:
+            wanted = METADATA_COLUMNS
+            stored = ['content_hash', 'path'] + STORED_COLUMNS
+        else:
+            wanted = list(columns)
+            stored = [c for c in wanted if c in STORED_COLUMNS or c in ('path', 'content_hash')]
+            if 'filename' in wanted and 'path' not in stored:
+                stored.append('path')
+        select = ', '.join(quote(c) for c in stored) or 'content_hash'
+        with timed("sqlite_query", db="epub_cache"):
+            df = pd.read_sql_query(f"SELECT {select} FROM epub_metadata ORDER BY content_hash", self.connection)
+        count("sqlite_rows", len(df), db="epub_cache")
+
+        for column in LIST_COLUMNS:
+            if column in df.columns:
+                df[column] = df[column].map(lambda v: json.loads(v) if isinstance(v, str) else v)
+        if 'filename' in wanted:
+            df['filename'] = df['path'].map(os.path.basename)
+        if 'extra' in df.columns:
+            extras = pd.DataFrame([json.loads(v) if isinstance(v, str) else {} for v in df.pop('extra')],
+                                  index=df.index)
+            df = pd.concat([df, extras], axis=1)
+        extra_columns = [c for c in df.columns if c not in wanted] if columns is None else []
+        df = df.reindex(columns=wanted + extra_columns)
+        self.frames[memo_key] = df
+        return df.copy()
+
+
+def quote(column):
+    return f'"{column}"'
+
+
+def encode_metadata(metadata):
+    """Convierte un dict de metadatos en los valores de las columnas de la tabla."""
+    values = {}
+    extra = {}
+    for key, value in metadata.items():
+        value = to_python(value)
+        if key in LIST_COLUMNS:
+            values[key] = json.dumps(value, ensure_ascii=False) if value is not None else None
+        elif key in STORED_COLUMNS:
+            values[key] = value
+        elif key not in ('path', 'content_hash', 'filename'):
+            extra[key] = value
+    values['extra'] = json.dumps(extra, ensure_ascii=False) if extra else None
+    return values
+
+
+def decode_row(row):
+    """Inversa de encode_metadata: reconstruye el dict de metadatos de una fila."""
+    metadata = {}
+    for key, value in row.items():
+        if key == 'extra':
+            metadata.update(json.loads(value) if value else {})
+        elif key in LIST_COLUMNS and isinstance(value, str):
+            metadata[key] = json.loads(value)
+        else:
+            metadata[key] = value
+    return metadata
+
+
+def listing_fingerprint(listing):
+    """Huella del estado de una carpeta: cambia si se añade, borra, mueve o modifica algún EPUB."""
+    entries = sorted(f"{item['path']}|{item['content_hash']}" for item in listing)
+    return hashlib.sha256("\n".join(entries).encode('utf-8')).hexdigest()
+
+
+# Versión del formato JSON de la caché de libros sin EPUB
+MISSES_SCHEMA_VERSION = 1
+
+
+class MissingEpubCache:
+    """
+    Caché negativa: libros del Kobo para los que no se encontró EPUB en la carpeta.
+
+    Cada fallo guarda la huella de la carpeta en el momento del fallo. Un libro solo
+    se vuelve a buscar si la carpeta ha cambiado desde entonces o si ha pasado el TTL.
+
+    Formato en disco (JSON):
+        {"schema_version": 1, "folder_fingerprint": ...,
+         "misses": {clave canónica: {"titulo": ..., "autor": ..., "fingerprint": ..., "timestamp": ...}}}
+    """
+
+    def __init__(self, cache_path="data/epub_misses.json", ttl_seconds=7 * 24 * 3600):
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.folder_fingerprint = None
+        self.misses = {}
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def book_key(titulo, autor):
+        return canonical_key(titulo, autor)
+
+    def load(self):
+        """Carga la caché desde disco; si la versión de esquema no coincide, empieza vacía."""
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Caché de libros sin EPUB ilegible ({e}), se reconstruirá.")
+            return
+        if data.get("schema_version") != MISSES_SCHEMA_VERSION:
+            return
+        self.folder_fingerprint = data.get("folder_fingerprint")
+        self.misses = data.get("misses", {})
+
+    def save(self):
+        """Guarda la caché de forma atómica, solo si ha cambiado."""
+        if not self.dirty:
+            return
+        payload = {"schema_version": MISSES_SCHEMA_VERSION, "folder_fingerprint": self.folder_fingerprint,
+                   "misses": self.misses}
+        atomic_write_bytes(self.cache_path, json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+        self.dirty = False
+
+    def is_suppressed(self, titulo, autor, now=None):
+        """True si el libro ya falló con la carpeta en su estado actual y el TTL no ha vencido."""
+        miss = self.misses.get(self.book_key(titulo, autor))
+        if miss is None:
+            return False
+        now = now if now is not None else time.time()
+        if now - miss["timestamp"] >= self.ttl_seconds:
+            return False
+        return miss["fingerprint"] == self.folder_fingerprint
+
+    def set_folder_fingerprint(self, fingerprint):
+        if fingerprint != self.folder_fingerprint:
+            self.folder_fingerprint = fingerprint
+            self.dirty = True
+
+    def record(self, unmatched, now=None):
+        """
+        Sustituye los fallos por los libros (titulo, autor) sin EPUB en esta ejecución.
+        Los libros que ya tienen EPUB desaparecen de la caché.
+        """
+        now = now if now is not None else time.time()
+        misses = {}
+        for titulo, autor in unmatched:
+            key = self.book_key(titulo, autor)
+            previous = self.misses.get(key)
+            if (previous and previous["fingerprint"] == self.folder_fingerprint
+                    and now - previous["timestamp"] < self.ttl_seconds):
+                # Mismo estado de carpeta: conservar el instante del fallo para que el TTL siga corriendo
+                misses[key] = previous
+            else:
+                misses[key] = {"titulo": titulo, "autor": autor,
+                               "fingerprint": self.folder_fingerprint, "timestamp": now}
+        if misses != self.misses:
+            self.misses = misses
+            self.dirty = True
+
+    def __len__(self):
+        return len(self.misses)
@@ -0,0 +1,229 @@
+"""
+Métricas ligeras de los puntos calientes de la sincronización.
+
+Un registro global (`registry`) acumula contadores (llamadas, reintentos, bytes...) y
+tiempos (número, suma y máximo) por nombre y etiquetas. Registrar una medida es una
+suma bajo un lock, así que puede dejarse activado siempre. Al terminar cada ejecución
+se vuelca a un informe JSON (más una línea resumida en un histórico JSONL, para graficar
+el coste de la sincronización en el tiempo) y a un fichero en formato texto de Prometheus,
+apto para el textfile collector de node_exporter.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = "kobo_sync"
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Metrics:
+    """Registro de contadores y tiempos, seguro entre hilos."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+            self.started_at = time.time()
+
+    def count(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """
+        Mide el bloque; si lanza una excepción se registra con la etiqueta error (el código
+        HTTP si la excepción lo trae, p. ej. 429, o si no el tipo de la excepción).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            error = getattr(e, "status", None) or type(e).__name__
+            self.observe(name, time.perf_counter() - start, **labels, error=error)
+            raise
+        self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """Copia del registro como dict serializable."""
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            timers = [{"name": name, "labels": dict(labels), "count": count,
+                       "sum_seconds": round(total, 6), "max_seconds": round(maximum, 6)}
+                      for (name, labels), (count, total, maximum) in sorted(self.timers.items())]
+        return {"started_at": self.started_at, "counters": counters, "timers": timers}
+
+    def to_prometheus(self, extra_gauges=None):
+        """Texto en formato de exposición de Prometheus (contadores *_total y tiempos *_seconds)."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def add(metric, kind, samples):
+            if not samples:
+                return
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.extend(f"{metric}{format_labels(labels)} {value}" for labels, value in samples)
+
+        for name in sorted({counter["name"] for counter in snapshot["counters"]}):
+            add(f"{PROMETHEUS_PREFIX}_{name}_total", "counter",
+                [(c["labels"], c["value"]) for c in snapshot["counters"] if c["name"] == name])
+        for name in sorted({timer["name"] for timer in snapshot["timers"]}):
+            timers = [t for t in snapshot["timers"] if t["name"] == name]
+            metric = f"{PROMETHEUS_PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for timer in timers:
+                lines.append(f"{metric}_count{format_labels(timer['labels'])} {timer['count']}")
+                lines.append(f"{metric}_sum{format_labels(timer['labels'])} {timer['sum_seconds']}")
+            add(f"{metric}_max", "gauge", [(t["labels"], t["max_seconds"]) for t in timers])
+        for name, value in (extra_gauges or {}).items():
+            add(f"{PROMETHEUS_PREFIX}_{name}", "gauge", [({}, value)])
+        return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in sorted(labels.items())) + "}"
+
+
+# Registro del proceso: los módulos instrumentados escriben aquí
+registry = Metrics()
+
+
+def count(name, value=1, **labels):
+    registry.count(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    registry.observe(name, seconds, **labels)
+
+
+def timed(name, **labels):
+    return registry.timed(name, **labels)
+
+
+def timed_function(name, **labels):
+    """Decorador que mide cada llamada a la función."""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with registry.timed(name, **labels):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+class InstrumentedClient:
+    """
+    Envuelve un cliente de API (notion_client.Client, dropbox.Dropbox) y mide cada
+    llamada a sus endpoints como api_request{service, endpoint}. Los grupos de endpoints
+    del propio paquete (p. ej. notion.databases, notion.blocks.children) se envuelven
+    a su vez, así que el código que usa el cliente no cambia.
+    """
+
+    def __init__(self, client, service, prefix=""):
+        self._client = client
+        self._service = service
+        self._prefix = prefix
+        self._package = type(client).__module__.split(".")[0]
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        endpoint = f"{self._prefix}{name}"
+        if callable(value):
+            service = self._service
+
+            def call(*args, **kwargs):
+                with registry.timed("api_request", service=service, endpoint=endpoint):
+                    return value(*args, **kwargs)
+            return call
+        if type(value).__module__.split(".")[0] == self._package:
+            return InstrumentedClient(value, self._service, prefix=f"{endpoint}.")
+        return value
+
+
+def instrument_client(client, service):
+    """Devuelve el cliente envuelto para registrar latencia y errores de cada endpoint."""
+    return InstrumentedClient(client, service)
+
+
+# Campos del informe que se copian tal cual en la línea del histórico
+HISTORY_FIELDS = ("finished_at", "duration_seconds", "status", "force", "wall_seconds")
+
+
+def history_summary(report):
+    """
+    Línea del histórico: estado, duración, segundos de cada etapa y llamadas por servicio.
+    El informe completo (todas las series de métricas) solo se guarda en last_run.json, así
+    que el histórico crece unos cientos de bytes por ejecución.
+    """
+    summary = {field: report[field] for field in HISTORY_FIELDS if field in report}
+    if "stages" in report:
+        summary["stages"] = {stage["stage"]: stage["seconds"] for stage in report["stages"]}
+    calls = {}
+    for timer in report["timers"]:
+        if timer["name"] == "api_request":
+            service = timer["labels"].get("service", "")
+            calls[service] = calls.get(service, 0) + timer["count"]
+    summary["api_calls"] = calls
+    return summary
+
+
+def write_reports(directory, extra=None):
+    """
+    Vuelca las métricas de la ejecución:
+      - last_run.json: informe completo de la última ejecución.
+      - history.jsonl: una línea resumida por ejecución (ver history_summary).
+      - kobo_sync.prom: formato texto de Prometheus.
+
+    Args:
+        directory: Carpeta de salida (se crea si no existe).
+        extra: Datos adicionales del informe (p. ej. tiempos por etapa y estado final).
+    """
+    # Importación diferida: metadata_cache se instrumenta con este módulo
+    from src.metadata_cache import atomic_write_bytes
+
+    os.makedirs(directory, exist_ok=True)
+    report = {**registry.snapshot(), "finished_at": time.time(), **(extra or {})}
+    report["duration_seconds"] = round(report["finished_at"] - report["started_at"], 3)
+
+    data = json.dumps(report, ensure_ascii=False, indent=2, default=str)
+    atomic_write_bytes(os.path.join(directory, "last_run.json"), data.encode('utf-8'))
+    with open(os.path.join(directory, "history.jsonl"), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(history_summary(report), ensure_ascii=False, default=str) + "\n")
+
+    gauges = {"last_run_timestamp_seconds": round(report["finished_at"], 3),
+              "last_run_duration_seconds": report["duration_seconds"],
+              "last_run_success": int(report.get("status", "ok") == "ok")}
+    prometheus = registry.to_prometheus(gauges)
+    atomic_write_bytes(os.path.join(directory, "kobo_sync.prom"), prometheus.encode('utf-8'))
+    return report
@@ -5,19 +5,22 @@ Incluye funciones para eliminar duplicados y limpiar completamente las bases de
 from notion_client import Client
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from src.book_keys import canonical_key, exact_key
 
 
 def remove_duplicate_books(notion, database_id):
     """
     Elimina libros duplicados de la base de datos de Notion.
-    Mantiene solo la primera ocurrencia de cada libro (por título + autor).
+    Mantiene solo la primera ocurrencia de cada libro. Solo se archivan las páginas cuyo
+    título y autor coinciden literalmente con los de la que se conserva (exact_key); las que
+    solo coinciden tras normalizar (tildes, puntuación...) se listan pero no se tocan.
     
     Args:
         notion: Cliente de Notion
         database_id: ID de la base de datos de libros
     
     Returns:
-        dict: Estadísticas de la operación (total, duplicados, eliminados)
+        dict: Estadísticas de la operación (total, duplicados, eliminados y posibles duplicados no archivados)
     """
     print("🔍 Buscando libros duplicados en Notion...")
     
@@ -44,9 +47,7 @@ def remove_duplicate_books(notion, database_id):
     # Detectar duplicados
     seen_books = {}
     duplicates = []
-    
-    def normalize_text(text):
-        return text.strip().lower() if isinstance(text, str) else ""
+    near_duplicates = []
     
     for page in all_books:
         try:
@@ -55,31 +56,34 @@ def remove_duplicate_books(notion, database_id):
                 author = page["properties"]["Autor"]["rich_text"]
                 
                 if title and author:
-                    book_key = (
-                        normalize_text(title[0]["text"]["content"]),
-                        normalize_text(author[0]["text"]["content"])
-                    )
+                    title_text, author_text = title[0]["text"]["content"], author[0]["text"]["content"]
+                    book_key = canonical_key(title_text, author_text)
                     
                     if book_key in seen_books:
-                        duplicates.append({
-                            "id": page["id"],
-                            "title": title[0]["text"]["content"],
-                            "author": author[0]["text"]["content"]
-                        })
+                        kept_id, kept_exact = seen_books[book_key]
+                        duplicate = {"id": page["id"], "title": title_text, "author": author_text, "kept": kept_id}
+                        if exact_key(title_text, author_text) == kept_exact:
+                            duplicates.append(duplicate)
+                        else:
+                            near_duplicates.append(duplicate)
                     else:
-                        seen_books[book_key] = page["id"]
+                        seen_books[book_key] = (page["id"], exact_key(title_text, author_text))
         except (IndexError, KeyError, TypeError):
             continue
     
+    if near_duplicates:
+        print(f"\n⚠️  {len(near_duplicates)} libros parecen duplicados pero su título o autor no es idéntico; "
+              f"no se archivan:")
+        for dup in near_duplicates:
+            print(f"   - {dup['title']} - {dup['author']} ({dup['id']}), se conserva {dup['kept']}")
+
     if not duplicates:
         print("✅ No se encontraron duplicados.")
-        return {"total": len(all_books), "duplicates": 0, "deleted": 0}
+        return {"total": len(all_books), "duplicates": 0, "deleted": 0, "near_duplicates": len(near_duplicates)}
     
-    print(f"\n⚠️  Se encontraron {len(duplicates)} libros duplicados:")
-    for i, dup in enumerate(duplicates[:5], 1):
-        print(f"   {i}. {dup['title']} - {dup['author']}")
-    if len(duplicates) > 5:
-        print(f"   ... y {len(duplicates) - 5} más")
+    print(f"\n⚠️  Se encontraron {len(duplicates)} libros duplicados (se archivarán):")
+    for i, dup in enumerate(duplicates, 1):
+        print(f"   {i}. {dup['title']} - {dup['author']} ({dup['id']}), se conserva {dup['kept']}")
     
     # Eliminar duplicados en paralelo con alta concurrencia
     deleted_count = 0
@@ -107,7 +111,8 @@ def remove_duplicate_books(notion, database_id):
     return {
         "total": len(all_books),
         "duplicates": len(duplicates),
-        "deleted": deleted_count
+        "deleted": deleted_count,
+        "near_duplicates": len(near_duplicates)
     }
 
 
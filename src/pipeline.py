@@ -0,0 +1,373 @@
+"""
+Pipeline de sincronización como un pequeño grafo de etapas con caché en disco.
+
+Cada etapa declara de qué etapas depende y, opcionalmente, una huella externa
+(p. ej. el mtime de la BBDD del Kobo o la última edición en Notion). La clave de una
+etapa combina su nombre, su versión, los hashes de las salidas de sus dependencias
+y su huella externa; si coincide con la de la última ejecución, la salida se carga
+del disco y la etapa no se ejecuta.
+
+Con `parallel=True` cada etapa corre en su propio hilo en cuanto sus dependencias están
+listas, así que las etapas de E/S independientes (Kobo, Dropbox, lecturas de Notion) se
+solapan y la duración total se acerca a la de la rama más lenta en lugar de a la suma.
+"""
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import Future
+import pandas as pd
+from src.metadata_cache import atomic_write_bytes
+from src.metrics import observe
+
+MANIFEST_SCHEMA_VERSION = 1
+
+
+class Stage:
+    """
+    Etapa del pipeline.
+
+    Args:
+        name: Nombre único de la etapa.
+        func: Función que recibe las salidas de las dependencias (en orden) y devuelve su salida.
+        inputs: Nombres de las etapas de las que depende.
+        fingerprint: Función sin argumentos con la huella del estado externo que lee o escribe.
+        cache: Si es False la etapa se ejecuta siempre (su salida sigue protegiendo a las siguientes).
+        version: Cambiarla invalida la caché de la etapa (p. ej. al cambiar su lógica).
+        untracked: Dependencias que se pasan a `func` pero no forman parte de la clave (instantáneas
+            cuyo estado ya cubre la huella externa). Solo se piden si la etapa tiene que ejecutarse;
+            en paralelo, si la huella externa ya lo asegura, se piden al arrancar la etapa.
+        lazy: Si es True la etapa solo se ejecuta cuando otra la necesita.
+        on_done: Función sin argumentos que se llama al terminar la etapa (ejecutada, de caché o con error).
+        cache_if: Función que recibe la salida y decide si puede reutilizarse en la siguiente ejecución.
+    """
+
+    def __init__(self, name, func, inputs=(), fingerprint=None, cache=True, version=1,
+                 untracked=(), lazy=False, on_done=None, cache_if=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.fingerprint = fingerprint
+        self.cache = cache
+        self.version = version
+        self.untracked = tuple(untracked)
+        self.lazy = lazy
+        self.on_done = on_done
+        self.cache_if = cache_if
+
+    @property
+    def tracked(self):
+        return tuple(name for name in self.inputs if name not in self.untracked)
+
+    def external_fingerprint(self):
+        return self.fingerprint() if self.fingerprint else None
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_output(output):
+    """
+    Hash del contenido de una salida. Los DataFrames se serializan a JSON (admite listas
+    en las celdas y no depende de cómo pickle comparta objetos en memoria).
+    """
+    if isinstance(output, pd.DataFrame):
+        data = output.to_json(orient='split', date_format='iso', default_handler=str) + str(output.dtypes.to_dict())
+        return hash_bytes(data.encode('utf-8'))
+    if isinstance(output, (tuple, list)):
+        return hash_bytes("".join(hash_output(item) for item in output).encode('utf-8'))
+    return hash_bytes(pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def stage_key(stage, input_hashes, external):
+    payload = json.dumps({"stage": stage.name, "version": stage.version,
+                          "inputs": input_hashes, "external": external},
+                         sort_keys=True, default=str)
+    return hash_bytes(payload.encode('utf-8'))
+
+
+def external_key(stage, external):
+    """Hash de la huella externa (y la versión): si cambia, la etapa se ejecutará seguro."""
+    payload = json.dumps({"version": stage.version, "external": external}, sort_keys=True, default=str)
+    return hash_bytes(payload.encode('utf-8'))
+
+
+class PipelineAborted(Exception):
+    """Una etapa no llegó a ejecutarse porque otra falló antes."""
+
+
+class Pipeline:
+    """
+    Ejecuta las etapas en orden topológico (o en paralelo según se resuelven sus
+    dependencias), memoizando en `cache_dir` la salida de cada una (pickle) y un
+    manifiesto con su clave y el hash de su salida.
+
+    La huella externa de una etapa se toma justo antes de ejecutarla: lo que cambie
+    después (sus propias escrituras o una edición del usuario durante la ejecución)
+    invalida su caché y la siguiente ejecución la repite.
+
+    Args:
+        cache_dir: Carpeta de la caché en disco.
+        memory: Dict compartido entre ejecuciones del mismo proceso (modo daemon) con la
+            última salida de cada etapa y su hash; una etapa de caché cuya salida sigue en
+            memoria no se vuelve a leer del disco.
+    """
+
+    def __init__(self, cache_dir="data/pipeline_cache", memory=None):
+        self.cache_dir = cache_dir
+        self.memory = memory
+        self.stages = {}
+        self.timings = []
+        self.wall_time = 0.0
+        self.invalidated = set()
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f"Etapa duplicada: {stage.name}")
+        missing = [name for name in stage.inputs if name not in self.stages]
+        if missing:
+            raise ValueError(f"La etapa '{stage.name}' depende de etapas no definidas: {missing}")
+        if not set(stage.untracked) <= set(stage.inputs):
+            raise ValueError(f"La etapa '{stage.name}' marca como no rastreadas etapas que no son dependencias")
+        self.stages[stage.name] = stage
+        return stage
+
+    def invalidate(self, name):
+        """
+        Descarta la caché de una etapa ya terminada de la ejecución en curso, p. ej. cuando
+        otra posterior no pudo completar el trabajo que aquella dejó pendiente: se aplica al
+        terminar la ejecución y la siguiente repite la etapa.
+        """
+        self.invalidated.add(name)
+
+    def manifest_path(self):
+        return os.path.join(self.cache_dir, "manifest.json")
+
+    def output_path(self, name):
+        return os.path.join(self.cache_dir, f"{name}.pkl")
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path(), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("schema_version") != MANIFEST_SCHEMA_VERSION:
+            return {}
+        return manifest.get("stages", {})
+
+    def save_manifest(self, stages):
+        payload = {"schema_version": MANIFEST_SCHEMA_VERSION, "stages": stages}
+        atomic_write_bytes(self.manifest_path(), json.dumps(payload, indent=2).encode('utf-8'))
+
+    def load_output(self, name, output_hash=None):
+        if self.memory is not None:
+            remembered = self.memory.get(name)
+            if remembered is not None and remembered[0] == output_hash:
+                return remembered[1]
+        with open(self.output_path(name), 'rb') as f:
+            output = pickle.load(f)
+        self.remember(name, output_hash, output)
+        return output
+
+    def remember(self, name, output_hash, output):
+        if self.memory is not None and output_hash is not None:
+            self.memory[name] = (output_hash, output)
+
+    def run(self, force=False, parallel=False):
+        """
+        Ejecuta el pipeline.
+
+        Args:
+            force: Si es True se ignora la caché y se ejecutan todas las etapas.
+            parallel: Si es True cada etapa arranca en su propio hilo en cuanto tiene sus dependencias.
+
+        Returns:
+            dict: Salida de cada etapa que ha llegado a evaluarse (las perezosas no necesarias no aparecen).
+        """
+        manifest = self.load_manifest()
+        lock = threading.Lock()
+        aborted = threading.Event()
+        futures = {}
+        outputs = {}
+        output_hashes = {}
+        self.timings = []
+        self.invalidated = set()
+        run_start = time.perf_counter()
+
+        def start(name):
+            with lock:
+                if name in futures:
+                    return futures[name]
+                future = futures[name] = Future()
+            if parallel:
+                threading.Thread(target=evaluate, args=(self.stages[name], future),
+                                 name=f"etapa-{name}", daemon=True).start()
+            else:
+                evaluate(self.stages[name], future)
+            return future
+
+        def get(name):
+            return start(name).result()
+
+        def get_hash(name):
+            output = get(name)
+            with lock:
+                if name in output_hashes:
+                    return output_hashes[name]
+            digest = hash_output(output)
+            with lock:
+                if name not in output_hashes and not self.stages[name].cache:
+                    # Solo el hash (sin la salida): plan() lo usa para prever las etapas siguientes
+                    manifest[name] = {"output_hash": digest, "timestamp": time.time()}
+                    self.save_manifest(manifest)
+                return output_hashes.setdefault(name, digest)
+
+        def execute(stage):
+            # La huella externa se toma al arrancar, antes de esperar a las dependencias y de escribir
+            external = stage.external_fingerprint()
+            with lock:
+                previous = manifest.get(stage.name)
+            if parallel and stage.untracked and (force or not stage.cache or previous is None
+                                                 or previous.get("external") != external_key(stage, external)):
+                # Se ejecutará seguro: sus lecturas no rastreadas se solapan ya con las dependencias
+                for name in stage.untracked:
+                    start(name)
+            input_hashes = [get_hash(name) for name in stage.tracked]
+            if aborted.is_set():
+                raise PipelineAborted(stage.name)
+            start_time = time.perf_counter()
+            key = stage_key(stage, input_hashes, external)
+
+            if not force and stage.cache and previous and previous.get("key") == key:
+                try:
+                    output = self.load_output(stage.name, previous["output_hash"])
+                    with lock:
+                        output_hashes[stage.name] = previous["output_hash"]
+                    return output, "caché", start_time
+                except Exception as e:
+                    print(f"⚠️ Caché de la etapa '{stage.name}' ilegible ({e}), se vuelve a ejecutar.")
+
+            # Las dependencias no rastreadas (p. ej. instantáneas de Notion) solo se piden ahora
+            inputs = [get(name) for name in stage.inputs]
+            output = stage.func(*inputs)
+            if stage.cache and (stage.cache_if is None or stage.cache_if(output)):
+                data = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+                atomic_write_bytes(self.output_path(stage.name), data)
+                digest = hash_output(output)
+                with lock:
+                    output_hashes[stage.name] = digest
+                    manifest[stage.name] = {"key": key, "external": external_key(stage, external),
+                                            "output_hash": digest, "timestamp": time.time()}
+                    self.save_manifest(manifest)
+                    self.remember(stage.name, digest, output)
+            elif stage.cache:
+                # Resultado incompleto: la siguiente ejecución tiene que repetir la etapa
+                with lock:
+                    if manifest.pop(stage.name, None) is not None:
+                        self.save_manifest(manifest)
+            return output, "ejecutada", start_time
+
+        def evaluate(stage, future):
+            try:
+                output, status, start_time = execute(stage)
+            except BaseException as e:
+                if not isinstance(e, PipelineAborted):
+                    aborted.set()
+                error = e
+            else:
+                error = None
+                seconds = time.perf_counter() - start_time
+                observe("stage", seconds, stage=stage.name, status=status)
+                with lock:
+                    outputs[stage.name] = output
+                    self.timings.append((stage.name, status, start_time - run_start, seconds))
+            # Antes de publicar el resultado: run() no aplica las invalidaciones hasta que terminan los on_done
+            try:
+                if stage.on_done:
+                    stage.on_done()
+            finally:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(output)
+
+        # Las etapas se añaden después de sus dependencias, así que el orden de inserción es topológico
+        for name, stage in self.stages.items():
+            if not stage.lazy:
+                start(name)
+
+        error = None
+        for name in self.stages:
+            with lock:
+                future = futures.get(name)
+            if future is None:
+                continue
+            exception = future.exception()
+            if exception is not None and (error is None or isinstance(error, PipelineAborted)):
+                error = exception
+        self.timings.sort(key=lambda timing: timing[2])
+        self.wall_time = time.perf_counter() - run_start
+
+        # Etapas que otras dieron por incompletas durante la ejecución (ver invalidate)
+        invalidated = [name for name in self.invalidated if manifest.pop(name, None) is not None]
+        if invalidated:
+            self.save_manifest(manifest)
+
+        if error is not None:
+            raise error
+        return outputs
+
+    def plan(self):
+        """
+        Prevé qué haría run() sin ejecutar ninguna etapa (solo calcula las huellas externas).
+
+        Las etapas sin caché se suponen con la misma salida que en la última ejecución, y una
+        etapa cuyas dependencias vayan a ejecutarse queda pendiente de lo que estas devuelvan.
+
+        Returns:
+            list: Tuplas (etapa, estado, detalle) con estado 'caché', 'ejecutar', 'siempre',
+                'depende' (detalle: etapas de las que depende) o 'bajo demanda'.
+        """
+        manifest = self.load_manifest()
+        known_hashes = {}
+        plan = []
+        for name, stage in self.stages.items():
+            previous = manifest.get(name, {})
+            unknown = [dependency for dependency in stage.tracked if known_hashes.get(dependency) is None]
+            if stage.lazy:
+                plan.append((name, "bajo demanda", None))
+            elif not stage.cache:
+                known_hashes[name] = previous.get("output_hash")
+                plan.append((name, "siempre", None))
+            elif unknown:
+                plan.append((name, "depende", unknown))
+            else:
+                key = stage_key(stage, [known_hashes[dependency] for dependency in stage.tracked],
+                                stage.external_fingerprint())
+                if previous.get("key") == key:
+                    known_hashes[name] = previous["output_hash"]
+                    plan.append((name, "caché", None))
+                else:
+                    plan.append((name, "ejecutar", None))
+        return plan
+
+    def report(self):
+        """Imprime el tiempo de cada etapa de la última ejecución."""
+        print("\n⏱️ Tiempos por etapa:")
+        for name, status, offset, seconds in self.timings:
+            print(f"   {name:<16} {status:<10} +{offset:7.2f} s {seconds:8.2f} s")
+        print(f"   {'total':<16} {'':<10} {'':<10} {self.wall_time:8.2f} s "
+              f"(suma de etapas {sum(timing[3] for timing in self.timings):.2f} s)")
+
+
+def file_fingerprint(path):
+    """Huella barata de un fichero: tamaño y fecha de modificación (None si no existe)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,355 @@
+"""
+Ficheros remotos de solo lectura con acceso aleatorio mediante peticiones HTTP Range.
+
+Permiten abrir un EPUB con zipfile sin descargarlo entero: zipfile solo lee el
+directorio central (al final del fichero) y las entradas que se le piden
+(container.xml, OPF, ToC...), así que basta con traer esos rangos de bytes.
+"""
+import io
+import json
+import os
+import struct
+import zlib
+import requests
+from src.metrics import timed, count
+from src.tracing import trace_request
+
+DROPBOX_DOWNLOAD_URL = "https://content.dropboxapi.com/2/files/download"
+
+
+class RangeFile(io.RawIOBase):
+    """
+    Fichero de solo lectura que obtiene los bytes bajo demanda en bloques.
+
+    Las subclases implementan `fetch_range(start, end)` (ambos inclusive). Los bloques
+    leídos se guardan en memoria, de forma que releer el directorio central del zip o
+    cabeceras ya vistas no genera nuevas peticiones.
+    """
+
+    def __init__(self, size=None, block_size=64 * 1024):
+        super().__init__()
+        self.block_size = block_size
+        self.blocks = {}
+        self.position = 0
+        self.bytes_fetched = 0
+        self.requests_made = 0
+        self.size = size if size is not None else self.fetch_size()
+
+    def fetch_range(self, start, end):
+        """Devuelve los bytes [start, end] del fichero."""
+        raise NotImplementedError
+
+    def fetch_size(self):
+        """Obtiene el tamaño total del fichero cuando no se conoce de antemano."""
+        raise NotImplementedError
+
+    def close(self):
+        # Libera los bloques descargados aunque quede alguna referencia al fichero
+        self.blocks = {}
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"whence no válido: {whence}")
+        if position < 0:
+            raise ValueError("Posición negativa en seek")
+        self.position = position
+        return self.position
+
+    def load_blocks(self, first, last):
+        """Descarga, en una sola petición por tramo contiguo, los bloques que faltan."""
+        missing = [i for i in range(first, last + 1) if i not in self.blocks]
+        while missing:
+            run_start = missing[0]
+            run_end = run_start
+            while run_end + 1 in missing:
+                run_end += 1
+            start = run_start * self.block_size
+            end = min((run_end + 1) * self.block_size, self.size) - 1
+            data = self.fetch_range(start, end)
+            self.requests_made += 1
+            self.bytes_fetched += len(data)
+            for i in range(run_start, run_end + 1):
+                offset = (i - run_start) * self.block_size
+                self.blocks[i] = data[offset:offset + self.block_size]
+            missing = [i for i in missing if i > run_end]
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+
+        first = self.position // self.block_size
+        last = (self.position + length - 1) // self.block_size
+        self.load_blocks(first, last)
+
+        data = b"".join(self.blocks[i] for i in range(first, last + 1))
+        offset = self.position - first * self.block_size
+        chunk = data[offset:offset + length]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+
+class LocalRangeFile(RangeFile):
+    """RangeFile respaldado por un fichero local (útil para pruebas y para discos montados)."""
+
+    def __init__(self, path, block_size=64 * 1024):
+        self.path = path
+        self.file = open(path, 'rb')
+        super().__init__(size=os.path.getsize(path), block_size=block_size)
+
+    def fetch_range(self, start, end):
+        self.file.seek(start)
+        return self.file.read(end - start + 1)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+class HTTPRangeFile(RangeFile):
+    """
+    RangeFile sobre cualquier servidor HTTP que soporte cabeceras Range.
+
+    Args:
+        url: URL del fichero.
+        size: Tamaño en bytes si ya se conoce (evita una petición extra).
+        session: requests.Session para reutilizar conexiones.
+        method: Método HTTP ('GET' o 'POST', Dropbox usa POST).
+        headers: Cabeceras adicionales para cada petición.
+        budget: Límite de bytes en vuelo compartido entre hilos (acquire/release), al que
+            cada petición carga solo los bytes del rango que pide.
+    """
+
+    # Etiquetas de las métricas de cada petición
+    service = "http"
+    endpoint = "range"
+
+    def __init__(self, url, size=None, session=None, method='GET', headers=None, block_size=64 * 1024,
+                 budget=None):
+        self.url = url
+        self.budget = budget
+        self.target = url
+        # La sesión solo se cierra con el fichero si la hemos creado aquí
+        self.own_session = session is None
+        self.session = session or requests.Session()
+        self.method = method
+        self.headers = headers or {}
+        super().__init__(size=size, block_size=block_size)
+
+    def close(self):
+        if not self.closed and self.own_session:
+            self.session.close()
+        super().close()
+
+    def request_range(self, range_header, length):
+        if self.budget is None:
+            return self.send_range_request(range_header)
+        self.budget.acquire(length)
+        try:
+            return self.send_range_request(range_header)
+        finally:
+            self.budget.release(length)
+
+    def send_range_request(self, range_header):
+        with timed("api_request", service=self.service, endpoint=self.endpoint), \
+                trace_request(self.service, self.endpoint, target=self.target) as info:
+            response = self.session.request(self.method, self.url,
+                                            headers={**self.headers, "Range": range_header},
+                                            timeout=60)
+            info["status"] = response.status_code
+            info["response_bytes"] = len(response.content)
+        count("api_bytes", len(response.content), service=self.service, endpoint=self.endpoint)
+        if response.status_code not in (200, 206):
+            raise IOError(f"Error {response.status_code} pidiendo {range_header}: {response.text[:200]}")
+        return response
+
+    def fetch_range(self, start, end):
+        response = self.request_range(f"bytes={start}-{end}", end - start + 1)
+        if response.status_code == 200:
+            # El servidor ignoró el Range y devolvió el fichero completo
+            return response.content[start:end + 1]
+        return response.content
+
+    def fetch_size(self):
+        # Pedimos el último bloque: así obtenemos el tamaño (Content-Range) y, de paso,
+        # el directorio central del zip, que es lo primero que lee zipfile
+        response = self.request_range(f"bytes=-{self.block_size}", self.block_size)
+        self.requests_made += 1
+        self.bytes_fetched += len(response.content)
+        if response.status_code == 200:
+            size = len(response.content)
+            tail = response.content
+        else:
+            size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+            tail = response.content
+        tail_start = size - len(tail)
+        # Guardar solo los bloques completos contenidos en la cola descargada
+        first = -(-tail_start // self.block_size)
+        last_block = (size - 1) // self.block_size
+        for i in range(first, last_block + 1):
+            offset = i * self.block_size - tail_start
+            self.blocks[i] = tail[offset:offset + self.block_size]
+        return size
+
+
+class DropboxRangeFile(HTTPRangeFile):
+    """
+    RangeFile sobre el endpoint de descarga de Dropbox (/2/files/download admite Range).
+
+    Args:
+        access_token: Token de acceso de Dropbox.
+        path: Ruta del fichero en Dropbox.
+        size: Tamaño del fichero (FileMetadata.size del listado de la carpeta).
+    """
+
+    service = "dropbox"
+    endpoint = "files/download"
+
+    def __init__(self, access_token, path, size=None, session=None, block_size=64 * 1024,
+                 url=DROPBOX_DOWNLOAD_URL, budget=None):
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Dropbox-API-Arg": json.dumps({"path": path}),
+        }
+        super().__init__(url, size=size, session=session, method='POST', headers=headers,
+                         block_size=block_size, budget=budget)
+        self.target = path
+
+
+DROPBOX_DOWNLOAD_ZIP_URL = "https://content.dropboxapi.com/2/files/download_zip"
+
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+
+class StreamReader:
+    """Lectura secuencial de un stream no posicionable con posibilidad de devolver bytes leídos de más."""
+
+    def __init__(self, stream, chunk_size=1024 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.pending = b""
+
+    def read(self, n):
+        """Lee exactamente n bytes (menos solo si el stream se acaba)."""
+        parts = [self.pending[:n]]
+        self.pending = self.pending[n:]
+        missing = n - len(parts[0])
+        while missing > 0:
+            data = self.stream.read(max(missing, self.chunk_size))
+            if not data:
+                break
+            parts.append(data[:missing])
+            self.pending = data[missing:]
+            missing -= len(parts[-1])
+        return b"".join(parts)
+
+    def read_chunk(self):
+        """Devuelve el siguiente trozo disponible (b'' al final del stream)."""
+        if self.pending:
+            data, self.pending = self.pending, b""
+            return data
+        return self.stream.read(self.chunk_size)
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+
+def parse_zip64_sizes(extra, compressed_size, uncompressed_size):
+    """
+    Lee la extensión ZIP64 (id 0x0001) de una cabecera local.
+
+    Returns:
+        tuple: (tamaño comprimido, tamaño descomprimido, True si la entrada es ZIP64).
+    """
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack("<HH", extra[offset:offset + 4])
+        if header_id == 0x0001:
+            values = extra[offset + 4:offset + 4 + length]
+            position = 0
+            if uncompressed_size == 0xFFFFFFFF and position + 8 <= len(values):
+                uncompressed_size = struct.unpack("<Q", values[position:position + 8])[0]
+                position += 8
+            if compressed_size == 0xFFFFFFFF and position + 8 <= len(values):
+                compressed_size = struct.unpack("<Q", values[position:position + 8])[0]
+            return compressed_size, uncompressed_size, True
+        offset += 4 + length
+    return compressed_size, uncompressed_size, False
+
+
+def iter_zip_stream(stream):
+    """
+    Recorre un zip leído secuencialmente (p. ej. una respuesta HTTP en streaming) sin
+    necesidad de seek ni de escribir a disco, devolviendo (nombre, contenido) por entrada.
+
+    Soporta entradas almacenadas o comprimidas con deflate, con o sin descriptor de datos
+    (bit 3), que es lo habitual en zips generados al vuelo.
+    """
+    reader = StreamReader(stream)
+    while True:
+        header = reader.read(30)
+        if len(header) < 30 or header[:4] != LOCAL_HEADER_SIGNATURE:
+            # Fin de las entradas (empieza el directorio central)
+            return
+        (_, _, flags, method, _, _, _, compressed_size, uncompressed_size,
+         name_length, extra_length) = struct.unpack("<4sHHHHHIIIHH", header)
+        name = reader.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read(extra_length)
+        compressed_size, uncompressed_size, is_zip64 = parse_zip64_sizes(extra, compressed_size, uncompressed_size)
+        has_descriptor = bool(flags & 0x08)
+
+        if method not in (0, 8):
+            raise ValueError(f"Método de compresión {method} no soportado en '{name}'")
+
+        if not has_descriptor:
+            data = reader.read(compressed_size)
+            if len(data) < compressed_size:
+                raise ValueError(f"Zip truncado en '{name}'")
+            content = zlib.decompress(data, -15) if method == 8 else data
+        elif method == 8:
+            # Sin tamaño conocido: descomprimir hasta el final del flujo deflate
+            decompressor = zlib.decompressobj(-15)
+            parts = []
+            while not decompressor.eof:
+                chunk = reader.read_chunk()
+                if not chunk:
+                    raise ValueError(f"Zip truncado en '{name}'")
+                parts.append(decompressor.decompress(chunk))
+            reader.unread(decompressor.unused_data)
+            content = b"".join(parts)
+        elif name.endswith('/'):
+            # Directorio: no lleva datos aunque tenga descriptor
+            content = b""
+        else:
+            raise ValueError(f"Entrada almacenada con descriptor de datos no soportada en '{name}'")
+
+        if has_descriptor:
+            # Firma opcional + crc32 + tamaños (8 bytes cada uno en entradas ZIP64)
+            signature = reader.read(4)
+            if signature != DATA_DESCRIPTOR_SIGNATURE:
+                reader.unread(signature)
+            reader.read(4 + (16 if is_zip64 else 8))
+
+        if not name.endswith('/'):
+            yield name, content
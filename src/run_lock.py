@@ -0,0 +1,133 @@
+"""
+Exclusión entre procesos para la sincronización con Notion.
+
+El monitor de KOReader, la tarea programada de Windows, el daemon y las ejecuciones a mano
+pueden lanzar una sincronización a la vez; dos en paralelo compiten en Notion y crean libros
+y anotaciones duplicados. `run_coalesced` garantiza que solo una se ejecuta:
+
+  - El cerrojo es un bloqueo del sistema operativo sobre `data/sync.lock` (fcntl en Linux/macOS,
+    msvcrt en Windows), así que se libera solo si el proceso muere y nunca queda obsoleto.
+  - Quien llega con otra sincronización en marcha deja una marca en `data/sync.pending` y
+    termina. Al acabar, el proceso que tenía el cerrojo ve la marca y ejecuta una sincronización
+    incremental más: N peticiones durante una ejecución se agrupan en una sola posterior.
+"""
+import os
+import time
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+LOCK_PATH = os.path.join("data", "sync.lock")
+PENDING_PATH = os.path.join("data", "sync.pending")
+
+
+class RunLock:
+    """Cerrojo exclusivo entre procesos sobre un fichero (no bloqueante)."""
+
+    def __init__(self, path=LOCK_PATH):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        """Intenta tomar el cerrojo; devuelve False si lo tiene otro proceso."""
+        if self.file is not None:
+            return True
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(self.path, 'a+')
+        try:
+            if msvcrt:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.file = lock_file
+        if not msvcrt:
+            # Quién lo tiene, para los mensajes de los demás procesos (en Windows el byte bloqueado no se puede leer)
+            lock_file.truncate(0)
+            lock_file.write(f"{os.getpid()} {time.time():.0f}\n")
+            lock_file.flush()
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        try:
+            if msvcrt:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def owner(self):
+        """PID del proceso que tiene el cerrojo, si se sabe."""
+        try:
+            with open(self.path, 'r') as f:
+                return int(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+
+def mark_pending(path=PENDING_PATH):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, 'a'):
+        pass
+
+
+def is_pending(path=PENDING_PATH):
+    return os.path.exists(path)
+
+
+def clear_pending(path=PENDING_PATH):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def run_coalesced(func, followup=None, lock_path=LOCK_PATH, pending_path=PENDING_PATH):
+    """
+    Ejecuta `func` con el cerrojo de sincronización, o la deja en cola si ya hay otra en marcha.
+
+    Args:
+        func: Sincronización pedida.
+        followup: Sincronización a repetir por las peticiones que lleguen mientras tanto
+            (por defecto `func`; p. ej. la incremental si `func` es una forzada).
+
+    Returns:
+        int: Ejecuciones hechas por este proceso (0 si la petición quedó en cola de otro).
+    """
+    lock = RunLock(lock_path)
+    if not lock.acquire():
+        mark_pending(pending_path)
+        # Si el otro proceso terminó justo ahora puede no haber visto la marca: se vuelve a intentar
+        if not lock.acquire():
+            owner = lock.owner()
+            print(f"⏳ Ya hay una sincronización en marcha{f' (proceso {owner})' if owner else ''}: "
+                  f"se ejecutará otra al terminar.")
+            return 0
+
+    runs = 0
+    try:
+        while True:
+            # Las peticiones que lleguen a partir de aquí necesitan otra ejecución
+            clear_pending(pending_path)
+            (func if runs == 0 else followup or func)()
+            runs += 1
+            # Se suelta antes de mirar la marca: quien la deje después lo verá al reintentar
+            lock.release()
+            if not is_pending(pending_path) or not lock.acquire():
+                return runs
+            print("\n🔁 Llegaron peticiones durante la sincronización: se ejecuta otra incremental.")
+    finally:
+        lock.release()
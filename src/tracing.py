@@ -0,0 +1,318 @@
+"""
+Traza opcional de cada llamada HTTP a Notion y Dropbox.
+
+Con `enable_tracing(path)` cada llamada añade una línea JSONL con el servicio, el
+endpoint, el id afectado (página, base de datos, bloque o ruta), el tamaño de la
+petición y de la respuesta, el estado, la duración y el número de intento. Las
+esperas por reintentos se registran como eventos "backoff". La escritura la hace un
+hilo en segundo plano con un buffer, así que los hilos que llaman a la API no esperan
+al disco. Desactivada (por defecto) no añade coste.
+
+Para resumir una traza (endpoints más costosos, libros más lentos y tiempo perdido
+por 429):
+
+    python -m src.tracing data/trace.jsonl [--top 10]
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Marca de fin para el hilo escritor
+STOP = object()
+
+# Claves que identifican el objeto afectado por una llamada, por orden de preferencia
+TARGET_KEYS = ('page_id', 'block_id', 'database_id', 'path', 'cursor')
+
+
+class TraceWriter:
+    """
+    Escritor JSONL con buffer en un hilo de fondo.
+
+    Args:
+        path: Fichero de la traza (se añade al final).
+        flush_interval: Segundos máximos que una línea espera en el buffer.
+        max_buffer: Líneas acumuladas que fuerzan una escritura.
+    """
+
+    def __init__(self, path, flush_interval=1.0, max_buffer=500):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.queue = queue.SimpleQueue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="trace-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        if not self.closed:
+            self.queue.put(record)
+
+    def run(self):
+        buffer = []
+        last_flush = time.monotonic()
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    record = None
+                if record is STOP:
+                    break
+                if record is not None:
+                    buffer.append(json.dumps(record, ensure_ascii=False, default=str))
+                if buffer and (len(buffer) >= self.max_buffer or time.monotonic() - last_flush >= self.flush_interval):
+                    f.write("\n".join(buffer) + "\n")
+                    f.flush()
+                    buffer = []
+                    last_flush = time.monotonic()
+            if buffer:
+                f.write("\n".join(buffer) + "\n")
+
+    def close(self):
+        """Vacía el buffer y detiene el hilo."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(STOP)
+        self.thread.join()
+
+
+# Escritor activo (None = traza desactivada) y contexto por hilo (libro en curso, intento)
+writer = None
+local = threading.local()
+
+
+def enable_tracing(path, **kwargs):
+    """Activa la traza en `path` para todo el proceso y devuelve el escritor."""
+    global writer
+    disable_tracing()
+    writer = TraceWriter(path, **kwargs)
+    return writer
+
+
+def disable_tracing():
+    global writer
+    if writer is not None:
+        writer.close()
+        writer = None
+
+
+def is_enabled():
+    return writer is not None
+
+
+@contextmanager
+def trace_context(**fields):
+    """Añade campos (p. ej. book=título, retry=1) a las llamadas que se hagan dentro del bloque en este hilo."""
+    previous = getattr(local, "fields", {})
+    local.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        local.fields = previous
+
+
+def current_fields():
+    """Campos de contexto del hilo actual (para propagarlos a otro hilo con in_trace_context)."""
+    return dict(getattr(local, "fields", {}))
+
+
+def in_trace_context(func, **fields):
+    """Envuelve func para que se ejecute dentro de trace_context(**fields) (p. ej. en executor.submit)."""
+    if writer is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        with trace_context(**fields):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def record(kind, **fields):
+    """Registra un evento en la traza (no hace nada si está desactivada)."""
+    if writer is None:
+        return
+    writer.write({"ts": round(time.time(), 3), "kind": kind, **getattr(local, "fields", {}), **fields})
+
+
+def payload_size(value):
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return None
+
+
+def find_target(kwargs):
+    for key in TARGET_KEYS:
+        if kwargs.get(key):
+            return str(kwargs[key])
+    parent = kwargs.get("parent")
+    if isinstance(parent, dict):
+        return parent.get("database_id") or parent.get("page_id")
+    return None
+
+
+def error_status(error):
+    return getattr(error, "status", None) or getattr(error, "status_code", None) or type(error).__name__
+
+
+@contextmanager
+def trace_request(service, endpoint, target=None, request_bytes=None):
+    """
+    Mide una llamada HTTP hecha fuera de un cliente envuelto (p. ej. descargas por rangos).
+    Dentro del bloque se puede fijar `info["status"]` e `info["response_bytes"]`.
+    """
+    info = {}
+    if writer is None:
+        yield info
+        return
+    start = time.perf_counter()
+    try:
+        yield info
+    except BaseException as e:
+        info.setdefault("status", error_status(e))
+        raise
+    finally:
+        record("request", service=service, endpoint=endpoint, target=target, request_bytes=request_bytes,
+               response_bytes=info.get("response_bytes"), status=info.get("status", 200),
+               duration_ms=round((time.perf_counter() - start) * 1000, 2))
+
+
+class TracedClient:
+    """
+    Envuelve un cliente de API (notion_client.Client, dropbox.Dropbox) y añade una
+    línea a la traza por cada llamada a sus endpoints, con la misma interfaz.
+    """
+
+    def __init__(self, client, service, prefix=""):
+        self._client = client
+        self._service = service
+        self._prefix = prefix
+        self._package = type(client).__module__.split(".")[0]
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        endpoint = f"{self._prefix}{name}"
+        if callable(value):
+            service = self._service
+
+            def call(*args, **kwargs):
+                target = find_target(kwargs) or (str(args[0]) if args and isinstance(args[0], str) else None)
+                with trace_request(service, endpoint, target, payload_size(kwargs) if kwargs else None) as info:
+                    result = value(*args, **kwargs)
+                    if isinstance(result, dict):
+                        info["response_bytes"] = payload_size(result)
+                    return result
+            return call
+        if type(value).__module__.split(".")[0] == self._package:
+            return TracedClient(value, self._service, prefix=f"{endpoint}.")
+        return value
+
+
+def trace_client(client, service):
+    """Devuelve el cliente envuelto si la traza está activada, o el mismo cliente si no."""
+    return TracedClient(client, service) if writer is not None else client
+
+
+def load_trace(path):
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # Línea cortada por una interrupción
+    return records
+
+
+def is_error_status(status):
+    """Un registro es un error si su estado no es un código 2xx (p. ej. 429 o el tipo de una excepción)."""
+    if isinstance(status, str) and status.isdigit():
+        status = int(status)
+    return not (isinstance(status, int) and 200 <= status < 300)
+
+
+def summarize_trace(records, top=10):
+    """
+    Resume una traza.
+
+    Returns:
+        dict: 'endpoints' (llamadas, segundos, bytes y errores por servicio/endpoint, de más
+            a menos tiempo), 'books' (los libros con más tiempo de API) y 'throttling' (llamadas
+            con 429, segundos que duraron y segundos esperando reintentos).
+    """
+    endpoints = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "request_bytes": 0, "response_bytes": 0,
+                                     "errors": 0, "max_ms": 0.0})
+    books = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+    throttled_calls = 0
+    throttled_seconds = 0.0
+    backoff_seconds = 0.0
+
+    for entry in records:
+        if entry.get("kind") == "backoff":
+            backoff_seconds += entry.get("wait_ms", 0) / 1000
+            continue
+        seconds = entry.get("duration_ms", 0) / 1000
+        stats = endpoints[f'{entry.get("service")} {entry.get("endpoint")}']
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["request_bytes"] += entry.get("request_bytes") or 0
+        stats["response_bytes"] += entry.get("response_bytes") or 0
+        stats["max_ms"] = max(stats["max_ms"], entry.get("duration_ms", 0))
+        if is_error_status(entry.get("status")):
+            stats["errors"] += 1
+        if str(entry.get("status")) == "429":
+            throttled_calls += 1
+            throttled_seconds += seconds
+        if entry.get("book"):
+            books[entry["book"]]["calls"] += 1
+            books[entry["book"]]["seconds"] += seconds
+
+    def ranked(stats):
+        return sorted(({"name": name, **values} for name, values in stats.items()),
+                      key=lambda item: item["seconds"], reverse=True)[:top]
+
+    return {
+        "requests": sum(stats["calls"] for stats in endpoints.values()),
+        "endpoints": ranked(endpoints),
+        "books": ranked(books),
+        "throttling": {"calls": throttled_calls, "seconds": round(throttled_seconds, 3),
+                       "backoff_seconds": round(backoff_seconds, 3)},
+    }
+
+
+def print_summary(summary):
+    print(f"📊 {summary['requests']} llamadas en la traza\n")
+    print("🔝 Endpoints por tiempo total:")
+    for item in summary["endpoints"]:
+        print(f"   {item['name']:<40} {item['calls']:6d} llamadas {item['seconds']:8.2f} s "
+              f"(máx {item['max_ms'] / 1000:.2f} s) {item['request_bytes'] / 1e3:8.1f} KB enviados "
+              f"{item['response_bytes'] / 1e3:8.1f} KB recibidos {item['errors']:4d} errores")
+    if summary["books"]:
+        print("\n🐢 Libros más lentos:")
+        for item in summary["books"]:
+            print(f"   {item['name'][:50]:<50} {item['calls']:6d} llamadas {item['seconds']:8.2f} s")
+    throttling = summary["throttling"]
+    print(f"\n⏳ Limitación de Notion/Dropbox (429): {throttling['calls']} llamadas, "
+          f"{throttling['seconds']:.2f} s en ellas y {throttling['backoff_seconds']:.2f} s esperando reintentos")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumen de una traza de llamadas a Notion y Dropbox")
+    parser.add_argument('path', help="Fichero JSONL de la traza")
+    parser.add_argument('--top', type=int, default=10, help="Número de endpoints y libros a mostrar")
+    args = parser.parse_args()
+    print_summary(summarize_trace(load_trace(args.path), top=args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -333,8 +333,9 @@ def transfer_all_annotations(source_db_path, target_db_path, dry_run=True, book_
     return global_stats
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
+        prog='koboannotations transfer' if argv is not None else None,
         description='Transferir anotaciones entre bases de datos de Kobo'
     )
     parser.add_argument(
@@ -358,7 +359,7 @@ def main():
         help='Títulos de libros específicos a transferir (opcional)'
     )
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Verificar que los archivos existen
     source_path = Path(args.source)